@@ -0,0 +1,98 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - SenseHat acquisition
+
+    Every SenseHat quantity is read once per sample into a Snapshot that the sensor & sampling jobs all
+    share, rather than each of them reading what it needs at a different moment. With the sense_hat library
+    a read is two I2C transactions - the HTS221 returns the humidity & its temperature together, the LPS25H
+    the pressure & its temperature. Those reads go through the library's sensor objects, which aren't part
+    of its API, so at start up one is checked against the four public getters & the getters are used instead
+    when it fails or disagrees (another sense_hat release, a trace recorder) - stats() reports which.
+
+    With oversample > 1 the reads are spread across the sample slot by their own job & the snapshot is the
+    average of those since the last one, lowering the noise without any reads on the sampling tick itself.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import collections
+
+# th/tp the temperature from the humidity/pressure sensor, cpu the SoC temperature, n the reads averaged
+Snapshot = collections.namedtuple('Snapshot', 'time th tp humidity pressure cpu n')
+
+FIELDS = ('th', 'tp', 'humidity', 'pressure', 'cpu')
+
+# how far a direct read may be from the getters' for the self test, C, C, %, hPa
+TOLERANCE = (1.0, 1.0, 3.0, 1.0)
+
+# what the sensor internals look like when they aren't what read_sense() expects
+CHANGED = (AttributeError, IndexError, TypeError, ValueError)
+
+
+def read_sense(sense):
+    # (th, tp, humidity, pressure), 0 for a reading the sensor flags as invalid as the getters do
+    h = sense._humidity.humidityRead()
+    p = sense._pressure.pressureRead()
+    return (h[3] if h[2] else 0, p[3] if p[2] else 0, h[1] if h[0] else 0, p[1] if p[0] else 0)
+
+
+def read_getters(sense):
+    # the same through the public API, two reads of each sensor
+    return (sense.get_temperature_from_humidity(), sense.get_temperature_from_pressure(),
+            sense.get_humidity(), sense.get_pressure())
+
+
+def self_test(sense):
+    # can read_sense() be used with this library, a direct read within TOLERANCE of the getters
+    try:
+        sense._init_humidity()
+        sense._init_pressure()
+        direct = read_sense(sense)
+        if len(direct) != len(TOLERANCE): return False
+        return all(abs(float(a) - float(b)) <= tolerance for a, b, tolerance in zip(direct, read_getters(sense), TOLERANCE))
+    except CHANGED:
+        return False
+
+
+class SenseSampler(object):
+
+    def __init__(self, sense, cpu, clock, oversample=1):
+        self.sense = sense
+        self.cpu = cpu
+        self.clock = clock
+        self.oversample = max(1, int(oversample))
+        self.latest = None
+        self.reads = 0
+        self.snapshots = 0
+        self._sums = [0.0] * len(FIELDS)
+        self._n = 0
+        # the sensors' own read calls when they pass the self test, the getters otherwise
+        self.direct = self_test(sense)
+
+    def read(self):
+        # one read of everything, added to the current average
+        values = None
+        if self.direct:
+            try:
+                values = read_sense(self.sense)
+            except CHANGED:
+                self.direct = False
+        if values is None:
+            values = read_getters(self.sense)
+        values = tuple(values) + (self.cpu.get(),)
+        self.reads += 1
+        for i, x in enumerate(values): self._sums[i] += x
+        self._n += 1
+
+    def snapshot(self):
+        # the snapshot for this sample, from the reads spread across the slot or (no oversampling, or
+        # none were taken) a read now
+        if self.oversample == 1 or not self._n: self.read()
+        n = self._n
+        self.latest = Snapshot(self.clock.time(), *([x / n for x in self._sums] + [n]))
+        self._sums = [0.0] * len(FIELDS)
+        self._n = 0
+        self.snapshots += 1
+        return self.latest
+
+    def stats(self):
+        return {'reads': self.reads, 'snapshots': self.snapshots, 'oversample': self.oversample, 'direct': self.direct}
@@ -0,0 +1,72 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - interval aggregation
+
+    Running count, min, max, mean & standard deviation per metric over an upload window, updated in O(1)
+    per sample with Welford's method so nothing but five numbers is kept per metric.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import math
+
+
+class RunningStats(object):
+    __slots__ = ('n', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or x < self.min: self.min = x
+        if self.max is None or x > self.max: self.max = x
+
+    def sd(self):
+        # sample standard deviation, 0 until there are two samples
+        if self.n < 2: return 0.0
+        return math.sqrt(self.m2 / (self.n - 1))
+
+    def summary(self, digits=2):
+        return {'n': self.n,
+                'min': round(self.min, digits),
+                'max': round(self.max, digits),
+                'avg': round(self.mean, digits),
+                'sd': round(self.sd(), digits)}
+
+
+class Aggregator(object):
+    # one RunningStats per metric for the current window
+
+    def __init__(self, metrics):
+        self.stats = dict((metric, RunningStats()) for metric in metrics)
+
+    def add(self, metric, x):
+        self.stats[metric].add(x)
+
+    def close_window(self, digits=2):
+        # summaries of the metrics that had samples, then start a new window
+        summaries = {}
+        for metric, stats in self.stats.items():
+            if stats.n:
+                summaries[metric] = stats.summary(digits)
+            stats.reset()
+        return summaries
+
+
+def upload_fields(summaries):
+    # flatten window summaries into upload fields, e.g. t_min, t_max, t_avg, t_sd, t_n
+    data = {}
+    for metric, summary in summaries.items():
+        for key, value in summary.items():
+            data[metric + '_' + key] = str(value)
+    return data
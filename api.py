@@ -0,0 +1,169 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - local read only HTTP API
+
+    Serves the latest reading, recent history & the station State straight from the Pi on its own threads,
+    nothing here runs on the sampling path. The loop publishes plain dicts once per tick, copied as it
+    keeps changing its own in place; each one is serialized to JSON by the first request that wants it and
+    the bytes are reused until the next tick. Every response carries an ETag, a hash of the body so it
+    holds across restarts, and pollers sending If-None-Match get an empty 304.
+
+        GET /current                          latest reading
+        GET /state                            station State
+        GET /history?metric=t&hours=24[&resolution=900]
+        GET /metrics                          Prometheus text format (see metrics.py)
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import copy
+import hashlib
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+
+MAX_HISTORY_HOURS = 24 * 365
+
+
+class Published(object):
+    # the documents the API serves, replaced by the loop & serialized lazily by the server
+
+    def __init__(self):
+        self.generation = 0
+        self.requests = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._docs = {}             # name -> object as published
+        self._cache = {}            # key -> (etag, json bytes), emptied every publish
+
+    def publish(self, docs):
+        # called from the loop once per tick with {name: dict}, no serialization happens here. A deep copy,
+        # the loop mutates nested values (the channels, the breakers) while a request may be serializing
+        docs = dict((name, copy.deepcopy(doc)) for name, doc in docs.items())
+        with self._lock:
+            for name, doc in docs.items():
+                self._docs[name] = doc
+            self.generation += 1
+            self._cache = {}
+
+    def get(self, key, build):
+        # (etag, bytes) for key, build() makes the object on a cache miss
+        with self._lock:
+            cached = self._cache.get(key)
+            generation = self.generation
+        if cached is not None:
+            return cached
+        body = json.dumps(build(), default=str, sort_keys=True).encode('utf-8')
+        cached = ('"%s"' % hashlib.sha1(body).hexdigest()[:20], body)
+        with self._lock:
+            if generation == self.generation:
+                self._cache[key] = cached
+        return cached
+
+    def doc(self, name):
+        with self._lock:
+            return self._docs.get(name)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = 'WeatherPi/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        published = self.server.published
+        published.requests += 1
+        url = urlsplit(self.path)
+        name = url.path.strip('/')
+        if name == 'metrics' and self.server.metrics is not None:
+            return self.send_metrics()
+        try:
+            if name in ('current', 'state'):
+                if published.doc(name) is None:
+                    return self.send_error(503, 'No data yet')
+                etag, body = published.get(name, lambda: published.doc(name))
+            elif name == 'history' and self.server.history is not None:
+                query = parse_qs(url.query)
+                metric = query.get('metric', ['t'])[0]
+                hours = min(float(query.get('hours', ['24'])[0]), MAX_HISTORY_HOURS)
+                resolution = query.get('resolution', [None])[0]
+                if resolution is not None: resolution = int(resolution)
+                etag, body = published.get(('history', metric, hours, resolution),
+                                           lambda: self.history(metric, hours, resolution))
+            else:
+                return self.send_error(404)
+        except (ValueError, KeyError):
+            return self.send_error(400)
+        if self.headers.get('If-None-Match') == etag:
+            published.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_metrics(self):
+        # always fresh, no ETag
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def history(self, metric, hours, resolution):
+        end = time.time()
+        resolution, rows = self.server.history.query(metric, end - hours * 3600, end, resolution)
+        if resolution:
+            columns = ['ts', 'n', 'min', 'max', 'avg', 'sd']
+        else:
+            columns = ['ts', 'value']
+        return {'metric': metric, 'resolution': resolution, 'columns': columns, 'rows': rows}
+
+
+class Api(object):
+
+    def __init__(self, bind='', port=8080, history=None, metrics=None):
+        self.published = Published()
+        self.server = ThreadingHTTPServer((bind, port), ApiHandler)
+        self.server.published = self.published
+        self.server.history = history
+        self.server.metrics = metrics
+        self._thread = None
+
+    def publish(self, docs):
+        self.published.publish(docs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='Api')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        return {'requests': self.published.requests,
+                'not_modified': self.published.not_modified,
+                'generation': self.published.generation}
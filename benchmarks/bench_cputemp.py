@@ -0,0 +1,43 @@
+#!/usr/bin/python
+'''*****************************************************************************************************************
+    Pi Weather Station - CPU temperature microbenchmark
+
+    Compares the cost of one CPU temperature reading through the held-open sysfs descriptor against the
+    old vcgencmd fork. Run on the Pi: python benchmarks/bench_cputemp.py [reads]
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cputemp import CpuTemp, read_vcgencmd
+
+
+def per_read(func, number):
+    # best of 3 runs, in microseconds per reading
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    cpu = CpuTemp(max_age=0)
+    if cpu.fd is None:
+        print("No thermal zone found, nothing to compare")
+    else:
+        print("sysfs pread   %-40s %10.1f us/read  (%.1fC)" % (cpu.path, per_read(cpu.read_sysfs, number), cpu.read_sysfs()))
+    try:
+        print("vcgencmd fork %-40s %10.1f us/read  (%.1fC)" % ('', per_read(read_vcgencmd, max(1, number // 50)), read_vcgencmd()))
+    except (OSError, ValueError):
+        print("vcgencmd not available")
+    cached = CpuTemp(max_age=5.0)
+    if cached.fd is not None:
+        print("cached get    %-40s %10.1f us/read" % ('max_age=5s', per_read(cached.get, number)))
+    cpu.close()
+    cached.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+'''*****************************************************************************************************************
+    Pi Weather Station - derived metrics throughput benchmark
+
+    Times the derived metrics (derived.py) over random samples three ways: the scalar derive() a sample at a
+    time as the live tick does, derive_batch() (numpy when installed) & its plain loop fallback, then a
+    backfill() of a store seeded with a year of 15 minute rollups. Reports samples per second & writes them
+    as JSON to compare against another run:
+
+        python benchmarks/bench_derived.py --samples 200000 --out before.json
+        python benchmarks/bench_derived.py --out after.json --compare before.json
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, baseDir)
+
+import derived
+from derived import derive, derive_batch
+from tsdb import TimeSeriesStore
+
+
+def samples(n, seed=1):
+    rnd = random.Random(seed)
+    t = [rnd.uniform(-20, 40) for i in range(n)]
+    rh = [rnd.uniform(5, 100) for i in range(n)]
+    p = [rnd.uniform(960, 1040) for i in range(n)]
+    return t, rh, p
+
+
+def timed(func, n, repeat):
+    # best of repeat, samples per second
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        func()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {'samples': n, 'seconds': round(best, 4), 'per_second': int(n / best) if best else 0}
+
+
+def run(args):
+    t, rh, p = samples(args.samples)
+    result = {'numpy': derived.numpy is not None and derived.numpy.__version__}
+
+    def scalar():
+        for sample in zip(t, rh, p):
+            derive(sample[0], sample[1], sample[2], 100.0)
+    result['scalar'] = timed(scalar, args.samples, args.repeat)
+    result['loop'] = timed(lambda: derived._derive_loop(t, rh, p, 100.0), args.samples, args.repeat)
+    if derived.numpy is not None:
+        result['batch'] = timed(lambda: derive_batch(t, rh, p, 100.0), args.samples, args.repeat)
+
+    # a year of 15 minute rollups, recomputed from the bucket averages
+    workdir = tempfile.mkdtemp(prefix='weatherpi-bench-')
+    try:
+        store = TimeSeriesStore(os.path.join(workdir, 'history.db'))
+        end = int(time.time()) // 900 * 900
+        stamps = [end - i * 900 for i in range(365 * 96)]
+        for metric, series in (('t', t), ('rh', rh), ('p', p)):
+            store.rewrite(900, [(metric, ts, 180, x, x, x, 0.0) for ts, x in zip(stamps, series * (len(stamps) // len(series) + 1))])
+        result['backfill'] = timed(lambda: derived.backfill(store, stamps[-1], end, 900), len(stamps), 1)
+        store.close()
+    finally:
+        shutil.rmtree(workdir)
+    return result
+
+
+def report(result, baseline=None):
+    print('%-10s %10s %10s %14s' % ('path', 'samples', 'seconds', 'samples/s'))
+    for name in ('scalar', 'loop', 'batch', 'backfill'):
+        if name not in result: continue
+        now = result[name]
+        text = '%-10s %10d %10.4f %14d' % (name, now['samples'], now['seconds'], now['per_second'])
+        then = baseline and baseline.get(name)
+        if then and then['per_second']:
+            text += '   %+6.1f%%' % ((now['per_second'] / float(then['per_second']) - 1) * 100)
+        print(text)
+    print('numpy %s' % (result['numpy'] or 'not installed, batch & backfill use the loop'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Weather Pi derived metrics throughput benchmark')
+    parser.add_argument('--samples', type=int, default=100000, help='samples per path (default 100000)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per path, the best is kept (default 3)')
+    parser.add_argument('--out', default='bench_derived.json', help='results file (default bench_derived.json)')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    result = run(args)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    report(result, baseline)
+    print('results written to ' + args.out)
+
+if __name__ == "__main__":
+    main()
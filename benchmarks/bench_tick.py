@@ -0,0 +1,340 @@
+#!/usr/bin/python
+'''*****************************************************************************************************************
+    Pi Weather Station - tick latency benchmark
+
+    Runs weather_pi's loop over a synthetic trace with the real uploaders posting to a local stub server
+    (configurable latency & failure rate). The clock is virtual but charged with the real time each tick
+    takes (times --factor, e.g. 10 to play a Pi 1 on a desktop) so lateness & missed slots are real.
+    Reports end to end tick latency & per stage latency percentiles, CPU time per simulated hour & missed
+    slots, and writes them as JSON to compare against another run:
+
+        python benchmarks/bench_tick.py --hours 6 --latency 20 --failure 0.05 --out before.json
+        python benchmarks/bench_tick.py --out after.json --compare before.json
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, baseDir)
+
+import weather_pi
+from weather_pi import Config
+from hal import Trace, ReplayHardware, VirtualClock
+from scheduler import monotonic
+from uploader import Uploader, Connection
+from tsdb import TimeSeriesStore
+from api import Api
+from acquire import SenseSampler
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+# ============================================================================
+# stub upload server
+# ============================================================================
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply()
+
+    def reply(self):
+        server = self.server
+        server.requests += 1
+        if server.latency: time.sleep(server.latency)
+        if server.random.random() < server.failure:
+            server.failures += 1
+            body = b'stub failure'
+            self.send_response(500)
+        else:
+            body = b'{"Status":0}' if self.path.startswith('/pw') else b'success'
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency, failure, seed=1):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.failure = failure
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.failures = 0
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='StubServer')
+        thread.daemon = True
+        thread.start()
+
+
+# ============================================================================
+# clock & hardware
+# ============================================================================
+class LoadedClock(VirtualClock):
+    # virtual time that also moves on by the real time spent working between sleeps, times factor
+
+    def __init__(self, start, factor=1.0):
+        VirtualClock.__init__(self, start)
+        self.factor = factor
+        self.ticks = []             # real seconds of work between sleeps, i.e. per tick
+        self._mark = monotonic()
+
+    def monotonic(self):
+        return self.elapsed + (monotonic() - self._mark) * self.factor
+
+    def time(self):
+        return self.start + self.monotonic()
+
+    def sleep(self, seconds):
+        now = monotonic()
+        work = now - self._mark
+        self.ticks.append(work)
+        self.elapsed += work * self.factor + max(seconds, 0)
+        self._mark = now
+
+    def exclude(self, seconds):
+        # real time that isn't the station's work, e.g. waiting for the stub server
+        self._mark += seconds
+
+
+class BenchHardware(ReplayHardware):
+    # trace sensors, real uploaders & connections
+
+    def uploader(self, name, url, queue_size, connect_timeout, read_timeout):
+        uploader = Uploader(name, url, queue_size, connect_timeout, read_timeout)
+        count_submits(uploader)
+        return uploader
+
+    def connection(self, url, connect_timeout, read_timeout):
+        return Connection(url, connect_timeout, read_timeout)
+
+
+# ============================================================================
+# stage timing
+# ============================================================================
+class Stages(object):
+
+    def __init__(self):
+        self.total = {}             # stage -> [seconds per call]
+        self.own = {}               # stage -> [seconds per call less the timed stages it called]
+        self._children = []
+
+    def wrap(self, name, func):
+        stages = self
+
+        def timed(*args, **kwargs):
+            stages._children.append(0.0)
+            start = monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = monotonic() - start
+                children = stages._children.pop()
+                stages.total.setdefault(name, []).append(elapsed)
+                stages.own.setdefault(name, []).append(elapsed - children)
+                if stages._children: stages._children[-1] += elapsed
+        return timed
+
+
+def percentiles(values):
+    # milliseconds
+    if not values: return {'count': 0}
+    values = sorted(values)
+    n = len(values)
+
+    def pct(p):
+        return round(values[min(n - 1, int(p / 100.0 * n))] * 1000, 4)
+    return {'count': n,
+            'mean': round(sum(values) / n * 1000, 4),
+            'p50': pct(50),
+            'p90': pct(90),
+            'p99': pct(99),
+            'max': round(values[-1] * 1000, 4)}
+
+
+def instrument(stages, hw):
+    # wrap the station's stages; the jobs are looked up when main() builds the scheduler
+    SenseSampler.read = stages.wrap('sensehat', SenseSampler.read)
+    hw.probes.get = stages.wrap('probes', hw.probes.get)
+    hw.cpu.get = stages.wrap('cpu', hw.cpu.get)
+    for name, job in (('sample', 'take_sample'), ('display', 'refresh_display'),
+                      ('pw_payload', 'pw_upload'), ('wu_payload', 'wu_upload'),
+                      ('upload_results', 'check_uploads'), ('notices', 'check_notification'),
+                      ('save_state', 'saveState')):
+        setattr(weather_pi, job, stages.wrap(name, getattr(weather_pi, job)))
+    TimeSeriesStore.add = stages.wrap('history', TimeSeriesStore.add)
+    Api.publish = stages.wrap('publish', Api.publish)
+
+
+def settle(clock, job):
+    # let the uploaders finish what the job queued before the next tick, off the tick's clock
+
+    def settled():
+        job()
+        start = monotonic()
+        deadline = start + 30
+        for uploader in (weather_pi.pw_uploader, weather_pi.wu_uploader):
+            while monotonic() < deadline:
+                stats = uploader.stats()
+                if not stats['depth'] and uploader.sent + uploader.failed + uploader.dropped >= uploader.submitted:
+                    break
+                time.sleep(0.001)
+        clock.exclude(monotonic() - start)
+    return settled
+
+
+def count_submits(uploader):
+    uploader.submitted = 0
+    submit = uploader.submit
+
+    def counted(params, tag=None):
+        uploader.submitted += 1
+        return submit(params, tag)
+    uploader.submit = counted
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=baseDir).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='weatherpi-bench-')
+    server = StubServer(args.latency / 1000.0, args.failure)
+    server.start()
+    try:
+        Config.LOGGING_PRINT = False
+        Config.TRACE_PATH = None
+        Config.FAILURE_REBOOT = False
+        Config.PW_UPLOAD = True
+        Config.WU_UPLOAD = True
+        Config.PW_URL = server.url + '/pw'
+        Config.WU_URL = server.url + '/wu'
+        Config.API = True
+        Config.API_BIND = '127.0.0.1'
+        Config.API_PORT = 0
+        Config.CONTROL = False
+        Config.STATE_PATH = os.path.join(workdir, 'State.pkl')
+        Config.OUTBOX_PATH = os.path.join(workdir, 'outbox.db')
+        Config.TSDB_PATH = os.path.join(workdir, 'history.db')
+        Config.METRICS_PATH = os.path.join(workdir, 'weather_pi.prom')
+        Config.SPARKLINE_PATH = os.path.join(workdir, 'recent.bin')
+        weather_pi.setup_logging(os.path.join(workdir, 'weather_pi.log'))
+
+        probes = [sensor.get('probe') or '28-%012d' % (n + 1) for n, sensor in enumerate(Config.SENSORS) if sensor['source'] == 'probe']
+        trace = Trace.synthetic(args.hours / 24.0 + 0.01, probes=probes)
+        clock = LoadedClock(trace.start(), args.factor)
+        hw = BenchHardware(trace, clock)
+        stages = Stages()
+        weather_pi.startup(hw)
+        instrument(stages, hw)
+
+        # uploads are paced in real time so the worker threads keep up with the virtual clock
+        weather_pi.pw_upload = settle(clock, weather_pi.pw_upload)
+        weather_pi.wu_upload = settle(clock, weather_pi.wu_upload)
+
+        wall = monotonic()
+        cpu = cpu_time()
+        weather_pi.main(run_for=args.hours * 3600)
+        cpu = cpu_time() - cpu
+        wall = monotonic() - wall
+
+        hours = clock.monotonic() / 3600.0
+        scheduler = weather_pi.scheduler.stats()
+        return {'version': git_version(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'when': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'params': vars(args),
+                'simulated_hours': round(hours, 3),
+                'wall_seconds': round(wall, 3),
+                'cpu_seconds': round(cpu, 3),
+                'cpu_ms_per_hour': round(cpu / hours * 1000, 3),
+                # the first & last ticks also carry main()'s start up & shut down
+                'tick_ms': percentiles(clock.ticks[1:-1]),
+                'stages_ms': dict((name, percentiles(values)) for name, values in stages.total.items()),
+                'stages_own_ms': dict((name, percentiles(values)) for name, values in stages.own.items()),
+                'missed': dict((name, job['missed']) for name, job in scheduler.items()),
+                'late_max': dict((name, job['late_max']) for name, job in scheduler.items()),
+                'uploads': {'pw': weather_pi.pw_uploader.stats(), 'wu': weather_pi.wu_uploader.stats()},
+                'server': {'requests': server.requests, 'failures': server.failures}}
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workdir)
+
+
+def report(result, baseline=None):
+    def line(name, now, then):
+        text = '%-16s %6d %9.3f %9.3f %9.3f %9.3f' % (name, now['count'], now['p50'], now['p90'], now['p99'], now['max'])
+        if then and then.get('count') and then['p50']:
+            text += '   p50 %+6.1f%%  p99 %+6.1f%%' % ((now['p50'] / then['p50'] - 1) * 100, (now['p99'] / then['p99'] - 1) * 100)
+        return text
+
+    print('%-16s %6s %9s %9s %9s %9s' % ('ms', 'count', 'p50', 'p90', 'p99', 'max'))
+    print(line('tick', result['tick_ms'], baseline and baseline['tick_ms']))
+    for name in sorted(result['stages_ms']):
+        if result['stages_ms'][name]['count']:
+            print(line(name, result['stages_ms'][name], baseline and baseline['stages_ms'].get(name)))
+    print('cpu per simulated hour %.1f ms%s' % (result['cpu_ms_per_hour'],
+          '  (was %.1f ms)' % baseline['cpu_ms_per_hour'] if baseline else ''))
+    print('missed slots %s' % json.dumps(result['missed'], sort_keys=True))
+    print('server %s' % json.dumps(result['server'], sort_keys=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Weather Pi tick latency benchmark')
+    parser.add_argument('--hours', type=float, default=6, help='simulated hours (default 6)')
+    parser.add_argument('--latency', type=float, default=20, help='stub server latency in ms (default 20)')
+    parser.add_argument('--failure', type=float, default=0.0, help='stub server failure rate 0..1 (default 0)')
+    parser.add_argument('--factor', type=float, default=1.0, help='virtual seconds charged per real second of work')
+    parser.add_argument('--out', default='bench_tick.json', help='results file (default bench_tick.json)')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    result = run(args)
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    report(result, baseline)
+    print('results written to ' + args.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - circuit breaker
+
+    One per upload destination, on the main thread. Closed, uploads go out as normal & threshold failures
+    in a row open it. Open, nothing is sent to the destination (the PW readings go to the outbox) until
+    its backoff has passed - base seconds doubling with every opening in a row up to cap, +/- jitter so
+    the retries don't fall into step with the server's own restarts - then it goes half open & the
+    destination is probed with something cheap (a TCP connect, not an upload). A good probe closes it on
+    probation (the next failure opens it again straight away), a bad one reopens it with a longer
+    backoff. Only a delivered upload resets the backoff. opens counts the openings in a row, the station
+    escalates its local recovery (reconnect, restart the network, reboot) on it & keeps the steps it took
+    in recovered, each once an outage. restore() carries an outage over a restart, backoff included.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import random
+
+from scheduler import monotonic
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+
+# gauge values
+LEVELS = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, threshold=3, base=30.0, cap=900.0, jitter=0.2, clock=monotonic, rand=random.random):
+        self.name = name
+        self.threshold = threshold
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.clock = clock
+        self.rand = rand
+        self.state = CLOSED
+        self.failures = 0           # in a row
+        self.opens = 0              # openings in a row, since the last delivered upload
+        self.retry_at = None        # clock() when an open breaker is due a probe
+        self.changed = clock()
+        self.recovered = []         # local recovery steps taken since the last delivered upload
+        self.on_change = None       # optional callback(breaker, old state, new state)
+
+    def allow(self):
+        # may an upload be sent now
+        return self.state == CLOSED
+
+    def due(self):
+        # open & the backoff has passed, time to probe
+        return self.state == OPEN and self.clock() >= self.retry_at
+
+    def probing(self):
+        self._set(HALF_OPEN)
+
+    def probed(self, ok):
+        if self.state != HALF_OPEN: return
+        if ok:
+            # on probation, one more failure & it opens again
+            self.failures = self.threshold - 1
+            self._set(CLOSED)
+        else:
+            self._open()
+
+    def success(self):
+        self.failures = 0
+        self.opens = 0
+        self.recovered = []
+        if self.state != CLOSED: self._set(CLOSED)
+
+    def failure(self):
+        # uploads already in flight when it opened still report back, they don't count twice
+        self.failures += 1
+        if self.state == CLOSED and self.failures >= self.threshold:
+            self._open()
+
+    def backoff(self):
+        # seconds the next opening lasts, before the jitter
+        return min(self.cap, self.base * 2 ** self.opens)
+
+    def _open(self):
+        wait = self.backoff() * (1 + self.jitter * (2 * self.rand() - 1))
+        self.opens += 1
+        self.retry_at = self.clock() + wait
+        self._set(OPEN)
+
+    def _set(self, state):
+        old, self.state = self.state, state
+        self.changed = self.clock()
+        if self.on_change is not None:
+            self.on_change(self, old, state)
+
+    def restore(self, saved, retry_in=0.0):
+        # a snapshot saved before a restart, an open (or half open) breaker stays open until retry_in
+        # seconds from now rather than starting closed & needing threshold failures to open again
+        self.opens = saved.get('opens', 0)
+        self.recovered = list(saved.get('recovered') or [])
+        if saved.get('state') in (OPEN, HALF_OPEN):
+            self.state = OPEN
+            self.failures = self.threshold
+            self.retry_at = self.clock() + max(0.0, min(retry_in, self.cap * (1 + self.jitter)))
+
+    def snapshot(self):
+        # for the State, plain values only
+        return {'state': self.state,
+                'failures': self.failures,
+                'opens': self.opens,
+                'recovered': list(self.recovered),
+                'retry_in': round(max(0.0, self.retry_at - self.clock()), 1) if self.state == OPEN else None}
@@ -0,0 +1,184 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - remote commands
+
+    A table of the commands the station takes, each with a parser that validates its value & a handler
+    that applies it. Commands come in from the PW server's upload response or from a local HTTP control
+    endpoint; either way they are validated when they arrive (so a bad one is rejected with a reason) and
+    queued, then applied on the main thread on the next tick, in table order, so the State is saved once.
+
+        POST /command   {"DisplayOn": "Yes", "WUServerUploadInterval": 30}    (JSON or form encoded)
+        GET  /command   the command names & anything still queued
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import collections
+import json
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import parse_qs
+
+from api import ThreadingHTTPServer
+
+
+# ============================================================================
+# value parsers - return the parsed value or raise ValueError
+# ============================================================================
+def flag(value):
+    # presence is the command, the value is ignored
+    return True
+
+
+def choice(*options):
+    # one of options, case insensitive, returned as spelled in options
+    def parse(value):
+        for option in options:
+            if str(value).lower() == option.lower(): return option
+        raise ValueError("expected one of " + "/".join(options))
+    return parse
+
+
+def int_range(low, high):
+    def parse(value):
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise ValueError("expected a whole number")
+        if not low <= number <= high:
+            raise ValueError("expected %d to %d" % (low, high))
+        return number
+    return parse
+
+
+class CommandProcessor(object):
+
+    def __init__(self):
+        self._table = collections.OrderedDict()    # name -> (parse, handler)
+        self._pending = collections.deque()        # (source, {name: value})
+        self._lock = threading.Lock()
+        self.applied = 0
+        self.rejected = 0
+        self.last = None                            # (source, {name: value}) last applied
+
+    def register(self, name, parse, handler):
+        self._table[name] = (parse, handler)
+
+    def names(self):
+        return list(self._table)
+
+    def validate(self, commands):
+        # ({name: value} accepted, {name: reason} rejected); keys that aren't commands are rejected too
+        accepted = {}
+        rejected = {}
+        for name, value in commands.items():
+            if name not in self._table:
+                rejected[name] = 'unknown command'
+                continue
+            try:
+                accepted[name] = self._table[name][0](value)
+            except ValueError as e:
+                rejected[name] = str(e)
+        return accepted, rejected
+
+    def submit(self, commands, source):
+        # from any thread, the accepted commands are applied by the next apply()
+        accepted, rejected = self.validate(commands)
+        with self._lock:
+            self.rejected += len(rejected)
+            if accepted: self._pending.append((source, accepted))
+        return accepted, rejected
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending)
+
+    def apply(self):
+        # on the main thread, returns the number of commands applied
+        count = 0
+        while True:
+            with self._lock:
+                if not self._pending: break
+                source, commands = self._pending.popleft()
+            for name, (parse, handler) in self._table.items():
+                if name in commands:
+                    handler(commands[name])
+                    count += 1
+            self.last = (source, commands)
+        self.applied += count
+        return count
+
+    def stats(self):
+        return {'applied': self.applied,
+                'rejected': self.rejected,
+                'pending': len(self._pending)}
+
+
+# ============================================================================
+# local control endpoint
+# ============================================================================
+class ControlHandler(BaseHTTPRequestHandler):
+    server_version = 'WeatherPi/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, doc):
+        body = json.dumps(doc, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def allowed(self):
+        if self.path.split('?')[0].strip('/') != 'command':
+            self.send_error(404)
+            return False
+        token = self.server.token
+        if token is not None and self.headers.get('X-Token') != token:
+            self.send_error(403)
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.allowed(): return
+        commands = self.server.commands
+        self.reply(200, {'commands': commands.names(), 'pending': [c for s, c in commands.pending()]})
+
+    def do_POST(self):
+        if not self.allowed(): return
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+        try:
+            # a JSON object whatever the Content-Type says (curl -d sends one as a form)
+            if 'json' in (self.headers.get('Content-Type') or 'json') or body.lstrip().startswith('{'):
+                commands = json.loads(body)
+            else:
+                commands = dict((k, v[0]) for k, v in parse_qs(body).items())
+            if not isinstance(commands, dict): raise ValueError
+        except ValueError:
+            return self.reply(400, {'error': 'expected a JSON object or form of commands'})
+        accepted, rejected = self.server.commands.submit(commands, 'http')
+        self.reply(202 if accepted else 400, {'accepted': accepted, 'rejected': rejected})
+
+
+class ControlServer(object):
+
+    def __init__(self, commands, bind='127.0.0.1', port=8081, token=None):
+        self.server = ThreadingHTTPServer((bind, port), ControlHandler)
+        self.server.commands = commands
+        self.server.token = token
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='Control')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
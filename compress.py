@@ -0,0 +1,208 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - series compression
+
+    Most 5 second readings are the same as the last one at the 0.1 the channels are rounded to, so between
+    the sensors & the raw history (or a sink) each channel keeps a point only when it carries information:
+
+        deadband    kept when the value moves more than error from the last kept value, read back as a step
+        door        swinging door, kept when no straight line from the last kept point stays within error
+                    of every sample since, read back by linear interpolation
+
+    The door keeps the end of each line on the line (not the raw sample, which is within error of it), so
+    decompress() reads every sample back within error. No two kept points are more than max_interval
+    seconds apart while samples keep coming - the previous sample is kept as a heartbeat - so points further
+    apart than that are a gap in the readings, not a steady value. Compressors hold their last sample back
+    until they know whether it is needed, flush() hands it over (on shutdown).
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import bisect
+
+INF = float('inf')
+DIGITS = 4                      # a door's points are rounded to, its error is narrowed to allow for it
+
+
+class Compressor(object):
+    # the heartbeat & gap handling, the subclass decides which samples are kept.
+    # add() & flush() return the points kept, [(ts, x)], oldest first
+    __slots__ = ('error', 'max_interval', 'kept_ts', 'last', 'pending', 'seen', 'kept')
+
+    def __init__(self, error=0.0, max_interval=None):
+        self.error = error
+        self.max_interval = max_interval
+        self.kept_ts = None             # time of the last kept point
+        self.last = None                # the last sample, (ts, x)
+        self.pending = False            # the last sample isn't kept (yet)
+        self.seen = 0
+        self.kept = 0
+
+    def add(self, ts, x):
+        out = []
+        if self.last is not None and ts <= self.last[0]:
+            return out                  # one sample per time, as the store keeps them
+        self.seen += 1
+        if self.last is None:
+            self._restart(ts, x, out)
+        elif self.max_interval is not None and ts - self.last[0] > self.max_interval:
+            # a gap in the samples, the points either side are further apart than max_interval
+            self._close(out)
+            self._restart(ts, x, out)
+        else:
+            if self.max_interval is not None and ts - self.kept_ts > self.max_interval:
+                self._close(out)        # heartbeat
+            self._next(ts, x, out)
+        self.last = (ts, x)
+        return out
+
+    def flush(self):
+        out = []
+        self._close(out)
+        return out
+
+    def _keep(self, ts, x, out):
+        out.append((ts, x))
+        self.kept_ts = ts
+        self.kept += 1
+
+    def _restart(self, ts, x, out):
+        self._keep(ts, x, out)
+        self.pending = False
+
+    def _next(self, ts, x, out):
+        raise NotImplementedError
+
+    def _close(self, out):
+        raise NotImplementedError
+
+
+class Passthrough(Compressor):
+    __slots__ = ()
+
+    def _next(self, ts, x, out):
+        self._keep(ts, x, out)
+
+    def _close(self, out):
+        pass
+
+
+class Deadband(Compressor):
+    __slots__ = ('value',)
+
+    def _restart(self, ts, x, out):
+        Compressor._restart(self, ts, x, out)
+        self.value = x
+
+    def _next(self, ts, x, out):
+        if abs(x - self.value) > self.error:
+            self._restart(ts, x, out)
+        else:
+            self.pending = True
+
+    def _close(self, out):
+        if self.pending:
+            self._restart(self.last[0], self.last[1], out)
+
+
+class SwingingDoor(Compressor):
+    # the door is kept as the range of slopes, from the last kept point, that pass within error of every
+    # sample since - it only ever narrows, a sample that would close it ends the line at the one before
+    __slots__ = ('anchor', 'low', 'high', 'width')
+
+    def __init__(self, error=0.0, max_interval=None):
+        Compressor.__init__(self, error, max_interval)
+        self.width = max(0.0, error - 0.5 * 10 ** -DIGITS)
+
+    def _restart(self, ts, x, out):
+        Compressor._restart(self, ts, x, out)
+        self.anchor = (ts, x)
+        self.low = -INF
+        self.high = INF
+
+    def _next(self, ts, x, out):
+        dt = float(ts - self.anchor[0])
+        low = max(self.low, (x - self.width - self.anchor[1]) / dt)
+        high = min(self.high, (x + self.width - self.anchor[1]) / dt)
+        if low > high:
+            self._close(out)
+            dt = float(ts - self.anchor[0])
+            low = (x - self.width - self.anchor[1]) / dt
+            high = (x + self.width - self.anchor[1]) / dt
+        self.low = low
+        self.high = high
+        self.pending = True
+
+    def _close(self, out):
+        if not self.pending: return
+        ts = self.last[0]
+        self._restart(ts, round(self.anchor[1] + (self.low + self.high) / 2 * (ts - self.anchor[0]), DIGITS), out)
+
+
+KINDS = {None: Passthrough, 'deadband': Deadband, 'door': SwingingDoor}
+
+
+def make_compressor(name, spec=None):
+    # spec: {'kind': 'deadband'|'door'|None, 'error': units, 'max_interval': seconds}
+    spec = spec or {}
+    kind = spec.get('kind')
+    if kind not in KINDS:
+        raise ValueError("Unknown compression kind '%s' for channel '%s'" % (kind, name))
+    return KINDS[kind](spec.get('error', 0.0), spec.get('max_interval'))
+
+
+class Compression(object):
+    # one independent Compressor per metric, built on first use from the per metric specs
+    # ('default' for the metrics without their own)
+
+    def __init__(self, specs=None):
+        self.specs = specs or {}
+        self.compressors = {}
+
+    def compressor(self, name):
+        compressor = self.compressors.get(name)
+        if compressor is None:
+            compressor = self.compressors[name] = make_compressor(name, self.specs.get(name, self.specs.get('default')))
+        return compressor
+
+    def add(self, ts, values):
+        # values: {metric: number} sampled at ts, returns the points kept as [(metric, ts, x)]
+        rows = []
+        for metric, x in values.items():
+            rows.extend((metric, point[0], point[1]) for point in self.compressor(metric).add(ts, x))
+        return rows
+
+    def flush(self):
+        rows = []
+        for metric, compressor in self.compressors.items():
+            rows.extend((metric, point[0], point[1]) for point in compressor.flush())
+        return rows
+
+    def ratio(self):
+        # samples seen per point kept
+        kept = sum(compressor.kept for compressor in self.compressors.values())
+        return round(sum(compressor.seen for compressor in self.compressors.values()) / float(kept), 2) if kept else 1.0
+
+    def stats(self):
+        return dict((metric, {'seen': compressor.seen, 'kept': compressor.kept})
+                    for metric, compressor in self.compressors.items())
+
+
+def decompress(points, stamps, kind='door', max_interval=None):
+    # the values at stamps read back from the kept points [(ts, x)], None in a gap or outside the points
+    times = [point[0] for point in points]
+    values = []
+    for ts in stamps:
+        i = bisect.bisect_right(times, ts) - 1
+        if i < 0:
+            values.append(None)
+        elif times[i] == ts:
+            values.append(points[i][1])
+        elif i + 1 == len(points) or (max_interval is not None and times[i + 1] - times[i] > max_interval):
+            values.append(None)
+        elif kind == 'door':
+            t0, x0 = points[i]
+            t1, x1 = points[i + 1]
+            values.append(x0 + (x1 - x0) * (ts - t0) / float(t1 - t0))
+        else:
+            values.append(points[i][1])
+    return values
@@ -6,41 +6,115 @@ class Config:
     # local station info
     LOCAL_STATION_ID = "6100245999979349"
     LOCAL_STATION_TIMEZONE = "America/Eastern"
+    ALTITUDE = 0                # metres above sea level, for the sea level pressure
 
     # logging config
     LOGGING_DEBUG = False       # log on debug -->  if both set to false min
     LOGGING_INFO = True         # log on info  -->  level is warning
-    LOGGING_BYTES = 10240       # bytes in log file before archive
+    LOGGING_BYTES = 1048576     # bytes in log file before archive
     LOGGING_ROTATION = 5        # number of log files to archive
     LOGGING_PRINT = False       # set to true to print to console
+    LOGGING_FLUSH_INTERVAL = 60 # seconds between batched log writes, errors are written straight away
+    LOGGING_REPEAT_WINDOW = 600 # seconds an identical message is counted rather than written again
+    LOGGING_RATE = 60           # log records written a minute at most
+    LOGGING_RING = 200          # records below the log level kept in memory & written when an error occurs
 
-    FAILURE_CSV = True          # capture data in CSV in upload fails
-    FAILURE_DIR = 'failurelogs' # where failure logs are stored
-    FAILURE_REBOOT = True       # attempt reboot if upload failures excede maximum (below)
-    FAILURE_MAX = 18            # maximum upload failures before reboot
+    # start up - load the 1-Wire modules in parallel (skipping loaded ones), scroll the splash in the
+    # background & take the first sample straight away rather than on the next 5 second slot
+    FAST_START = True
+
+    FAILURE_REBOOT = True       # allow the last recovery step (BREAKER_RECOVERY below), a reboot
+
+    # supervisor (supervisor.py) - runs this app as its worker & restarts just the worker when its loop stops
+    # sending a heartbeat or it crashes, in place of a nightly reboot
+    HEARTBEAT_INTERVAL = 5      # seconds between the loop's heartbeats
+    HEARTBEAT_TIMEOUT = 30      # seconds without one before the worker is restarted
+    HEARTBEAT_STARTUP = 180     # seconds allowed for the first one, the start up
+    SUPERVISOR_GRACE = 20       # seconds for a worker to stop (& say GoodBye) before it is killed
+    SUPERVISOR_BACKOFF = 2      # seconds before a restart, doubling with each crash in a row
+    SUPERVISOR_BACKOFF_MAX = 300
+    SUPERVISOR_STABLE = 600     # seconds a worker must run before its crashes stop counting as in a row
+    SUPERVISOR_LOG = 'supervisor.log'           # relative to the app directory
+    SUPERVISOR_METRICS_PATH = 'supervisor.prom'  # restarts by reason, rewritten every METRICS_INTERVAL
 
     # daytime
     SUNRISE = 5
     SUNSET = 19
 
-    # temperature probes
+    # temperature probes - 28-* devices are found on the bus, None uses the 1st/2nd probe found
     PROBE_1 = '28-0417a2d9f9ff'  # probe 1 - air
     PROBE_2 = '28-0417a2ec2aff'  # probe 2 - coldframe
 
-    TEMP_SENSOR_1 = '/sys/bus/w1/devices/'+PROBE_1+'/w1_slave'
-    TEMP_SENSOR_2 = '/sys/bus/w1/devices/'+PROBE_2+'/w1_slave'
+    W1_DEVICES = '/sys/bus/w1/devices'
+    PROBE_INTERVAL = 5           # seconds between probe refreshes
+    PROBE_MAX_AGE = 15           # seconds before a cached probe reading is treated as missing
 
     USE_PROBE_1 = True
     USE_PROBE_2 = True
     USE_SENSEHAT_TEMPERATURE = True
+    CPU_TEMP_MAX_AGE = 5         # seconds a CPU temperature reading is reused for the SenseHat correction
+    SENSEHAT_OVERSAMPLE = 1      # SenseHat reads averaged per sample, spread evenly across the 5 second slot
+
+    # sensor channels - each is read on its own interval, filtered, summarised & uploaded as 'field' (with
+    # its probe id as 'id_field'). The first channel is the station's air temperature (display, dew point & WU).
+    #   source      'probe' (a 1-Wire DS18B20) or 'sensehat' (the SenseHat temperature corrected for the CPU)
+    #   probe       1-Wire id, None uses the index'th probe found on the bus
+    #   interval    seconds between readings, a multiple of 5 (the probes refresh every PROBE_INTERVAL)
+    #   filter      see FILTERS below
+    #   fallback    'sensehat' to read the SenseHat while the probe is missing, None for no reading
+    #   expected    State key (or True) - a missing probe reads 0 with its notice lit rather than -99/NotSet
+    #   notice      NOTICE lit while the probe is missing
+    #   display_units  upload in the display units (DISPLAY_SI) rather than Celsius
+    SENSORS = [
+        {'name': 'air', 'source': 'probe', 'probe': PROBE_1, 'index': 0, 'interval': 5,
+         'filter': {'kind': None, 'reject': [85.0], 'max_step': 5.0, 'max_rejects': 3},
+         'fallback': 'sensehat' if USE_SENSEHAT_TEMPERATURE else None, 'notice': 'Air',
+         'field': 't', 'id_field': 'pid', 'display_units': True},
+        {'name': 'coldframe', 'source': 'probe', 'probe': PROBE_2, 'index': 1, 'interval': 5,
+         'filter': {'kind': None, 'reject': [85.0], 'max_step': 5.0, 'max_rejects': 3},
+         'expected': 'ColdFrameOn', 'notice': 'ColdFrame',
+         'field': 'cf', 'id_field': 'cid'},
+        # {'name': 'greenhouse', 'source': 'probe', 'probe': '28-...', 'interval': 30,
+        #  'filter': {'kind': 'ema', 'alpha': 0.3, 'reject': [85.0]}, 'field': 'gh', 'id_field': 'gid'},
+        # {'name': 'soil', 'source': 'probe', 'probe': '28-...', 'interval': 300,
+        #  'filter': {'kind': 'median', 'window': 3, 'reject': [85.0]}, 'field': 'sl', 'id_field': 'sid'},
+        # {'name': 'water', 'source': 'probe', 'probe': '28-...', 'interval': 60,
+        #  'filter': {'kind': 'average', 'window': 5, 'reject': [85.0]}, 'field': 'wt', 'id_field': 'wid'},
+    ]
+
+    # filters, per sensor (above) & for the SenseHat fallback
+    #   kind        'average' (moving average over window), 'ema' (alpha), 'median' (over window) or None
+    #   reject      values that are never real readings, 85.0 is the DS18B20 power on value
+    #   max_step    largest believable change between readings, bigger steps are dropped as spikes
+    #   max_rejects consecutive spikes accepted as a real change of level
+    FILTERS = {
+        'sensehat':  {'kind': 'average', 'window': 3},
+    }
 
     MEASUREMENT_INTERVAL = 1  # minutes
 
+    # derived metrics worked out each sample & uploaded (see derived.py) - dp dew point, fp frost point,
+    # hi heat index, hx humidex, ah absolute humidity, slp sea level pressure
+    DERIVED = ['dp', 'fp', 'hi', 'hx', 'ah', 'slp']
+
+    # pressure tendency
+    TENDENCY_WINDOWS = (1, 3)    # hours, regression windows - the longest gives the WMO 3 hour tendency
+    TENDENCY_STEADY = 0.1        # hPa/h, slopes smaller than this count as steady
+
     # 8x8 LED display
     DISPLAY_INTERVAL = 1    # minutes
     DISPLAY_ON = True       # True is On
     DISPLAY_DIM = False     # True is Dim
     DISPLAY_SI = True       # display temperature in metric if true, imperial if false
+    DISPLAY_MODE = 'Number' # 'Number' (the temperature), or the history of the 'Temperature' or 'Pressure'
+
+    # history display modes (DisplayMode command) - the last SPARKLINE_HOURS drawn as 8 columns, each lit from the
+    # period's min to its max on a scale from the lowest to the highest, kept in memory in SPARKLINE_SLOT second slots
+    SPARKLINE_HOURS = 8
+    SPARKLINE_SLOT = 300            # seconds
+    SPARKLINE_MIN_RANGE = 2.0       # degrees or hPa, the least drawn full height so the noise isn't magnified
+    SPARKLINE_PATH = 'recent.bin'   # binary snapshot of the history, relative to the app directory
+    SPARKLINE_SAVE_INTERVAL = 600   # seconds between snapshots, also written on exit
 
     # call back settings   **** currently unused **** currently unused ****
     CAPTURE_SI = True   # capture local data as metric if true, imperial if false
@@ -55,3 +129,94 @@ class Config:
     WU_UPLOAD = False
     WU_UPLOAD_INTERVAL = 15  # minutes
     WU_URL = "http://weatherstation.wunderground.com/weatherstation/updateweatherstation.php"
+
+    # upload workers
+    UPLOAD_QUEUE_SIZE = 10          # pending uploads per destination before the oldest is dropped
+    UPLOAD_CONNECT_TIMEOUT = 5      # seconds
+    UPLOAD_READ_TIMEOUT = 10        # seconds
+
+    # circuit breaker per destination (see breaker.py) - uploads stop after BREAKER_THRESHOLD failures in a row,
+    # then the destination is probed after BREAKER_BACKOFF seconds, doubling each time it fails again
+    BREAKER_THRESHOLD = 3           # failures in a row
+    BREAKER_BACKOFF = 30            # seconds, first wait before a probe
+    BREAKER_BACKOFF_MAX = 900       # seconds
+    BREAKER_JITTER = 0.2            # +/- fraction of the wait
+    # local recovery as the PW breaker opens again & again - {openings in a row: step}, each step once an
+    # outage (until an upload is delivered, over restarts too) & every opening also reconnects (& re-resolves)
+    # the destination. 'network' runs NETWORK_RESTART, 'reboot' needs FAILURE_REBOOT & the Pi's own network
+    # to be down - the gateway not answering a connect to NETWORK_CHECK_PORT - not just the PW server
+    BREAKER_RECOVERY = {3: 'network', 10: 'reboot'}
+    NETWORK_RESTART = 'sudo systemctl restart dhcpcd'   # None to skip
+    NETWORK_CHECK_PORT = 53         # TCP port on the gateway, accepted or refused the network is up
+
+    # other destinations, each on its own worker (see sinks.py) so a slow or failing one never holds up another
+    #   kind        'mqtt' (url mqtt://[user:password@]host[:port], topic), 'influx' (url of /write?db=...,
+    #               measurement) or 'file' (path, relative to the app directory)
+    #   interval    seconds between readings sent
+    #   batch       readings sent together, the sink waits for a full batch
+    #   timeout     seconds, retries & retry_wait (seconds, doubling) for a failed batch, queue before dropping
+    #   compress    only the values COMPRESSION keeps are sent, a record per time with the tags (station & ids)
+    SINKS = [
+        {'name': 'mqtt', 'kind': 'mqtt', 'enabled': False, 'url': 'mqtt://127.0.0.1:1883', 'topic': 'weatherpi/reading',
+         'interval': 60, 'batch': 1, 'timeout': 5, 'retries': 2, 'retry_wait': 5, 'queue': 100, 'compress': True},
+        {'name': 'influx', 'kind': 'influx', 'enabled': False, 'url': 'http://127.0.0.1:8086/write?db=weather',
+         'interval': 60, 'batch': 10, 'timeout': 10, 'retries': 2, 'retry_wait': 10, 'queue': 100, 'compress': True},
+        {'name': 'file', 'kind': 'file', 'enabled': False, 'path': 'readings.jsonl',
+         'interval': 60, 'batch': 15, 'queue': 100},
+    ]
+
+    # outbox - store & forward of readings the PW server didn't get
+    OUTBOX = True                   # keep undelivered readings & replay them
+    OUTBOX_PATH = 'outbox.db'       # SQLite file, relative to the app directory
+    # batching needs an endpoint on the PW server taking a POSTed 'data' JSON list, the stock server has none so
+    # by default the backlog is replayed one reading per request, REPLAY_RATE a second (a day's backlog ~12 min)
+    PW_BATCH_URL = None             # that endpoint, None replays one reading per request
+    REPLAY_BATCH_SIZE = 100         # readings per batch
+    REPLAY_RATE = 2                 # replay requests per second
+    REPLAY_MAX_ATTEMPTS = 5         # times the server may refuse a reading before it's moved aside (outbox.db, rejected)
+
+    # local history
+    TSDB = True                     # keep samples & rollups on the Pi
+    TSDB_PATH = 'history.db'        # SQLite file, relative to the app directory
+    TSDB_FLUSH_INTERVAL = 60        # seconds of samples buffered per SD card write
+    TSDB_RETENTION = {0: 2*86400,       # raw 5 second samples, seconds kept
+                      60: 30*86400,     # 1 minute rollups
+                      900: 365*86400,   # 15 minute rollups
+                      3600: 730*86400}  # hourly rollups
+    TSDB_COMPRESS = True            # keep only the raw samples COMPRESSION needs, the rollups see every sample
+
+    # compression - per metric (the sensor fields, rh, p & DERIVED), 'default' for the rest, used by the raw
+    # history & the SINKS with 'compress' set
+    #   kind         'deadband' - kept when it moves more than error from the last kept value, read back as a step
+    #                'door' - swinging door, kept when no straight line from the last kept point stays within
+    #                error of every sample since, read back as straight lines
+    #                None keeps every sample
+    #   error        most a value read back is off by, in the metric's units
+    #   max_interval seconds between kept points at most, further apart is a gap in the readings
+    COMPRESSION = {
+        'default': {'kind': 'door', 'error': 0.1, 'max_interval': 900},
+        'rh':      {'kind': 'door', 'error': 0.5, 'max_interval': 900},
+        'p':       {'kind': 'door', 'error': 0.05, 'max_interval': 900},
+    }
+
+    # local read only HTTP API - /current, /state, /history
+    API = True
+    API_BIND = ''                   # all interfaces
+    API_PORT = 8080
+
+    # local control endpoint - POST /command {"DisplayOn": "Yes"}, the same commands the PW server sends
+    CONTROL = True
+    CONTROL_BIND = '127.0.0.1'      # this Pi only
+    CONTROL_PORT = 8081
+    CONTROL_TOKEN = None            # required in an X-Token header when set
+
+    # metrics - stage timings & counters in Prometheus text format, also served at /metrics
+    METRICS = True
+    METRICS_PATH = 'weather_pi.prom'  # rewritten every METRICS_INTERVAL, relative to the app directory
+    METRICS_INTERVAL = 60           # seconds
+
+    # saved station state, relative to the working directory
+    STATE_PATH = 'State.pkl'
+
+    # record the raw sensor values each sample as JSON lines for replay.py, None records nothing
+    TRACE_PATH = None
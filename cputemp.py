@@ -0,0 +1,90 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - CPU temperature
+
+    Reads the SoC temperature from /sys/class/thermal through a file descriptor held open for the life of
+    the app, re-read with pread at offset 0, so a reading costs one system call instead of forking a shell
+    and vcgencmd. vcgencmd is only used when there is no thermal zone. Readings are cached for max_age
+    seconds.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import glob
+import os
+import subprocess
+
+from scheduler import monotonic
+
+THERMAL_ZONES = '/sys/class/thermal/thermal_zone*'
+
+
+def _pread(fd, size, offset):
+    # os.pread is python 3 only
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def find_zone(pattern=THERMAL_ZONES):
+    # the cpu zone's temp file, or the first zone when none is labelled as the cpu
+    zones = sorted(glob.glob(pattern))
+    for zone in zones:
+        try:
+            with open(os.path.join(zone, 'type')) as f:
+                if 'cpu' in f.read().lower():
+                    return os.path.join(zone, 'temp')
+        except (IOError, OSError):
+            pass
+    for zone in zones:
+        if os.path.exists(os.path.join(zone, 'temp')):
+            return os.path.join(zone, 'temp')
+    return None
+
+
+def read_vcgencmd():
+    # 'borrowed' from https://www.raspberrypi.org/forums/viewtopic.php?f=104&t=111457
+    res = subprocess.check_output(['vcgencmd', 'measure_temp']).decode()
+    return float(res.replace("temp=", "").replace("'C\n", ""))
+
+
+class CpuTemp(object):
+
+    def __init__(self, max_age=5.0, path=None, clock=monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self.path = path or find_zone()
+        self.fd = None
+        self.source = 'vcgencmd'
+        if self.path is not None:
+            try:
+                self.fd = os.open(self.path, os.O_RDONLY)
+                self.source = 'sysfs'
+            except OSError:
+                self.fd = None
+        self.reads = 0
+        self._value = None
+        self._time = None
+
+    def read_sysfs(self):
+        # millidegrees C
+        return int(_pread(self.fd, 16, 0)) / 1000.0
+
+    def read(self):
+        # uncached reading
+        self.reads += 1
+        if self.fd is not None:
+            return self.read_sysfs()
+        return read_vcgencmd()
+
+    def get(self):
+        now = self.clock()
+        if self._time is None or now - self._time > self.max_age:
+            self._value = self.read()
+            self._time = now
+        return self._value
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
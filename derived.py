@@ -0,0 +1,261 @@
+#!/usr/bin/python
+'''*****************************************************************************************************************
+    Pi Weather Station - derived metrics
+
+    Quantities worked out from the air temperature (C), relative humidity (%) & station pressure (hPa):
+
+        dp      dew point, C (Magnus over water)
+        fp      frost point, C (Magnus over ice)
+        hi      heat index, C (NWS: Steadman below 80F, the Rothfusz regression & its adjustments above)
+        hx      humidex
+        ah      absolute humidity, g/m3
+        slp     sea level pressure, hPa (reduced from the station's altitude in metres)
+
+    derive() is the scalar path for the live tick, a metric outside its formula's domain (humidity not in
+    0-100%, temperatures below absolute zero or the Magnus pole) is None rather than an exception.
+    derive_batch() does the same over whole series, vectorized with numpy when it is installed & a plain
+    loop otherwise, with NaN for the out of domain values. backfill() uses it to recompute the derived
+    metrics of the stored history after a formula or calibration change, the rollups' min/max/sd from the
+    raw samples while they are kept (TSDB_RETENTION):
+
+        python derived.py [--days 90] [--resolution 3600]
+********************************************************************************************************************'''
+
+from __future__ import division, print_function
+
+import math
+import sys
+
+from aggregate import RunningStats
+from compress import Compression, decompress
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Magnus coefficients over water (as the dew point always used) & over ice
+A1 = 17.625
+B1 = 243.04
+A_ICE = 22.46
+B_ICE = 272.62
+E0 = 6.1094             # hPa, saturation vapour pressure at 0C for A1/B1
+KELVIN = 273.15
+LAPSE = 0.0065          # K/m, standard atmosphere
+
+DERIVED = ('dp', 'fp', 'hi', 'hx', 'ah', 'slp')
+
+NAN = float('nan')
+
+
+# ============================================================================
+# scalar path - one sample, None outside the domain
+# ============================================================================
+def _heat_index_f(tf, rh):
+    # NWS heat index, Fahrenheit
+    hi = 0.5 * (tf + 61.0 + (tf - 68.0) * 1.2 + rh * 0.094)
+    if (hi + tf) / 2 < 80:
+        return hi
+    hi = (-42.379 + 2.04901523 * tf + 10.14333127 * rh - 0.22475541 * tf * rh - 0.00683783 * tf * tf
+          - 0.05481717 * rh * rh + 0.00122874 * tf * tf * rh + 0.00085282 * tf * rh * rh - 0.00000199 * tf * tf * rh * rh)
+    if rh < 13 and 80 <= tf <= 112:
+        hi -= ((13 - rh) / 4) * math.sqrt((17 - abs(tf - 95)) / 17)
+    elif rh > 85 and 80 <= tf <= 87:
+        hi += ((rh - 85) / 10) * ((87 - tf) / 5)
+    return hi
+
+
+def derive(t, rh, p=None, altitude=0.0):
+    # {metric: value} for one sample, t in C, rh in %, p in hPa (None skips the sea level pressure)
+    derived = dict((name, None) for name in DERIVED)
+    if t is None or t <= -B1:
+        return derived
+    if p is not None and p > 0:
+        derived['slp'] = p * (1 - LAPSE * altitude / (t + LAPSE * altitude + KELVIN)) ** -5.257
+    if rh is None or not 0 < rh <= 100:
+        return derived
+    gamma = math.log(rh / 100.0) + A1 * t / (B1 + t)
+    dp = B1 * gamma / (A1 - gamma)
+    e = E0 * math.exp(gamma)                # actual vapour pressure, hPa
+    derived['dp'] = dp
+    derived['fp'] = B_ICE * gamma / (A_ICE - gamma)
+    derived['hi'] = (_heat_index_f(t * 1.8 + 32, rh) - 32) / 1.8
+    derived['hx'] = t + 0.5555 * (6.11 * math.exp(5417.7530 * (1 / 273.16 - 1 / (dp + KELVIN))) - 10)
+    derived['ah'] = 216.74 * e / (t + KELVIN)
+    return derived
+
+
+# ============================================================================
+# batch path - whole series, NaN outside the domain
+# ============================================================================
+def derive_batch(t, rh, p=None, altitude=0.0):
+    # {metric: series} for equal length series of t, rh (& p), numpy arrays when numpy is installed
+    if numpy is None:
+        return _derive_loop(t, rh, p, altitude)
+    t = numpy.asarray(t, dtype=float)
+    rh = numpy.asarray(rh, dtype=float)
+    with numpy.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        t = numpy.where(t > -B1, t, numpy.nan)
+        derived = {'slp': numpy.full(t.shape, numpy.nan)}
+        if p is not None:
+            p = numpy.asarray(p, dtype=float)
+            p = numpy.where(p > 0, p, numpy.nan)
+            derived['slp'] = p * (1 - LAPSE * altitude / (t + LAPSE * altitude + KELVIN)) ** -5.257
+        rh = numpy.where((rh > 0) & (rh <= 100), rh, numpy.nan)
+        gamma = numpy.log(rh / 100.0) + A1 * t / (B1 + t)
+        dp = B1 * gamma / (A1 - gamma)
+        derived['dp'] = dp
+        derived['fp'] = B_ICE * gamma / (A_ICE - gamma)
+        derived['hx'] = t + 0.5555 * (6.11 * numpy.exp(5417.7530 * (1 / 273.16 - 1 / (dp + KELVIN))) - 10)
+        derived['ah'] = 216.74 * E0 * numpy.exp(gamma) / (t + KELVIN)
+        tf = t * 1.8 + 32
+        simple = 0.5 * (tf + 61.0 + (tf - 68.0) * 1.2 + rh * 0.094)
+        full = (-42.379 + 2.04901523 * tf + 10.14333127 * rh - 0.22475541 * tf * rh - 0.00683783 * tf * tf
+                - 0.05481717 * rh * rh + 0.00122874 * tf * tf * rh + 0.00085282 * tf * rh * rh - 0.00000199 * tf * tf * rh * rh)
+        full = numpy.where((rh < 13) & (tf >= 80) & (tf <= 112),
+                           full - ((13 - rh) / 4) * numpy.sqrt(numpy.abs(17 - numpy.abs(tf - 95)) / 17), full)
+        full = numpy.where((rh > 85) & (tf >= 80) & (tf <= 87), full + ((rh - 85) / 10) * ((87 - tf) / 5), full)
+        hi = numpy.where((simple + tf) / 2 < 80, simple, full)
+        derived['hi'] = numpy.where(numpy.isnan(rh), numpy.nan, (hi - 32) / 1.8)
+    return derived
+
+
+def _derive_loop(t, rh, p, altitude):
+    # derive_batch without numpy, lists with NaN for None
+    derived = dict((name, []) for name in DERIVED)
+    if p is None: p = [None] * len(t)
+    for sample in zip(t, rh, p):
+        values = derive(sample[0], sample[1], sample[2], altitude)
+        for name in DERIVED:
+            value = values[name]
+            derived[name].append(NAN if value is None else value)
+    return derived
+
+
+# ============================================================================
+# recomputing the stored history
+# ============================================================================
+def _shared(store, metrics, start, end, compression=None):
+    # the raw samples of metrics at every time any of them has one, (times, {metric: [value or None]}).
+    # A compressed metric keeps its points at its own times, so it's read back at the others' by its kind
+    # (interpolated for a door, a step for a deadband), None in a gap
+    points = dict((metric, store.query(metric, start, end, 0)[1]) for metric in metrics)
+    stamps = sorted(set(row[0] for rows in points.values() for row in rows))
+    values = {}
+    for metric in metrics:
+        spec = (compression or {}).get(metric, (compression or {}).get('default')) or {}
+        if spec.get('kind') is None:
+            lookup = dict(points[metric])
+            values[metric] = [lookup.get(ts) for ts in stamps]
+        else:
+            values[metric] = decompress(points[metric], stamps, spec['kind'], spec.get('max_interval'))
+    return stamps, values
+
+
+def _derive_raw(store, start, end, t, fahrenheit, altitude, compression):
+    # (times, {metric: series}) of the derived metrics at the raw samples' shared times
+    stamps, series = _shared(store, (t, 'rh', 'p'), start, end, compression)
+    temps = [NAN if x is None else x for x in series[t]]
+    if fahrenheit: temps = [(x - 32) / 1.8 for x in temps]
+    return stamps, derive_batch(temps,
+                                [NAN if x is None else x for x in series['rh']],
+                                [NAN if x is None else x for x in series['p']],
+                                altitude)
+
+
+def backfill(store, start, end, resolution=3600, t='t', fahrenheit=False, altitude=0.0, names=DERIVED, compression=None):
+    # recompute names from the stored t/rh/p between start & end, returns the number of points written.
+    # compression: the specs (Config.COMPRESSION) the raw history was stored with, None when it wasn't -
+    # the recomputed raw points replace the old ones in the range & are compressed the same way.
+    # A rollup bucket still covered by raw samples gets the n/min/max/avg/sd of the metric recomputed at
+    # each of them, as the live rollup does; an older one is recomputed from its bucket averages & keeps
+    # the spread (min & max about the avg, sd) it was stored with, min = max = avg when it has none
+    if resolution == 0:
+        stamps, derived = _derive_raw(store, start, end, t, fahrenheit, altitude, compression)
+        if not stamps: return 0
+        packer = Compression(compression) if compression else None
+        rows = []
+        for i, ts in enumerate(stamps):
+            # NaN (out of the domain or a gap) is left out
+            values = dict((name, round(float(derived[name][i]), 2)) for name in names if derived[name][i] == derived[name][i])
+            if packer is None:
+                rows.extend((name, ts, x) for name, x in values.items())
+            else:
+                rows.extend(packer.add(ts, values))
+        if packer is not None: rows.extend(packer.flush())
+        store.rewrite(resolution, rows, start, end)
+        return len(rows)
+    series = {}
+    for metric in (t, 'rh', 'p'):
+        resolution, rows = store.query(metric, start, end, resolution)
+        series[metric] = dict((row[0], row) for row in rows)
+    stamps = sorted(set(series[t]) & set(series['rh']))
+    if not stamps: return 0
+    temps = [series[t][ts][4] for ts in stamps]         # (ts, n, min, max, avg, sd)
+    if fahrenheit: temps = [(x - 32) / 1.8 for x in temps]
+    derived = derive_batch(temps,
+                           [series['rh'][ts][4] for ts in stamps],
+                           [series['p'][ts][4] if ts in series['p'] else NAN for ts in stamps],
+                           altitude)
+    # the buckets from the first raw sample on, summarised from the raw samples
+    raw_stamps, raw = _derive_raw(store, start, end + resolution - 1, t, fahrenheit, altitude, compression)
+    first = raw_stamps[0] if raw_stamps else None
+    buckets = {}
+    for name in names:
+        for ts, x in zip(raw_stamps, raw[name]):
+            if x != x: continue
+            key = (name, ts - ts % resolution)
+            stats = buckets.get(key)
+            if stats is None: stats = buckets[key] = RunningStats()
+            stats.add(float(x))
+    rows = []
+    for name in names:
+        stored = dict((row[0], row) for row in store.query(name, start, end, resolution)[1])
+        for i, x in enumerate(derived[name]):
+            ts = stamps[i]
+            stats = buckets.get((name, ts))
+            if first is not None and ts >= first and stats is not None:
+                rows.append((name, ts, series[t][ts][1], round(stats.min, 2), round(stats.max, 2), round(stats.mean, 2),
+                             round(stats.sd(), 2)))
+                continue
+            if x != x: continue                     # NaN, out of the domain
+            x = round(float(x), 2)
+            old = stored.get(ts)
+            if old is not None and old[4] is not None:
+                shift = x - old[4]
+                rows.append((name, ts, series[t][ts][1], round(old[2] + shift, 2), round(old[3] + shift, 2), x, old[5]))
+            else:
+                rows.append((name, ts, series[t][ts][1], x, x, x, 0.0))
+    store.rewrite(resolution, rows)
+    return len(rows)
+
+
+def main():
+    import argparse
+    import os
+    import time
+    from config import Config
+    from tsdb import TimeSeriesStore, RAW, ROLLUPS
+
+    parser = argparse.ArgumentParser(description='Recompute the derived metrics of the stored history')
+    parser.add_argument('--days', type=float, default=365, help='days back from now (default 365)')
+    parser.add_argument('--resolution', type=int, action='append', choices=(RAW,) + ROLLUPS,
+                        help='seconds, raw (0) or a rollup (default all)')
+    args = parser.parse_args()
+
+    air = Config.SENSORS[0]
+    fahrenheit = air.get('display_units') and not Config.DISPLAY_SI
+    store = TimeSeriesStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), Config.TSDB_PATH), Config.TSDB_RETENTION)
+    end = time.time()
+    try:
+        for resolution in args.resolution or (RAW,) + ROLLUPS:
+            started = time.time()
+            written = backfill(store, end - args.days * 86400, end, resolution, air['field'], fahrenheit, Config.ALTITUDE,
+                               Config.DERIVED, Config.COMPRESSION if Config.TSDB_COMPRESS else None)
+            print("resolution %5ds: %d points in %.2fs (%s)" % (resolution, written, time.time() - started,
+                                                                'numpy' if numpy is not None else 'no numpy'))
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
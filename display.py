@@ -0,0 +1,258 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - 8x8 LED display engine
+
+    Owns an 8x8 framebuffer and runs the trend / notification animations on a background thread so the
+    sampling loop only ever posts display intents. The base picture is the current temperature or a
+    sparkline of recent history, the animations are drawn over it. Each frame is pushed with a single
+    set_pixels call.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import threading
+import time
+
+E = [0, 0, 0]       # empty
+
+FRAME_TIME = 0.15   # seconds per animation frame
+
+NOTICE_OFFSET_LEFT = 0
+NOTICE_OFFSET_TOP = 7
+
+OFFSET_LEFT = 1
+OFFSET_TOP = 1
+
+NUMS =[1,1,1,1,0,1,1,0,1,1,0,1,1,1,1,  # 0
+       0,1,0,0,1,0,0,1,0,0,1,0,0,1,0,  # 1
+       1,1,1,0,0,1,0,1,0,1,0,0,1,1,1,  # 2
+       1,1,1,0,0,1,1,1,1,0,0,1,1,1,1,  # 3
+       1,0,0,1,0,1,1,1,1,0,0,1,0,0,1,  # 4
+       1,1,1,1,0,0,1,1,1,0,0,1,1,1,1,  # 5
+       1,1,1,1,0,0,1,1,1,1,0,1,1,1,1,  # 6
+       1,1,1,0,0,1,0,1,0,1,0,0,1,0,0,  # 7
+       1,1,1,1,0,1,1,1,1,1,0,1,1,1,1,  # 8
+       1,1,1,1,0,1,1,1,1,0,0,1,0,0,1]  # 9
+
+TREND_UP = 'up'
+TREND_DOWN = 'down'
+TREND_STEADY = 'steady'
+
+# lit rows of the trend column for each frame of the pressure trend animations,
+# the last (empty) frame clears the column
+TREND_FRAMES = {
+    TREND_UP: [(7,), (6,), (5,), (4,), (3,), (2,), (1,), (0,), ()],
+    TREND_DOWN: [(0,), (1,), (2,), (3,), (4,), (5,), (6,), (7,), ()],
+    TREND_STEADY: [(0, 7), (0, 7, 1, 6), (1, 6, 2, 5), (2, 5, 3, 4), (3, 4), ()],
+}
+
+
+def render_digit(buf, val, xd, yd, rgb):
+    # draw a single digit (0-9) into a 64 pixel buffer
+    offset = val * 15
+    for p in range(offset, offset + 15):
+        xt = p % 3
+        yt = (p-offset) // 3
+        buf[(yt+yd)*8 + xt+xd] = [rgb[0]*NUMS[p], rgb[1]*NUMS[p], rgb[2]*NUMS[p]]
+
+
+def render_number(val, rgb):
+    # draw a two-digit positive number (0-99) into a fresh 64 pixel buffer
+    buf = [E] * 64
+    abs_val = abs(val)
+    tens = abs_val // 10
+    units = abs_val % 10
+    if (abs_val > 9): render_digit(buf, tens, OFFSET_LEFT, OFFSET_TOP, rgb)
+    render_digit(buf, units, OFFSET_LEFT+4, OFFSET_TOP, rgb)
+    return buf
+
+
+def render_sparkline(columns, rgb, min_range=0.0):
+    # draw up to 8 columns [(min, max) or None], oldest on the left, each lit from its min to its max on a
+    # scale from the lowest min (bottom row) to the highest max (top row), at least min_range high
+    buf = [E] * 64
+    values = [column for column in columns[-8:] if column is not None]
+    if not values: return buf
+    low = min(column[0] for column in values)
+    high = max(column[1] for column in values)
+    if high - low < min_range:
+        middle = (high + low) / 2.0
+        low, high = middle - min_range / 2.0, middle + min_range / 2.0
+    scale = 7.0 / (high - low) if high > low else 0.0
+    for x, column in enumerate(columns[-8:]):
+        if column is None: continue
+        top = 7 - int(round((column[1] - low) * scale))
+        bottom = 7 - int(round((column[0] - low) * scale))
+        for y in range(top, bottom + 1):
+            buf[y*8 + x] = rgb
+    return buf
+
+
+def trend_animation(kind, colour):
+    # yields the trend column (8 pixels, top to bottom) one frame at a time
+    for lit in TREND_FRAMES[kind]:
+        yield [colour if y in lit else E for y in range(8)]
+
+
+def notice_animation(colours):
+    # sweep each active notice colour across the notice row then sweep it clear
+    row = [E] * 8
+    for colour in list(colours) + [E]:
+        for x in range(8):
+            row = row[:x] + [colour] + row[x+1:]
+            yield row
+
+
+class LedDisplay(object):
+    # Background display engine. Intents posted from the loop are coalesced; an animation
+    # already on screen runs to completion and the latest pending intent starts after it.
+
+    def __init__(self, sense, frame_time=FRAME_TIME):
+        self.sense = sense
+        self.frame_time = frame_time
+        self.frames_pushed = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._running = False
+        self._enabled = True
+        self._low_light = None
+        self._base = [E] * 64
+        self._trend_column = [E] * 8
+        self._notice_row = [E] * 8
+        self._trend = None          # running trend animation
+        self._notice = None         # running notice animation
+        self._pending_trend = None
+        self._pending_notices = None
+        self._pending_message = None
+        self._last = None
+
+    # ------------------------------------------------------------------
+    # intents - called from the sampling loop, never block
+    # ------------------------------------------------------------------
+    def number(self, val, rgb):
+        buf = render_number(val, rgb)
+        with self._lock:
+            self._base = buf
+        self._wake.set()
+
+    def sparkline(self, columns, rgb, min_range=0.0):
+        buf = render_sparkline(columns, rgb, min_range)
+        with self._lock:
+            self._base = buf
+        self._wake.set()
+
+    def clear(self):
+        with self._lock:
+            self._base = [E] * 64
+            self._trend_column = [E] * 8
+            self._notice_row = [E] * 8
+            self._trend = self._notice = None
+            self._pending_trend = self._pending_notices = None
+        self._wake.set()
+
+    def trend(self, kind, colour):
+        with self._lock:
+            self._pending_trend = (kind, colour)
+        self._wake.set()
+
+    def notices(self, colours):
+        with self._lock:
+            self._pending_notices = list(colours)
+        self._wake.set()
+
+    def message(self, text, text_colour, back_colour):
+        # scroll text across the matrix on the engine thread, e.g. the start up splash
+        with self._lock:
+            self._pending_message = (text, text_colour, back_colour)
+        self._wake.set()
+
+    def enable(self, on):
+        with self._lock:
+            self._enabled = on
+        self._wake.set()
+
+    def low_light(self, dim):
+        with self._lock:
+            self._low_light = dim
+        self._wake.set()
+
+    # ------------------------------------------------------------------
+    # engine
+    # ------------------------------------------------------------------
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='LedDisplay')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _next_frame(self):
+        # advance the running animations by one frame and compose the framebuffer
+        with self._lock:
+            if self._trend is None and self._pending_trend is not None:
+                self._trend = trend_animation(*self._pending_trend)
+                self._pending_trend = None
+            if self._notice is None and self._pending_notices is not None:
+                self._notice = notice_animation(self._pending_notices)
+                self._pending_notices = None
+            if self._trend is not None:
+                try:
+                    self._trend_column = next(self._trend)
+                except StopIteration:
+                    self._trend = None
+            if self._notice is not None:
+                try:
+                    self._notice_row = next(self._notice)
+                except StopIteration:
+                    self._notice = None
+            animating = self._trend is not None or self._notice is not None
+            if not self._enabled:
+                frame = [E] * 64
+            else:
+                # only the lit pixels of the animations, a sparkline uses the whole matrix
+                frame = list(self._base)
+                for y in range(8):
+                    if self._trend_column[y] != E: frame[y*8 + NOTICE_OFFSET_LEFT] = self._trend_column[y]
+                for x in range(8):
+                    if self._notice_row[x] != E: frame[NOTICE_OFFSET_TOP*8 + x] = self._notice_row[x]
+            low_light = self._low_light
+            self._low_light = None
+        return frame, low_light, animating
+
+    def _show_message(self):
+        with self._lock:
+            message, self._pending_message = self._pending_message, None
+        if message is None: return
+        try:
+            self.sense.show_message(message[0], text_colour=message[1], back_colour=message[2])
+            self.sense.clear()
+        except Exception:
+            pass
+        self._last = None
+
+    def _run(self):
+        while self._running:
+            self._show_message()
+            frame, low_light, animating = self._next_frame()
+            try:
+                if low_light is not None:
+                    self.sense.low_light = low_light
+                if frame != self._last:
+                    self.sense.set_pixels(frame)
+                    self._last = frame
+                    self.frames_pushed += 1
+            except Exception:
+                # the matrix is best effort, never let it take the engine down
+                self._last = None
+            if animating:
+                # fixed frame pacing, posting an intent mid-animation must not speed it up
+                time.sleep(self.frame_time)
+            else:
+                self._wake.wait()
+                self._wake.clear()
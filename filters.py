@@ -0,0 +1,165 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - streaming filters
+
+    Per channel filter state, each channel owns its own ring buffer so one sensor can never leak into
+    another's history. Moving average and EMA update in O(1), the rolling median keeps a sorted copy of its
+    (small) window. Rejection drops the DS18B20 85.0C power on value & single sample spikes before they
+    reach the smoother. State lives in __slots__ classes over array('d') so dozens of channels stay cheap.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import bisect
+from array import array
+
+
+class MovingAverage(object):
+    __slots__ = ('window', 'ring', 'pos', 'count', 'total')
+
+    def __init__(self, window=3):
+        self.window = window
+        self.ring = array('d', [0.0] * window)
+        self.pos = 0
+        self.count = 0
+        self.total = 0.0
+
+    def update(self, x):
+        if self.count == self.window:
+            self.total -= self.ring[self.pos]
+        else:
+            self.count += 1
+        self.ring[self.pos] = x
+        self.total += x
+        self.pos = (self.pos + 1) % self.window
+        return self.total / self.count
+
+
+class Ema(object):
+    __slots__ = ('alpha', 'value')
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        if self.value is None:
+            self.value = x
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class RollingMedian(object):
+    __slots__ = ('window', 'ring', 'ordered', 'pos', 'count')
+
+    def __init__(self, window=5):
+        self.window = window
+        self.ring = array('d', [0.0] * window)
+        self.ordered = array('d')
+        self.pos = 0
+        self.count = 0
+
+    def update(self, x):
+        if self.count == self.window:
+            self.ordered.pop(bisect.bisect_left(self.ordered, self.ring[self.pos]))
+        else:
+            self.count += 1
+        self.ring[self.pos] = x
+        bisect.insort(self.ordered, x)
+        self.pos = (self.pos + 1) % self.window
+        mid = self.count // 2
+        if self.count % 2:
+            return self.ordered[mid]
+        return (self.ordered[mid - 1] + self.ordered[mid]) / 2.0
+
+
+class Passthrough(object):
+    __slots__ = ()
+
+    def update(self, x):
+        return x
+
+
+class Rejector(object):
+    # drops fixed invalid values (85.0 from a DS18B20 that has just powered up) and steps bigger than
+    # max_step from the last accepted value, unless max_rejects in a row say the level really has moved
+    __slots__ = ('invalid', 'max_step', 'max_rejects', 'last', 'run', 'rejected')
+
+    def __init__(self, invalid=(), max_step=None, max_rejects=3):
+        self.invalid = tuple(invalid)
+        self.max_step = max_step
+        self.max_rejects = max_rejects
+        self.last = None
+        self.run = 0
+        self.rejected = 0
+
+    def accept(self, x):
+        if x in self.invalid:
+            self.rejected += 1
+            return False
+        if self.max_step is not None and self.last is not None and abs(x - self.last) > self.max_step:
+            self.run += 1
+            if self.run <= self.max_rejects:
+                self.rejected += 1
+                return False
+        self.run = 0
+        self.last = x
+        return True
+
+
+class Channel(object):
+    # rejection followed by a smoother, update() returns the filtered value or the previous one when the
+    # sample is rejected (None if nothing has been accepted yet)
+    __slots__ = ('name', 'rejector', 'smoother', 'value')
+
+    def __init__(self, name, smoother, rejector=None):
+        self.name = name
+        self.smoother = smoother
+        self.rejector = rejector
+        self.value = None
+
+    def update(self, x):
+        if self.rejector is None or self.rejector.accept(x):
+            self.value = self.smoother.update(x)
+        return self.value
+
+
+def make_channel(name, spec=None):
+    # spec: {'kind': 'average'|'ema'|'median'|None, 'window': n, 'alpha': a,
+    #        'reject': [values], 'max_step': units, 'max_rejects': n}
+    spec = spec or {}
+    kind = spec.get('kind')
+    if kind == 'average':
+        smoother = MovingAverage(spec.get('window', 3))
+    elif kind == 'ema':
+        smoother = Ema(spec.get('alpha', 0.3))
+    elif kind == 'median':
+        smoother = RollingMedian(spec.get('window', 5))
+    elif kind is None:
+        smoother = Passthrough()
+    else:
+        raise ValueError("Unknown filter kind '%s' for channel '%s'" % (kind, name))
+    rejector = None
+    if spec.get('reject') or spec.get('max_step') is not None:
+        rejector = Rejector(spec.get('reject', ()), spec.get('max_step'), spec.get('max_rejects', 3))
+    return Channel(name, smoother, rejector)
+
+
+class Filters(object):
+    # one independent Channel per name, built on first use from the per channel specs
+
+    def __init__(self, specs=None):
+        self.specs = specs or {}
+        self.channels = {}
+
+    def channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = make_channel(name, self.specs.get(name))
+        return channel
+
+    def update(self, name, x):
+        return self.channel(name).update(x)
+
+    def rejected(self):
+        return dict((name, channel.rejector.rejected) for name, channel in self.channels.items() if channel.rejector)
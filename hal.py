@@ -0,0 +1,592 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - hardware abstraction
+
+    Everything the station touches outside the Python process goes through a Hardware bundle:
+
+        clock           monotonic() / time() / now() / utcnow() / sleep()
+        sense           SenseHat compatible - get_temperature_from_humidity/_from_pressure, get_humidity,
+                        get_pressure, set_pixels, clear, show_message, low_light
+        probes          ProbeReader compatible - probes, get(probe_id), start(), stop(), stats(), bulk
+        cpu             CpuTemp compatible - get(), source, path
+        uploader()      Uploader factory, connection() Connection factory, sink() factory for Config.SINKS
+        tick()          called once per sample, restart_network() / reboot() / shutdown() / close()
+        network_up()    is the Pi's own network working, as opposed to a server on it being down
+
+    PiHardware is the real thing. ReplayHardware feeds a recorded (or synthetic) trace through the same
+    interfaces on a VirtualClock, so the station's loop can run a simulated week in seconds anywhere.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import bisect
+import datetime
+import errno
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import time
+
+from scheduler import monotonic
+from uploader import Uploader, UploadResult, Connection
+from sinks import make_sink
+from probes import ProbeReader, PROBE_OK, PROBE_STALE, PROBE_POWER_ON, PROBE_ERROR
+from cputemp import CpuTemp
+
+
+# ============================================================================
+# clocks
+# ============================================================================
+class SystemClock(object):
+
+    def monotonic(self):
+        return monotonic()
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def utcnow(self):
+        return datetime.datetime.utcnow()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock(object):
+    # time only moves when somebody sleeps
+
+    def __init__(self, start):
+        self.start = float(start)       # epoch seconds
+        self.elapsed = 0.0
+
+    def monotonic(self):
+        return self.elapsed
+
+    def time(self):
+        return self.start + self.elapsed
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def utcnow(self):
+        return datetime.datetime.utcfromtimestamp(self.time())
+
+    def sleep(self, seconds):
+        if seconds > 0: self.elapsed += seconds
+
+
+# ============================================================================
+# the real Pi
+# ============================================================================
+def process_started():
+    # monotonic time the process started (both count from boot on Linux), None when unknown
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        # fields after the parenthesised command name, starttime is field 22 in clock ticks
+        ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+        return ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def load_modules(modules, parallel=True):
+    # modprobe the kernel modules not already loaded, all at once when parallel, returns those loaded
+    missing = [m for m in modules if not os.path.isdir(os.path.join('/sys/module', m.replace('-', '_')))]
+    if not parallel:
+        for module in missing: os.system('modprobe ' + module)
+        return missing
+    running = []
+    for module in missing:
+        try:
+            running.append(subprocess.Popen(['modprobe', module]))
+        except OSError:
+            pass
+    for proc in running: proc.wait()
+    return missing
+
+
+def default_gateway(path='/proc/net/route'):
+    # the IPv4 default route's gateway, None when there is no default route
+    try:
+        with open(path) as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                # destination 0.0.0.0 with the gateway flag (0x2) set
+                if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 2:
+                    return socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def gateway_answers(port=53, timeout=2.0):
+    # a TCP connect to the gateway, accepted or refused it is up - a dead server elsewhere on the LAN
+    # doesn't make the Pi's own network down
+    gateway = default_gateway()
+    if gateway is None: return False
+    try:
+        socket.create_connection((gateway, port), timeout).close()
+    except socket.timeout:
+        return False
+    except socket.error as e:
+        return e.errno == errno.ECONNREFUSED
+    return True
+
+
+class Hardware(object):
+
+    clock = None
+    started = None          # clock.monotonic() when the station started, for the startup metrics
+    sense = None
+    probes = None
+    cpu = None
+
+    def uploader(self, name, url, queue_size, connect_timeout, read_timeout):
+        return Uploader(name, url, queue_size, connect_timeout, read_timeout)
+
+    def connection(self, url, connect_timeout, read_timeout):
+        return Connection(url, connect_timeout, read_timeout)
+
+    def sink(self, spec):
+        return make_sink(spec)
+
+    def tick(self):
+        pass
+
+    def restart_network(self):
+        pass
+
+    def network_up(self):
+        return True
+
+    def reboot(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def close(self):
+        self.probes.stop()
+
+
+class PiHardware(Hardware):
+
+    def __init__(self, config):
+        self.clock = SystemClock()
+        self.started = process_started()
+        if self.started is None: self.started = self.clock.monotonic()
+        # init environment
+        self.modules = load_modules(['w1-gpio', 'w1-therm'], config.FAST_START)
+        from sense_hat import SenseHat
+        self.sense = SenseHat()
+        self.probes = ProbeReader(config.W1_DEVICES, config.PROBE_INTERVAL, config.PROBE_MAX_AGE)
+        self.cpu = CpuTemp(config.CPU_TEMP_MAX_AGE)
+        self.network_restart = getattr(config, 'NETWORK_RESTART', None)
+        self.network_check_port = getattr(config, 'NETWORK_CHECK_PORT', 53)
+        self.recorder = None
+        if getattr(config, 'TRACE_PATH', None):
+            self.recorder = TraceRecorder(config.TRACE_PATH, self.clock)
+            self.sense = self.recorder.sense(self.sense)
+            self.probes = self.recorder.probes(self.probes)
+            self.cpu = self.recorder.cpu(self.cpu)
+
+    def tick(self):
+        if self.recorder is not None: self.recorder.tick()
+
+    def restart_network(self):
+        # in the background, the loop carries on while the interface comes back
+        if self.network_restart: subprocess.Popen(self.network_restart, shell=True)
+
+    def network_up(self):
+        return gateway_answers(self.network_check_port)
+
+    def reboot(self):
+        os.system('reboot')
+
+    def shutdown(self):
+        os.system('shutdown -h now')
+
+    def close(self):
+        self.probes.stop()
+        if self.recorder is not None: self.recorder.close()
+
+
+# ============================================================================
+# traces - one JSON object per sample
+#   {"t": epoch, "th": temp from humidity, "tp": temp from pressure, "h": humidity, "p": pressure,
+#    "cpu": cpu temp, "probes": {"28-...": celcius or null}, "pw": server up, "wu": server up,
+#    "net": the Pi's own network up, true when left out}
+# ============================================================================
+class _Proxy(object):
+    # passes everything through to the wrapped object, records what the wrapped getters return
+
+    def __init__(self, target, row, getters):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_row', row)
+        object.__setattr__(self, '_getters', getters)
+
+    def __getattr__(self, name):
+        # not the target's internals, callers fall back to the getters that are recorded
+        if name.startswith('_'): raise AttributeError(name)
+        value = getattr(self._target, name)
+        if name in self._getters:
+            key = self._getters[name]
+            row = self._row
+
+            def recorded(*args):
+                result = value(*args)
+                row[key] = result
+                return result
+            return recorded
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+
+class _RecordingProbes(object):
+
+    def __init__(self, target, row):
+        self._target = target
+        self._row = row
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def get(self, probe):
+        reading = self._target.get(probe)
+        probes = self._row.setdefault('probes', {})
+        probes[probe] = reading['celcius'] if reading['status'] in (PROBE_OK, PROBE_POWER_ON) else None
+        return reading
+
+
+class TraceRecorder(object):
+    # writes the raw values the station read each tick, for replay.py
+
+    def __init__(self, path, clock):
+        self.clock = clock
+        self.row = {}
+        self.out = open(path, 'a')
+
+    def sense(self, sense):
+        return _Proxy(sense, self.row, {'get_temperature_from_humidity': 'th',
+                                         'get_temperature_from_pressure': 'tp',
+                                         'get_humidity': 'h',
+                                         'get_pressure': 'p'})
+
+    def probes(self, probes):
+        return _RecordingProbes(probes, self.row)
+
+    def cpu(self, cpu):
+        return _Proxy(cpu, self.row, {'get': 'cpu'})
+
+    def tick(self):
+        self.row['t'] = round(self.clock.time(), 3)
+        self.out.write(json.dumps(self.row, sort_keys=True) + '\n')
+        self.out.flush()
+        self.row.clear()
+
+    def close(self):
+        self.out.close()
+
+
+class Trace(object):
+
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda row: row['t'])
+        self.times = [row['t'] for row in self.rows]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    @classmethod
+    def synthetic(cls, days=7, start=None, interval=5, probes=('28-000000000001', '28-000000000002'),
+                  outages=((1.5, 6.0), (4.2, 0.5)), probe_faults=((2.0, 3.0, 0), (5.0, 0.2, 1)), network_outages=(),
+                  seed=1):
+        # a week of plausible weather: diurnal temperature & humidity, a slowly wandering pressure,
+        # server outages (start day, hours), probe faults (start day, hours, probe index) & outages of
+        # the Pi's own network (start day, hours), every server unreachable
+        rnd = random.Random(seed)
+        start = start if start is not None else time.mktime(datetime.date.today().timetuple()) - days * 86400
+        rows = []
+        pressure = 1013.0
+        n = int(days * 86400 / interval)
+        for i in range(n):
+            t = start + i * interval
+            day = (t - start) / 86400.0
+            diurnal = math.sin(2 * math.pi * (day - 0.375))
+            air = 12 + 8 * diurnal + rnd.gauss(0, 0.05)
+            pressure += rnd.gauss(0, 0.01) + 0.0005 * math.sin(2 * math.pi * day / 3.0)
+            humidity = min(100.0, max(5.0, 65 - 20 * diurnal + rnd.gauss(0, 0.5)))
+            row = {'t': t,
+                   'th': air + 9 + rnd.gauss(0, 0.1),
+                   'tp': air + 8 + rnd.gauss(0, 0.1),
+                   'h': humidity,
+                   'p': pressure,
+                   'cpu': air + 30 + rnd.gauss(0, 0.5),
+                   # the first probe in the air, the rest a few degrees warmer under glass or in the ground
+                   'probes': dict((probe, round(air + 4 * n + 2 * n * diurnal, 3)) for n, probe in enumerate(probes)),
+                   'pw': True,
+                   'wu': True}
+            for begin, hours in outages:
+                if begin <= day < begin + hours / 24.0:
+                    row['pw'] = row['wu'] = False
+            for begin, hours in network_outages:
+                if begin <= day < begin + hours / 24.0:
+                    row['pw'] = row['wu'] = row['net'] = False
+            for begin, hours, index in probe_faults:
+                if index < len(probes) and begin <= day < begin + hours / 24.0:
+                    # an unplugged probe, with the odd 85.0 power on reading as it comes & goes
+                    row['probes'][probes[index]] = 85.0 if rnd.random() < 0.05 else None
+            rows.append(row)
+        return cls(rows)
+
+    def at(self, t):
+        # the last row at or before t (the first row before the trace starts)
+        i = bisect.bisect_right(self.times, t) - 1
+        return self.rows[max(i, 0)]
+
+    def start(self):
+        return self.times[0]
+
+    def duration(self):
+        return self.times[-1] - self.times[0]
+
+
+# ============================================================================
+# fakes
+# ============================================================================
+class _FakeSensor(object):
+    # the sense_hat library's RTIMU humidity & pressure sensors, the reading & the sensor's own
+    # temperature in one read
+
+    def __init__(self, sense, key, default, temp_key):
+        self.sense = sense
+        self.key = key
+        self.default = default
+        self.temp_key = temp_key
+
+    def _read(self):
+        row = self.sense._row()
+        return (True, row.get(self.key, self.default), True, row.get(self.temp_key, 25.0))
+
+    humidityRead = _read
+    pressureRead = _read
+
+
+class FakeSense(object):
+    # SenseHat stand in, readings come from the trace at the current (virtual) time
+
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+        self.low_light = False
+        self.frames = 0
+        self.reads = 0
+        self._humidity = _FakeSensor(self, 'h', 50.0, 'th')
+        self._pressure = _FakeSensor(self, 'p', 1013.25, 'tp')
+
+    def _init_humidity(self):
+        pass
+
+    def _init_pressure(self):
+        pass
+
+    def _row(self):
+        # one I2C read, a recorded trace only holds what the station read that tick
+        self.reads += 1
+        return self.trace.at(self.clock.time())
+
+    def _value(self, key, default):
+        return self._row().get(key, default)
+
+    def get_temperature_from_humidity(self):
+        return self._value('th', 25.0)
+
+    def get_temperature_from_pressure(self):
+        return self._value('tp', 25.0)
+
+    def get_humidity(self):
+        return self._value('h', 50.0)
+
+    def get_pressure(self):
+        return self._value('p', 1013.25)
+
+    def set_pixels(self, pixels):
+        self.frames += 1
+
+    def clear(self):
+        self.frames += 1
+
+    def show_message(self, text, **kwargs):
+        pass
+
+
+class FakeProbes(object):
+
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+        self.probes = sorted(trace.rows[0].get('probes', {}))
+        self.bulk = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get(self, probe):
+        celcius = self.trace.at(self.clock.time()).get('probes', {}).get(probe, 'missing')
+        if celcius == 'missing':
+            return {'status': PROBE_STALE, 'celcius': 0, 'age': None}
+        if celcius is None:
+            return {'status': PROBE_ERROR, 'celcius': 0, 'age': 0.0}
+        if celcius == 85.0:
+            return {'status': PROBE_POWER_ON, 'celcius': celcius, 'age': 0.0}
+        return {'status': PROBE_OK, 'celcius': celcius, 'age': 0.0}
+
+    def stats(self):
+        return {'probes': self.probes, 'bulk': False, 'failures': 0, 'last_error': None}
+
+
+class FakeCpu(object):
+
+    source = 'trace'
+    path = None
+
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+
+    def get(self):
+        return self.trace.at(self.clock.time()).get('cpu', 45.0)
+
+
+class FakeUploader(object):
+    # delivers straight away, succeeding or failing as the trace says the server was up or down
+
+    PW_REPLY = '{"Status":0}'
+
+    def __init__(self, name, url, trace, clock):
+        self.name = name
+        self.url = url
+        self.trace = trace
+        self.clock = clock
+        self.sent = self.failed = self.dropped = 0
+        self._results = []
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        return []
+
+    def up(self):
+        return self.trace.at(self.clock.time()).get(self.name, True)
+
+    def probe(self):
+        result = UploadResult(self.name, None, None)
+        result.probe = True
+        result.ok = self.up()
+        if not result.ok: result.error = IOError
+        self._results.append(result)
+
+    def reconnect(self):
+        pass
+
+    def submit(self, params, tag=None):
+        result = UploadResult(self.name, params, tag)
+        result.url = self.url
+        if self.up():
+            result.ok = True
+            result.status = 200
+            result.body = self.PW_REPLY if self.name == 'pw' else 'success'
+            self.sent += 1
+        else:
+            result.error = IOError
+            self.failed += 1
+        self._results.append(result)
+        return None
+
+    def results(self):
+        done, self._results = self._results, []
+        return done
+
+    def depth(self):
+        return 0
+
+    def stats(self):
+        return {'depth': 0, 'sent': self.sent, 'failed': self.failed, 'dropped': self.dropped}
+
+
+class FakeConnection(object):
+
+    def __init__(self, name, trace, clock):
+        self.name = name
+        self.trace = trace
+        self.clock = clock
+        self.requests = 0
+
+    def _reply(self):
+        self.requests += 1
+        if not self.trace.at(self.clock.time()).get(self.name, True):
+            raise IOError('server down')
+        return 200, FakeUploader.PW_REPLY
+
+    def get(self, query):
+        return self._reply()
+
+    def post(self, body, content_type=None):
+        return self._reply()
+
+    def close(self):
+        pass
+
+
+class ReplayHardware(Hardware):
+
+    def __init__(self, trace, clock=None):
+        self.trace = trace
+        self.clock = clock or VirtualClock(trace.start())
+        self.sense = FakeSense(trace, self.clock)
+        self.probes = FakeProbes(trace, self.clock)
+        self.cpu = FakeCpu(trace, self.clock)
+        self.started = self.clock.monotonic()
+        self.ticks = 0
+        self.reboots = 0
+        self.shutdowns = 0
+        self.network_restarts = 0
+
+    def uploader(self, name, url, queue_size, connect_timeout, read_timeout):
+        return FakeUploader(name, url, self.trace, self.clock)
+
+    def connection(self, url, connect_timeout, read_timeout):
+        return FakeConnection('pw', self.trace, self.clock)
+
+    def tick(self):
+        self.ticks += 1
+
+    def restart_network(self):
+        self.network_restarts += 1
+
+    def network_up(self):
+        return self.trace.at(self.clock.time()).get('net', True)
+
+    def reboot(self):
+        self.reboots += 1
+
+    def shutdown(self):
+        self.shutdowns += 1
+
+    def close(self):
+        pass
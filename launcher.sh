@@ -1,9 +1,10 @@
 #!/bin/sh
 # launcher.sh
-# start the weather app weather_pi.py in /weatherstation directory
+# start the weather app weather_pi.py in /weatherstation directory, under the supervisor that
+# restarts it when it hangs or crashes
 
 cd /
 cd home/pi/weatherstation
-sudo python ./weather_pi.py
+sudo python ./supervisor.py
 cd /
 
@@ -0,0 +1,182 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - asynchronous logging
+
+    The loop only appends log records to a bounded queue; a background thread writes them in batches every
+    flush_interval seconds (straight away for errors) with one flush per batch, so the SD card sees a few
+    writes a minute instead of one per record. On the way through:
+
+        repeats         a message already logged within repeat_window seconds is counted rather than written,
+                        then summarised as "repeated N times" when the window closes
+        rate            no more than rate records a minute are written, the rest are counted & summarised
+        ring            records below the handler's level (DEBUG normally) are kept in a ring of the last
+                        ring_size & only written, just ahead of it, when an ERROR arrives
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import collections
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+
+from scheduler import monotonic
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    # RotatingFileHandler writing a list of records with a single flush
+
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            for record in records:
+                try:
+                    msg = self.format(record)
+                    if self.shouldRollover(record):
+                        self.doRollover()
+                    self.stream.write(msg + '\n')
+                except Exception:
+                    self.handleError(record)
+            self.stream.flush()
+        finally:
+            self.release()
+
+
+class AsyncHandler(logging.Handler):
+
+    def __init__(self, target, level=logging.INFO, flush_interval=30, repeat_window=600, rate=60, ring_size=200,
+                 queue_size=1000, name='weather_pi', clock=monotonic):
+        # the handler itself takes every record, level is what gets written rather than kept in the ring
+        logging.Handler.__init__(self)
+        self.target = target                    # BatchRotatingFileHandler (or anything with emit_batch)
+        self.write_level = level
+        self.logger_name = name               # for the summary records
+        self.flush_interval = flush_interval
+        self.repeat_window = repeat_window
+        self.rate = rate
+        self.clock = clock
+        self.written = 0
+        self.batches = 0
+        self.repeated = 0
+        self.limited = 0
+        self.overflowed = 0
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._ring = collections.deque(maxlen=ring_size)
+        self._seen = {}                         # (level, message) -> [first seen, repeats, last record]
+        self._allowance = rate
+        self._refilled = clock()
+        self._limited_since = 0
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='AsyncLog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # ------------------------------------------------------------------
+    # loop side
+    # ------------------------------------------------------------------
+    def handle(self, record):
+        # no formatting, filtering or locking here, the writer thread does all of it
+        if len(self._queue) >= self._queue_size:
+            self.overflowed += 1
+            return False
+        self._queue.append(record)
+        if record.levelno >= logging.ERROR: self._wake.set()
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    # ------------------------------------------------------------------
+    # writer side
+    # ------------------------------------------------------------------
+    def _run(self):
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flushing:
+            self._flush()
+
+    def _flush(self):
+        batch = []
+        now = self.clock()
+        while self._queue:
+            self._process(self._queue.popleft(), now, batch)
+        self._expire(now, batch)
+        if self._limited_since and (self._allowance > 0 or not self._running):
+            batch.append(self._summary(logging.WARNING, 'Log rate limit dropped %d record(s)' % self._limited_since))
+            self._limited_since = 0
+        if batch:
+            self.target.emit_batch(batch)
+            self.written += len(batch)
+            self.batches += 1
+
+    def _process(self, record, now, batch):
+        if record.levelno < self.write_level:
+            self._ring.append(record)
+            return
+        if record.levelno >= logging.ERROR and self._ring:
+            # the run up to the error
+            batch.append(self._summary(record.levelno, '---- last %d debug record(s) ----' % len(self._ring), record.created))
+            batch.extend(self._ring)
+            self._ring.clear()
+        key = (record.levelno, record.getMessage())
+        seen = self._seen.get(key)
+        if seen is not None:
+            seen[1] += 1
+            seen[2] = record
+            self.repeated += 1
+            return
+        self._seen[key] = [now, 0, record]
+        if not self._allowed(now, record):
+            return
+        batch.append(record)
+
+    def _allowed(self, now, record):
+        # token bucket of rate records a minute, errors always get through
+        self._allowance = min(self.rate, self._allowance + (now - self._refilled) * self.rate / 60.0)
+        self._refilled = now
+        if record.levelno >= logging.ERROR or self._allowance >= 1:
+            self._allowance -= 1
+            return True
+        self.limited += 1
+        self._limited_since += 1
+        return False
+
+    def _expire(self, now, batch):
+        # close the repeat windows that have run their time
+        for key, (first, repeats, last) in list(self._seen.items()):
+            if now - first < self.repeat_window: continue
+            del self._seen[key]
+            if repeats:
+                batch.append(self._summary(last.levelno, '%s [repeated %d times in %ds]' % (key[1], repeats, int(now - first)), last.created))
+
+    def _summary(self, level, msg, created=None):
+        record = logging.LogRecord(self.logger_name, level, __file__, 0, msg, None, None)
+        if created is not None: record.created = created
+        return record
+
+    def close(self):
+        # write everything still pending, including the repeat counts
+        if self._running:
+            self._running = False
+            self._wake.set()
+            self._thread.join(5.0)
+            self.repeat_window = 0
+            self.flush()
+            self.target.close()
+        logging.Handler.close(self)
+
+    def stats(self):
+        return {'written': self.written,
+                'batches': self.batches,
+                'repeated': self.repeated,
+                'limited': self.limited,
+                'overflowed': self.overflowed,
+                'queued': len(self._queue)}
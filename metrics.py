@@ -0,0 +1,135 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - metrics
+
+    Counters, gauges & fixed bucket histograms for the station's stages, cheap enough for every tick: a
+    histogram is a preallocated array of bucket counts plus a sum, observing is a bisect & three adds, and
+    a histogram times a block as a reusable context manager (with stage['probes']: ...) off the monotonic
+    clock. The registry renders the Prometheus text format, served at /metrics & written periodically to
+    a file (e.g. for node_exporter's textfile collector) so slow ticks can be alerted on.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import bisect
+import collections
+import os
+from array import array
+
+from scheduler import monotonic
+
+# seconds, upper bounds of the histogram buckets (+Inf is implied)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_start')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = array('L', [0] * (len(self.bounds) + 1))
+        self.sum = 0.0
+        self.count = 0
+        self._start = 0.0
+
+    def observe(self, x):
+        self.counts[bisect.bisect_left(self.bounds, x)] += 1
+        self.sum += x
+        self.count += 1
+
+    def __enter__(self):
+        self._start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(monotonic() - self._start)
+        return False
+
+    def timed(self, func):
+        # func wrapped to observe its run time, e.g. for a scheduler job
+        def run(*args):
+            with self:
+                return func(*args)
+        return run
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._families = collections.OrderedDict()     # name -> [type, help, {labels: metric}]
+
+    def _get(self, kind, name, help, labels, make):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [kind, help, collections.OrderedDict()]
+        elif family[0] != kind:
+            raise ValueError("%s is a %s, not a %s" % (name, family[0], kind))
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = make()
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._get('counter', name, help, labels, Counter)
+
+    def gauge(self, name, help, **labels):
+        return self._get('gauge', name, help, labels, Gauge)
+
+    def histogram(self, name, help, buckets=BUCKETS, **labels):
+        return self._get('histogram', name, help, labels, lambda: Histogram(buckets))
+
+    def render(self):
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        for name, (kind, help, metrics) in self._families.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key, metric in metrics.items():
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, _labels(key), _number(metric.value)))
+                    continue
+                cumulative = 0
+                for bound, n in zip(metric.bounds + ('+Inf',), metric.counts):
+                    cumulative += n
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append('%s_bucket%s %d' % (name, _labels(key + (('le', le),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(key), _number(metric.sum)))
+                lines.append('%s_count%s %d' % (name, _labels(key), metric.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # replace the file in one rename so a reader never sees half of it
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+
+def _labels(key):
+    if not key: return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in key) + '}'
+
+
+def _number(x):
+    if isinstance(x, float): return repr(x)
+    return str(x)
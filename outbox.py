@@ -0,0 +1,213 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - store and forward outbox
+
+    Readings that could not be delivered are appended to a SQLite database in WAL mode, which survives a
+    crash or power cut mid-write. Once the server answers again a replay thread drains the backlog, in
+    batches posted to PW_BATCH_URL when the server has one, otherwise one reading per request over a
+    keep-alive connection. Either way the replay is rate limited so it can't swamp the LAN server. A refused
+    batch is sent again one reading at a time, and a reading the server answers but won't take is tried again
+    on the next drain, after max_attempts it is moved to the rejected table so one bad row can't hold up the
+    rest of the backlog.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from uploader import Connection
+
+
+class Outbox(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                         ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                         ' dest TEXT NOT NULL,'
+                         ' created REAL NOT NULL,'
+                         ' payload TEXT NOT NULL,'
+                         ' attempts INTEGER NOT NULL DEFAULT 0)')
+        if 'attempts' not in [row[1] for row in self._db.execute('PRAGMA table_info(outbox)')]:
+            # an outbox from before the attempts were counted
+            self._db.execute('ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS outbox_dest ON outbox (dest, id)')
+        # readings the server kept refusing, kept to look at rather than replayed
+        self._db.execute('CREATE TABLE IF NOT EXISTS rejected ('
+                         ' id INTEGER PRIMARY KEY,'
+                         ' dest TEXT NOT NULL,'
+                         ' created REAL NOT NULL,'
+                         ' payload TEXT NOT NULL,'
+                         ' attempts INTEGER NOT NULL)')
+        self._db.commit()
+
+    def store(self, dest, params):
+        self.store_many(dest, [params])
+
+    def store_many(self, dest, rows):
+        if not rows: return
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT INTO outbox (dest, created, payload) VALUES (?, ?, ?)',
+                                     [(dest, now, json.dumps(params, sort_keys=True)) for params in rows])
+
+    def pending(self, dest, limit):
+        # oldest first, as a list of (id, params)
+        with self._lock:
+            rows = self._db.execute('SELECT id, payload FROM outbox WHERE dest=? ORDER BY id LIMIT ?',
+                                    (dest, limit)).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def ack(self, ids):
+        if not ids: return
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM outbox WHERE id=?', [(i,) for i in ids])
+
+    def reject(self, ids, max_attempts):
+        # one more refusal for each row, those refused max_attempts times move to rejected, returns how many
+        if not ids: return 0
+        with self._lock:
+            with self._db:
+                self._db.executemany('UPDATE outbox SET attempts=attempts+1 WHERE id=?', [(i,) for i in ids])
+                marks = ','.join('?' * len(ids))
+                dead = [row[0] for row in self._db.execute('SELECT id FROM outbox WHERE id IN (%s) AND attempts>=?' % marks,
+                                                           list(ids) + [max_attempts])]
+                if dead:
+                    marks = ','.join('?' * len(dead))
+                    self._db.execute('INSERT INTO rejected SELECT id, dest, created, payload, attempts FROM outbox'
+                                     ' WHERE id IN (%s)' % marks, dead)
+                    self._db.execute('DELETE FROM outbox WHERE id IN (%s)' % marks, dead)
+        return len(dead)
+
+    def count(self, dest):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM outbox WHERE dest=?', (dest,)).fetchone()[0]
+
+    def rejected(self, dest):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM rejected WHERE dest=?', (dest,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Replayer(object):
+    # drains one destination's backlog on its own thread whenever it is woken
+
+    def __init__(self, outbox, dest, url, batch_url=None, batch_size=100, rate=2.0,
+                 connect_timeout=5.0, read_timeout=10.0, connection=None, max_attempts=5, row_connection=None):
+        self.outbox = outbox
+        self.dest = dest
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.interval = 1.0 / rate if rate else 0.0   # seconds between requests
+        self.batch = batch_url is not None
+        self.connection = connection or Connection(batch_url or url, connect_timeout, read_timeout)
+        # single readings go to url, in batch mode on a connection of their own
+        if not self.batch:
+            self.row_connection = self.connection
+        else:
+            self.row_connection = row_connection or Connection(url, connect_timeout, read_timeout)
+        self.replayed = 0
+        self.requests = 0
+        self.failed = 0
+        self.quarantined = 0
+        self.last_error = None
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='Replayer-'+self.dest)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.connection.close()
+        self.row_connection.close()
+
+    def wake(self):
+        self._wake.set()
+
+    def stats(self):
+        return {'backlog': self.outbox.count(self.dest),
+                'replayed': self.replayed,
+                'requests': self.requests,
+                'failed': self.failed,
+                'quarantined': self.quarantined,
+                'last_error': self.last_error}
+
+    def _run(self):
+        while self._running:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self._drain()
+            except Exception:
+                self.failed += 1
+                self.last_error = str(sys.exc_info()[0])
+                self.connection.close()
+                self.row_connection.close()
+
+    def _accepted(self, status, body):
+        # the same rule as pw_result, a 200 whose JSON reply carries a good Status
+        if status != 200: return False
+        try:
+            reply = json.loads(body)
+        except (TypeError, ValueError):
+            return False
+        return isinstance(reply, dict) and reply.get('Status') in (0, 1)
+
+    def _drain(self):
+        while self._running:
+            rows = self.outbox.pending(self.dest, self.batch_size)
+            if not rows: return
+            for row in rows: row[1]['st'] = 'Stored'
+            if self.batch:
+                if self._send(rows, True): continue
+                # the batch was refused, send it again a reading at a time so only the bad one gains an attempt
+            for row in rows:
+                if not self._running or not self._send([row], False): return
+
+    def _send(self, chunk, batch):
+        # one request for the chunk, True once the server took it
+        started = time.time()
+        if batch:
+            status, body = self.connection.post(urlencode({'data': json.dumps([params for i, params in chunk])}))
+        else:
+            status, body = self.row_connection.get(urlencode(chunk[0][1]))
+        self.requests += 1
+        accepted = self._accepted(status, body)
+        if accepted:
+            self.outbox.ack([i for i, params in chunk])
+            self.replayed += len(chunk)
+        else:
+            self.failed += 1
+            self.last_error = 'HTTP Status %s' % str(status) if status != 200 else 'Refused:' + str(body)[:80]
+            # the server answered, so the reading itself may be what it won't take
+            if not batch: self.quarantined += self.outbox.reject([chunk[0][0]], self.max_attempts)
+        # rate limit the replay
+        wait = self.interval - (time.time() - started)
+        if wait > 0 and self._running: time.sleep(wait)
+        return accepted
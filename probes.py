@@ -0,0 +1,208 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - 1-Wire probe acquisition
+
+    Reads every DS18B20 on the 1-Wire bus on a background thread and keeps the results in a cache, so the
+    sampling loop never waits the ~750ms conversion time. Probes are found by globbing for 28-* devices.
+    When the bus master supports it (therm_bulk_read) all probes are told to convert at once, otherwise
+    the probes are read in parallel from a thread pool, either way a refresh costs about one conversion
+    time however many probes are fitted. A probe whose file can't be read or parsed is PROBE_ERROR on its
+    own; a refresh that fails as a whole is counted & logged (weather_pi.probes), the cache goes stale.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import glob
+import logging
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from scheduler import monotonic
+
+W1_DEVICES = '/sys/bus/w1/devices'
+
+PROBE_OK = 0
+PROBE_STALE = 7         # no reading within the maximum age
+PROBE_POWER_ON = 8      # 85.0C, the DS18B20 power on value, not a real reading
+PROBE_ERROR = 9         # missing probe, CRC failure or unreadable file
+
+BULK_TIMEOUT = 1.5      # seconds to wait for a bulk conversion
+
+logger = logging.getLogger('weather_pi.probes')
+
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def parse_w1_slave(text):
+    # w1_slave holds two lines, the first ends in YES when the CRC checked out, the second holds t=<millidegrees>
+    lines = text.splitlines()
+    if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+        return PROBE_ERROR, 0
+    temp_output = lines[1].find('t=')
+    if temp_output == -1:
+        return PROBE_ERROR, 0
+    return check_celcius(float(lines[1].strip()[temp_output+2:]) / 1000.0)
+
+
+def parse_temperature(text):
+    # the temperature attribute holds just <millidegrees>
+    try:
+        return check_celcius(float(text.strip()) / 1000.0)
+    except ValueError:
+        return PROBE_ERROR, 0
+
+
+def check_celcius(celcius):
+    if (celcius == 85.0): return PROBE_POWER_ON, celcius
+    return PROBE_OK, celcius
+
+
+def discover(base=W1_DEVICES):
+    # ids of the DS18B20 (family 28) probes on the bus
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(base, '28-*')))
+
+
+class ProbeReader(object):
+
+    def __init__(self, base=W1_DEVICES, interval=5.0, max_age=15.0, probes=None, reader=read_file,
+                 rediscover=60.0):
+        self.base = base
+        self.interval = interval            # seconds between refreshes
+        self.max_age = max_age              # seconds before a cached reading is reported stale
+        self.fixed = probes                 # explicit probe ids, None to discover them
+        self.reader = reader
+        self.rediscover = rediscover        # seconds between bus scans
+        self.probes = []
+        self.refreshes = 0
+        self.refresh_last = 0.0             # seconds the last refresh took
+        self.refresh_max = 0.0
+        self.failures = 0                   # refreshes that failed as a whole
+        self.last_error = None
+        self.bulk = False
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._running = False
+        self._thread = None
+        self._scanned = None
+
+    def start(self):
+        self.scan()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='ProbeReader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def scan(self):
+        # (re)discover the probes & whether the bus masters can do bulk conversions
+        found = list(self.fixed) if self.fixed else discover(self.base)
+        self.bulk = bool(self._bulk_files())
+        if found != self.probes:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = ThreadPool(max(1, len(found)))
+            self.probes = found
+        self._scanned = monotonic()
+        return found
+
+    def get(self, probe):
+        # latest cached reading, never blocks
+        with self._lock:
+            cached = self._cache.get(probe)
+        if cached is None:
+            return {'status': PROBE_STALE, 'celcius': 0, 'age': None}
+        age = monotonic() - cached['time']
+        if age > self.max_age:
+            return {'status': PROBE_STALE, 'celcius': cached['celcius'], 'age': age}
+        return {'status': cached['status'], 'celcius': cached['celcius'], 'age': age}
+
+    def refresh(self):
+        # read every probe once, conversions overlap so this takes about one conversion time
+        start = monotonic()
+        if self._scanned is None or start - self._scanned > self.rediscover:
+            self.scan()
+        probes = list(self.probes)
+        use_bulk = self.bulk and self._bulk_convert()
+        results = self._pool.map(lambda probe: self._read(probe, use_bulk), probes) if probes else []
+        now = monotonic()
+        with self._lock:
+            for probe, (status, celcius) in zip(probes, results):
+                # a failed read keeps the last good value, which goes stale after max_age
+                cached = self._cache.get(probe)
+                if status == PROBE_OK or cached is None or cached['status'] != PROBE_OK:
+                    self._cache[probe] = {'status': status, 'celcius': celcius, 'time': now}
+        self.refreshes += 1
+        self.refresh_last = now - start
+        self.refresh_max = max(self.refresh_max, self.refresh_last)
+
+    def stats(self):
+        return {'probes': self.probes,
+                'bulk': self.bulk,
+                'refreshes': self.refreshes,
+                'refresh_last': round(self.refresh_last, 4),
+                'refresh_max': round(self.refresh_max, 4),
+                'failures': self.failures,
+                'last_error': self.last_error}
+
+    def _read(self, probe, bulk):
+        try:
+            if bulk:
+                return parse_temperature(self.reader(os.path.join(self.base, probe, 'temperature')))
+            return parse_w1_slave(self.reader(os.path.join(self.base, probe, 'w1_slave')))
+        except (IOError, OSError, ValueError):
+            # unreadable, or a garbled / truncated t= line
+            return PROBE_ERROR, 0
+
+    def _bulk_files(self):
+        return glob.glob(os.path.join(self.base, 'w1_bus_master*', 'therm_bulk_read'))
+
+    def _bulk_convert(self):
+        # start a conversion on every probe at once & wait for it, False falls back to per-probe reads
+        files = self._bulk_files()
+        try:
+            for path in files:
+                with open(path, 'w') as f:
+                    f.write('trigger\n')
+            deadline = monotonic() + BULK_TIMEOUT
+            # -1 while a conversion is running, 1 once the values are ready
+            while any(self.reader(path).strip() == '-1' for path in files):
+                if monotonic() > deadline:
+                    return False
+                time.sleep(0.05)
+            return True
+        except (IOError, OSError):
+            return False
+
+    def _run(self):
+        next_due = monotonic()
+        failing = False
+        while self._running:
+            try:
+                self.refresh()
+                failing = False
+            except Exception:
+                self.failures += 1
+                self.last_error = str(sys.exc_info()[1])
+                # once a run of failures, the cached readings go stale after max_age
+                if not failing: logger.warning("...Probe Refresh Failed:" + self.last_error)
+                failing = True
+            next_due += self.interval
+            wait = next_due - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                next_due = monotonic()
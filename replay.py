@@ -0,0 +1,119 @@
+#!/usr/bin/python
+'''*****************************************************************************************************************
+    Pi Weather Station - accelerated replay
+
+    Runs weather_pi's own loop against a trace on a virtual clock, so a week of sampling, uploads, server
+    outages, probe faults & failure reboots takes seconds on any machine - no Pi, SenseHat or network.
+    The trace is either recorded on the Pi (set Config.TRACE_PATH) or a synthetic week.
+
+        python replay.py                        synthetic week
+        python replay.py --days 2               synthetic 2 days
+        python replay.py trace.jsonl            recorded trace
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import weather_pi
+from weather_pi import Config
+from hal import Trace, ReplayHardware
+from outbox import Outbox
+
+
+def configure(workdir):
+    # keep everything the run writes out of the app directory & off the network
+    Config.API = False
+    Config.CONTROL = False
+    Config.LOGGING_PRINT = False
+    Config.TRACE_PATH = None
+    Config.REPLAY_RATE = 0
+    Config.STATE_PATH = os.path.join(workdir, 'State.pkl')
+    Config.OUTBOX_PATH = os.path.join(workdir, 'outbox.db')
+    Config.TSDB_PATH = os.path.join(workdir, 'history.db')
+    Config.METRICS_PATH = os.path.join(workdir, 'weather_pi.prom')
+    Config.SPARKLINE_PATH = os.path.join(workdir, 'recent.bin')
+    weather_pi.setup_logging(os.path.join(workdir, 'weather_pi.log'))
+
+
+def add_stats(total, stats):
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def replay(trace, duration=None):
+    # run the station over the trace, restarting it after every simulated reboot like the Pi would
+    hw = ReplayHardware(trace)
+    duration = trace.duration() if duration is None else min(duration, trace.duration())
+    uploads = {'pw': {}, 'wu': {}}
+    late = {}
+    runs = 0
+    while hw.clock.monotonic() < duration:
+        runs += 1
+        weather_pi.startup(hw)
+        weather_pi.main(run_for=duration - hw.clock.monotonic())
+        add_stats(uploads['pw'], weather_pi.pw_uploader.stats())
+        add_stats(uploads['wu'], weather_pi.wu_uploader.stats())
+        for name, stats in weather_pi.scheduler.stats().items():
+            late[name] = max(late.get(name, 0), stats['late_max'])
+        if not weather_pi.REBOOT: break
+    weather_pi.saveState('replay')
+    return {'days': round(hw.clock.monotonic() / 86400.0, 2),
+            'runs': runs,
+            'samples': hw.ticks,
+            'reboots': hw.reboots,
+            'network_restarts': hw.network_restarts,
+            'shutdowns': hw.shutdowns,
+            'sense_reads': hw.sense.reads,
+            'compression': dict((name, weather_pi.compressions[name].ratio()) for name in weather_pi.compressions),
+            'uploads': uploads,
+            'late_max': late}
+
+
+def main():
+    args = sys.argv[1:]
+    days = None
+    if '--days' in args:
+        i = args.index('--days')
+        days = float(args[i + 1])
+        del args[i:i + 2]
+    keep = '--keep' in args
+    if keep: args.remove('--keep')
+
+    started = time.time()
+    if args:
+        trace = Trace.load(args[0])
+    else:
+        # the configured probe ids, so the probes are found where the station expects them
+        probes = [sensor.get('probe') or '28-%012d' % (n + 1) for n, sensor in enumerate(Config.SENSORS) if sensor['source'] == 'probe']
+        trace = Trace.synthetic(days or 7, probes=probes)
+    loaded = time.time() - started
+
+    workdir = tempfile.mkdtemp(prefix='weatherpi-replay-')
+    try:
+        configure(workdir)
+        started = time.time()
+        result = replay(trace, days * 86400 if days else None)
+        elapsed = time.time() - started
+        outbox = Outbox(Config.OUTBOX_PATH)
+        result['outbox_backlog'] = outbox.count('pw')
+        outbox.close()
+        result['trace_seconds'] = round(loaded, 2)
+        result['wall_seconds'] = round(elapsed, 2)
+        result['speedup'] = int(result['days'] * 86400 / elapsed) if elapsed else None
+        print(json.dumps(result, indent=2, sort_keys=True))
+    finally:
+        if keep:
+            print("Replay files kept in " + workdir)
+        else:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
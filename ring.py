@@ -0,0 +1,133 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - recent history ring
+
+    The last few hours of a handful of metrics in fixed memory for the display's sparklines. Each metric
+    is a ring of slots (slot seconds each) held in array('d') columns - the slot's number, n, min, max &
+    sum - so adding a sample overwrites a slot in place, O(1) & nothing grows. columns() summarises the
+    slots into (min, max) per display column.
+
+    save() writes the rings as a compact binary snapshot (a struct header then the raw arrays, about
+    40 bytes a slot), load() reads one back after a restart if it was written with the same layout.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'WPRG'
+VERSION = 1
+HEADER = struct.Struct('<4sBcHHd')      # magic, version, byte order, metrics, slots, slot seconds
+NAME = struct.Struct('<H')
+COLUMNS = 5                             # slot number, n, min, max, sum
+
+
+def _to_bytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _from_bytes(a, data):
+    if hasattr(a, 'frombytes'): a.frombytes(data)
+    else: a.fromstring(data)
+
+
+class HistoryRing(object):
+
+    def __init__(self, names, slots=96, slot=300.0):
+        self.names = list(names)
+        self.slots = slots
+        self.slot = float(slot)
+        self.rings = {}
+        for name in self.names:
+            # slot number -1 marks an empty slot
+            self.rings[name] = tuple(array('d', [-1.0 if c == 0 else 0.0] * slots) for c in range(COLUMNS))
+
+    def add(self, name, ts, x):
+        number, n, low, high, total = self.rings[name]
+        i = ts // self.slot
+        k = int(i % self.slots)
+        if number[k] != i:
+            # a slot from a lap ago (or never used), started over
+            number[k] = i
+            n[k] = 0
+            low[k] = high[k] = x
+            total[k] = 0.0
+        n[k] += 1
+        if x < low[k]: low[k] = x
+        if x > high[k]: high[k] = x
+        total[k] += x
+
+    def columns(self, name, end, span, count=8):
+        # [(min, max) or None] for count equal columns of the span seconds up to end, oldest first
+        number, n, low, high, total = self.rings[name]
+        start = end - span
+        width = float(span) / count
+        out = [None] * count
+        for k in range(self.slots):
+            if not n[k]: continue
+            ts = number[k] * self.slot
+            if ts < start or ts >= end: continue
+            column = min(count - 1, int((ts - start) // width))
+            current = out[column]
+            if current is None:
+                out[column] = (low[k], high[k])
+            else:
+                out[column] = (min(current[0], low[k]), max(current[1], high[k]))
+        return out
+
+    # ------------------------------------------------------------------
+    # snapshot
+    # ------------------------------------------------------------------
+    def dumps(self):
+        parts = [HEADER.pack(MAGIC, VERSION, sys.byteorder[0].encode('ascii'), len(self.names), self.slots, self.slot)]
+        for name in self.names:
+            encoded = name.encode('utf-8')
+            parts.append(NAME.pack(len(encoded)) + encoded)
+            parts.extend(_to_bytes(a) for a in self.rings[name])
+        return b''.join(parts)
+
+    def loads(self, data):
+        # fill the rings from a snapshot, False (the rings untouched) when it doesn't match this layout
+        try:
+            magic, version, order, count, slots, slot = HEADER.unpack_from(data, 0)
+        except struct.error:
+            return False
+        if magic != MAGIC or version != VERSION or slots != self.slots or slot != self.slot:
+            return False
+        size = slots * array('d').itemsize
+        offset = HEADER.size
+        rings = {}
+        for i in range(count):
+            if len(data) < offset + NAME.size: return False
+            length = NAME.unpack_from(data, offset)[0]
+            offset += NAME.size
+            name = data[offset:offset + length].decode('utf-8')
+            offset += length
+            if len(data) < offset + COLUMNS * size: return False
+            columns = []
+            for c in range(COLUMNS):
+                a = array('d')
+                _from_bytes(a, data[offset:offset + size])
+                if order != sys.byteorder[0].encode('ascii'): a.byteswap()
+                columns.append(a)
+                offset += size
+            rings[name] = tuple(columns)
+        for name in self.names:
+            if name in rings: self.rings[name] = rings[name]
+        return True
+
+    def save(self, path):
+        # replace the file in one rename so a crash never leaves half a snapshot
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.dumps())
+        os.rename(tmp, path)
+
+    def load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return self.loads(f.read())
+        except (IOError, OSError):
+            return False
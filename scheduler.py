@@ -0,0 +1,163 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - deadline scheduler
+
+    Runs the station's periodic jobs off a monotonic clock. Every job keeps its own deadline which always
+    advances by whole intervals from the previous deadline (never from "now"), so a slow step delays a job
+    but can neither drift it nor make it run the same slot twice. Lateness and missed slots are recorded
+    per job. Deadlines are kept in a heap so a tick only touches the jobs that are due, however many
+    there are (e.g. one per sensor).
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import heapq
+import os
+import time
+
+
+def _clock_monotonic():
+    # time.monotonic only exists on python 3, fall back to clock_gettime on the Pi's python 2
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        ts = timespec()
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+                errno_ = ctypes.get_errno()
+                raise OSError(errno_, os.strerror(errno_))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _clock_monotonic()
+
+
+class Job(object):
+
+    def __init__(self, name, interval, func, due, priority):
+        self.name = name
+        self.interval = float(interval)
+        self.func = func
+        self.due = due
+        self.priority = priority
+        self.runs = 0
+        self.missed = 0             # whole slots skipped because the job ran late
+        self.late_last = 0.0        # seconds the last run started after its deadline
+        self.late_max = 0.0
+        self.late_total = 0.0
+        self.duration_last = 0.0    # seconds the last run took
+        self.duration_max = 0.0
+
+    def stats(self):
+        return {'interval': self.interval,
+                'runs': self.runs,
+                'missed': self.missed,
+                'late_last': round(self.late_last, 4),
+                'late_max': round(self.late_max, 4),
+                'late_avg': round(self.late_total / self.runs, 4) if self.runs else 0.0,
+                'duration_last': round(self.duration_last, 4),
+                'duration_max': round(self.duration_max, 4)}
+
+
+class Scheduler(object):
+
+    def __init__(self, clock=monotonic, wall=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.wall = wall
+        self.sleep = sleep
+        self.jobs = []
+        self._heap = []             # (deadline slot, priority, job), the next job due on top
+        self.on_missed = None       # optional callback(job, slots) when a job skips slots
+        # wall clock offset taken once so every job aligns against the same reference
+        self._wall_offset = wall() - clock()
+
+    def _aligned(self, now, interval):
+        return now + (interval - (now + self._wall_offset) % interval) % interval
+
+    def add(self, name, interval, func, align=True):
+        # align=True puts the first deadline on the next wall clock multiple of the interval
+        # (5 second slots on :00/:05..., 15 minute slots on :00/:15...), otherwise run straight away
+        now = self.clock()
+        due = now
+        if align:
+            due = self._aligned(now, interval)
+        job = Job(name, interval, func, due, len(self.jobs))
+        self.jobs.append(job)
+        heapq.heappush(self._heap, self._entry(job))
+        return job
+
+    def _entry(self, job):
+        # deadlines within a millisecond count as the same slot and run in the order added
+        return (round(job.due, 3), job.priority, job)
+
+    def job(self, name):
+        for job in self.jobs:
+            if job.name == name:
+                return job
+        raise KeyError(name)
+
+    def set_interval(self, name, interval):
+        # re-align a job onto its new interval from the wall clock
+        job = self.job(name)
+        if float(interval) == job.interval:
+            return
+        job.interval = float(interval)
+        job.due = self._aligned(self.clock(), job.interval)
+        self._heap = [self._entry(j) for j in self.jobs]
+        heapq.heapify(self._heap)
+
+    def next_job(self):
+        return self._heap[0][2]
+
+    def run_pending(self):
+        # run every job whose deadline has passed, returns the number of jobs run
+        ran = 0
+        while self._heap:
+            slot, priority, job = self._heap[0]
+            start = self.clock()
+            if slot > start:
+                break
+            late = max(0.0, start - job.due)
+            slots = int(late // job.interval)
+            if slots:
+                job.missed += slots
+                if self.on_missed is not None:
+                    self.on_missed(job, slots)
+            job.late_last = late
+            job.late_max = max(job.late_max, late)
+            job.late_total += late
+            job.runs += 1
+            # advance from the deadline, not from now, so the schedule cannot drift
+            job.due += job.interval * (slots + 1)
+            heapq.heapreplace(self._heap, self._entry(job))
+            try:
+                job.func()
+            finally:
+                job.duration_last = self.clock() - start
+                job.duration_max = max(job.duration_max, job.duration_last)
+            ran += 1
+        return ran
+
+    def run(self, keep_going):
+        # run until keep_going() returns False, sleeping until the next deadline in between
+        while keep_going():
+            self.run_pending()
+            if not keep_going() or not self.jobs:
+                break
+            wait = self.next_job().due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+
+    def stats(self):
+        return dict((job.name, job.stats()) for job in self.jobs)
@@ -0,0 +1,210 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - sinks
+
+    Local destinations for the readings, alongside the PW & WU uploads (uploader.py). Each runs on its own
+    Sink worker with its own queue, batch size, timeout & retry policy (see Config.SINKS):
+
+        mqtt        each reading published as JSON to a broker (MQTT 3.1.1, QoS 0, no client library needed)
+        influx      batches of readings POSTed as InfluxDB line protocol, e.g. to /write?db=weather
+        file        batches of readings appended as JSON lines
+
+    A record is a flat dict of the reading, numbers are the measurements, strings (station & probe ids)
+    are tags, 'time' is the epoch second it was taken.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import json
+import numbers
+import os
+import socket
+import struct
+
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+from uploader import Sink, Connection
+
+
+class FileSink(Sink):
+
+    def __init__(self, name, path, queue_size=100, batch_size=10, retries=0, retry_wait=5.0):
+        Sink.__init__(self, name, queue_size, batch_size, retries, retry_wait)
+        self.path = path
+
+    def send(self, batch):
+        # one write & flush per batch
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(result.params, sort_keys=True) + '\n' for result in batch))
+        return True, None, None
+
+    def check(self):
+        return os.access(os.path.dirname(os.path.abspath(self.path)), os.W_OK)
+
+
+def line_protocol(measurement, record):
+    # weather,pid=28-0417a2d9f9ff,station=home rh=61.2,t=12.4 1538300000000000000
+    tags = []
+    fields = []
+    for key in sorted(record):
+        value = record[key]
+        if key == 'time' or value is None: continue
+        if isinstance(value, bool):
+            fields.append('%s=%s' % (key, 'true' if value else 'false'))
+        elif isinstance(value, numbers.Number):
+            fields.append('%s=%r' % (key, float(value)))
+        else:
+            tags.append('%s=%s' % (key, _escape(str(value))))
+    line = ','.join([measurement] + tags) + ' ' + ','.join(fields)
+    if 'time' in record: line += ' %d000000000' % int(record['time'])
+    return line
+
+
+def _escape(tag):
+    return tag.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+class InfluxSink(Sink):
+
+    def __init__(self, name, url, measurement='weather', queue_size=100, batch_size=10, connect_timeout=5.0,
+                 read_timeout=10.0, retries=2, retry_wait=5.0):
+        Sink.__init__(self, name, queue_size, batch_size, retries, retry_wait)
+        self.url = url
+        self.query = urlsplit(url).query
+        self.measurement = measurement
+        self.connection = Connection(url, connect_timeout, read_timeout)
+
+    def send(self, batch):
+        body = '\n'.join(line_protocol(self.measurement, result.params) for result in batch).encode('utf-8')
+        retries = self.connection.retries
+        try:
+            status, reply = self.connection.request('POST', self.query, body, {'Content-Type': 'text/plain; charset=utf-8'})
+        finally:
+            self.resent += self.connection.retries - retries
+        # 204 No Content when the points are written
+        return 200 <= status < 300, status, reply
+
+    def check(self):
+        return self.connection.check()
+
+    def close(self):
+        self.connection.close()
+
+
+# ============================================================================
+# MQTT 3.1.1, just enough to publish at QoS 0
+# ============================================================================
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+DISCONNECT = 0xe0
+
+
+def _string(text):
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def _packet(kind, payload):
+    # fixed header: packet type & the remaining length as a base 128 varint
+    header = bytearray([kind])
+    length = len(payload)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length: break
+    return bytes(header) + payload
+
+
+class MqttSink(Sink):
+
+    def __init__(self, name, url, topic='weatherpi/reading', client_id=None, queue_size=100, batch_size=1,
+                 timeout=5.0, retries=2, retry_wait=5.0, retain=False):
+        Sink.__init__(self, name, queue_size, batch_size, retries, retry_wait)
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 1883
+        self.username = parts.username
+        self.password = parts.password
+        self.topic = topic
+        self.client_id = client_id or 'weatherpi-%d' % os.getpid()
+        self.timeout = timeout
+        self.retain = retain
+        self.sock = None
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            flags = 0x02                                    # clean session
+            payload = _string(self.client_id)
+            if self.username is not None:
+                flags |= 0x80
+                payload += _string(self.username)
+                if self.password is not None:
+                    flags |= 0x40
+                    payload += _string(self.password)
+            # keep alive 0, the broker doesn't expect pings between readings
+            sock.sendall(_packet(CONNECT, _string('MQTT') + struct.pack('!BBH', 4, flags, 0) + payload))
+            reply = bytearray()
+            while len(reply) < 4:
+                data = sock.recv(4 - len(reply))
+                if not data: raise IOError("MQTT connection closed")
+                reply += bytearray(data)
+            if reply[0] != CONNACK or reply[3] != 0:
+                raise IOError("MQTT connect refused (%d)" % reply[3])
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def send(self, batch):
+        data = b''.join(_packet(PUBLISH | (0x01 if self.retain else 0),
+                                _string(self.topic) + json.dumps(result.params, sort_keys=True).encode('utf-8'))
+                        for result in batch)
+        for attempt in (0, 1):
+            reused = self.sock is not None
+            if self.sock is None:
+                self.sock = self._connect()
+            try:
+                self.sock.sendall(data)
+                return True, None, None
+            except Exception:
+                self.close()
+                # a broker that dropped an idle connection, once more on a fresh one
+                if attempt or not reused:
+                    raise
+                self.resent += 1
+
+    def check(self):
+        socket.create_connection((self.host, self.port), self.timeout).close()
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(_packet(DISCONNECT, b''))
+                self.sock.close()
+            except Exception:
+                pass
+            self.sock = None
+
+
+def make_sink(spec):
+    # a sink from one of Config.SINKS
+    kind = spec['kind']
+    name = spec.get('name', kind)
+    options = dict(queue_size=spec.get('queue', 100), batch_size=spec.get('batch', 1),
+                   retries=spec.get('retries', 0), retry_wait=spec.get('retry_wait', 5.0))
+    if kind == 'file':
+        return FileSink(name, spec['path'], **options)
+    if kind == 'influx':
+        timeout = spec.get('timeout', 10.0)
+        return InfluxSink(name, spec['url'], spec.get('measurement', 'weather'), connect_timeout=min(timeout, 5.0),
+                          read_timeout=timeout, **options)
+    if kind == 'mqtt':
+        return MqttSink(name, spec['url'], spec.get('topic', 'weatherpi/reading'), spec.get('client_id'),
+                        timeout=spec.get('timeout', 5.0), retain=spec.get('retain', False), **options)
+    raise ValueError("Unknown sink kind '%s' for sink '%s'" % (kind, name))
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+'''*****************************************************************************************************************
+    Pi Weather Station - supervisor
+
+    A small parent process that runs weather_pi.py as its worker & restarts just the worker, within seconds,
+    when it stops. The worker's loop writes a byte down a pipe every HEARTBEAT_INTERVAL seconds (a heartbeat
+    job, see Heartbeat); when none arrives for HEARTBEAT_TIMEOUT seconds the loop is taken to be wedged (a
+    hung request, a stuck sysfs read ...), the worker is asked for its thread stacks (SIGUSR1, only when its
+    heartbeats say it has a handler for it - the default action would kill it), stopped (SIGTERM, then SIGKILL after SUPERVISOR_GRACE seconds) & started again. A worker that crashes is
+    restarted too, after a backoff that doubles with each crash in a row so a crash loop doesn't spin. A
+    worker that exits cleanly (WeatherPiOff, a shutdown or reboot) ends the supervisor.
+
+    Restarts, by reason, are logged to SUPERVISOR_LOG & written to SUPERVISOR_METRICS_PATH in the Prometheus
+    text format, next to the worker's own metrics.
+
+        sudo python ./supervisor.py
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import fcntl
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from logging.handlers import RotatingFileHandler
+
+from scheduler import monotonic
+from metrics import Registry
+
+ENV = 'WEATHERPI_HEARTBEAT_FD'
+BEAT = b'.'
+STACKS = b'S'           # a heartbeat from a worker that dumps its stacks on SIGUSR1
+
+EXIT = 'exit'           # the worker stopped by itself, exit code 0
+CRASH = 'crash'         # any other exit code or a signal
+HANG = 'hang'           # no heartbeat within the timeout
+STOP = 'stop'           # the supervisor was told to stop
+
+
+class Heartbeat(object):
+    # the worker's end of the pipe
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.mark = BEAT
+        # a full pipe (a supervisor that isn't reading) must never block the loop
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        # None when the station isn't running under the supervisor
+        fd = environ.get(ENV)
+        if not fd: return None
+        return cls(int(fd))
+
+    def register_stacks(self):
+        # dump every thread's stack to stderr on SIGUSR1 (faulthandler, or dump_stacks on python 2) & say
+        # so in the heartbeats, so the supervisor can ask before it stops a hung worker
+        if not hasattr(signal, 'SIGUSR1'): return False
+        try:
+            import faulthandler
+            faulthandler.register(signal.SIGUSR1)
+        except (ImportError, AttributeError):
+            signal.signal(signal.SIGUSR1, dump_stacks)
+        self.mark = STACKS
+        return True
+
+    def beat(self):
+        try:
+            os.write(self.fd, self.mark)
+        except OSError:
+            pass
+
+
+def dump_stacks(signum, frame):
+    # faulthandler's dump for python 2, it runs on the main thread once it is back in python code
+    current = threading.current_thread().ident
+    for ident, stack in sys._current_frames().items():
+        if ident == current: stack = frame         # where it was interrupted, not this handler
+        sys.stderr.write("Thread 0x%x (most recent call first):\n" % ident)
+        sys.stderr.write(''.join(reversed(traceback.format_stack(stack))))
+    sys.stderr.flush()
+
+
+class Supervisor(object):
+
+    def __init__(self, command, timeout=30, startup=180, grace=20, backoff=2.0, backoff_max=300.0, stable=600,
+                 metrics_path=None, metrics_interval=60, logger=None, clock=monotonic):
+        self.command = command
+        self.timeout = timeout                  # seconds without a heartbeat
+        self.startup = startup                  # seconds allowed for the first heartbeat
+        self.grace = grace                      # seconds for a worker to stop before it is killed
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.stable = stable                    # seconds of running that clear the crashes in a row
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.logger = logger or logging.getLogger('supervisor')
+        self.clock = clock
+        self.running = True
+        self.proc = None
+        self.pipe = None
+        self.restarts = {}                      # reason -> count
+        self.crashes = 0                        # in a row
+        self.beats = 0
+        self.started = clock()
+        self.worker_started = None
+        self.last_beat = None
+        self.stacks = False                     # the worker has a SIGUSR1 handler
+        self.metrics = Registry()
+        self._metrics_written = 0
+
+    # ------------------------------------------------------------------
+    # worker
+    # ------------------------------------------------------------------
+    def spawn(self):
+        r, w = os.pipe()
+        env = dict(os.environ)
+        env[ENV] = str(w)
+        if sys.version_info[0] >= 3:
+            self.proc = subprocess.Popen(self.command, env=env, pass_fds=(w,))
+        else:
+            self.proc = subprocess.Popen(self.command, env=env, close_fds=False)
+        os.close(w)
+        self.pipe = r
+        self.worker_started = self.clock()
+        self.last_beat = None
+        self.stacks = False
+        self.logger.info("Worker %d started: %s" % (self.proc.pid, ' '.join(self.command)))
+
+    def watch(self):
+        # until the worker exits or stalls, returns why
+        while True:
+            if not self.running:
+                self.terminate()
+                return STOP
+            if select.select([self.pipe], [], [], 1.0)[0]:
+                data = os.read(self.pipe, 4096)
+                if data:
+                    self.beats += len(data)
+                    self.last_beat = self.clock()
+                    if STACKS in data: self.stacks = True
+            code = self.proc.poll()
+            if code is not None:
+                return EXIT if code == 0 else CRASH
+            now = self.clock()
+            if self.last_beat is None:
+                stalled = now - self.worker_started > self.startup
+            else:
+                stalled = now - self.last_beat > self.timeout
+            if stalled:
+                self.terminate(stacks=True)
+                return HANG
+            if now - self._metrics_written >= self.metrics_interval:
+                self.write_metrics()
+
+    def terminate(self, stacks=False):
+        if self.proc.poll() is not None: return
+        if stacks and self.stacks:
+            # the worker writes every thread's stack to stderr, to see where it hung
+            self._signal(signal.SIGUSR1)
+            time.sleep(1)
+        self._signal(signal.SIGTERM)
+        deadline = self.clock() + self.grace
+        while self.proc.poll() is None and self.clock() < deadline:
+            time.sleep(0.2)
+        if self.proc.poll() is None:
+            self.logger.warning("Worker %d didn't stop, killing it" % self.proc.pid)
+            self._signal(signal.SIGKILL)
+            self.proc.wait()
+
+    def _signal(self, sig):
+        try:
+            os.kill(self.proc.pid, sig)
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------
+    # supervision
+    # ------------------------------------------------------------------
+    def run(self):
+        while self.running:
+            self.spawn()
+            reason = self.watch()
+            os.close(self.pipe)
+            uptime = self.clock() - self.worker_started
+            if reason in (EXIT, STOP):
+                self.logger.info("Worker %d %s after %ds, supervisor stopping" % (self.proc.pid, reason, uptime))
+                break
+            self.restarts[reason] = self.restarts.get(reason, 0) + 1
+            self.metrics.counter('weatherpi_supervisor_restarts_total', 'Worker restarts', reason=reason).inc()
+            if uptime >= self.stable: self.crashes = 0
+            self.crashes += 1
+            delay = min(self.backoff_max, self.backoff * 2 ** (self.crashes - 1))
+            self.logger.warning("Worker %d %s (exit code %s) after %ds, restart %d in a row in %.0fs" %
+                                (self.proc.pid, reason, self.proc.returncode, uptime, self.crashes, delay))
+            self.write_metrics()
+            deadline = self.clock() + delay
+            while self.running and self.clock() < deadline:
+                time.sleep(min(1.0, deadline - self.clock()))
+        self.write_metrics()
+        self.logger.info("Supervisor Stats=> %s" % str(self.stats()))
+
+    def stop(self, *args):
+        # also the SIGTERM/SIGINT handler, the worker is stopped by the watch loop
+        self.running = False
+
+    def stats(self):
+        return {'restarts': dict(self.restarts),
+                'crashes': self.crashes,
+                'beats': self.beats,
+                'uptime': int(self.clock() - self.started)}
+
+    def write_metrics(self):
+        now = self.clock()
+        self._metrics_written = now
+        self.metrics.gauge('weatherpi_supervisor_uptime_seconds', 'Seconds the supervisor has run').set(int(now - self.started))
+        self.metrics.gauge('weatherpi_supervisor_worker_uptime_seconds', 'Seconds the current worker has run').set(
+            int(now - self.worker_started) if self.worker_started is not None else 0)
+        self.metrics.gauge('weatherpi_supervisor_crashes', 'Worker restarts in a row').set(self.crashes)
+        self.metrics.gauge('weatherpi_supervisor_heartbeat_age_seconds', 'Seconds since the last worker heartbeat').set(
+            round(now - self.last_beat, 1) if self.last_beat is not None else -1)
+        if not self.metrics_path: return
+        try:
+            self.metrics.write(self.metrics_path)
+        except (IOError, OSError):
+            self.logger.warning("Unable to Write Metrics:" + str(sys.exc_info()[1]))
+
+
+def main():
+    from config import Config
+
+    baseDir = os.path.dirname(os.path.abspath(__file__))
+    logger = logging.getLogger('supervisor')
+    logger.setLevel(logging.INFO)
+    handler = RotatingFileHandler(os.path.join(baseDir, Config.SUPERVISOR_LOG), maxBytes=Config.LOGGING_BYTES,
+                                  backupCount=Config.LOGGING_ROTATION)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+
+    supervisor = Supervisor([sys.executable, os.path.join(baseDir, 'weather_pi.py')] + sys.argv[1:],
+                            Config.HEARTBEAT_TIMEOUT, Config.HEARTBEAT_STARTUP, Config.SUPERVISOR_GRACE,
+                            Config.SUPERVISOR_BACKOFF, Config.SUPERVISOR_BACKOFF_MAX, Config.SUPERVISOR_STABLE,
+                            os.path.join(baseDir, Config.SUPERVISOR_METRICS_PATH), Config.METRICS_INTERVAL, logger)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    supervisor.run()
+
+if __name__ == "__main__":
+    main()
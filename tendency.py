@@ -0,0 +1,158 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - barometric tendency
+
+    Keeps a bounded ring of pressure samples and, for each window (1 & 3 hours by default), the running
+    sums of a least squares line through the samples in that window. A new sample is added to every
+    window and the samples that fell out of a window are subtracted, so the slope in hPa/h costs O(1)
+    per sample however long the window. The 3 hour change & the shape of the curve give the WMO pressure
+    tendency characteristic (code table 0200).
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+from array import array
+
+# WMO code table 0200 - characteristic of pressure tendency during the three hours preceding
+WMO_TENDENCY = {
+    0: 'Increasing, then decreasing',
+    1: 'Increasing, then steady; or increasing, then increasing more slowly',
+    2: 'Increasing (steadily or unsteadily)',
+    3: 'Decreasing or steady, then increasing; or increasing, then increasing more rapidly',
+    4: 'Steady',
+    5: 'Decreasing, then increasing',
+    6: 'Decreasing, then steady; or decreasing, then decreasing more slowly',
+    7: 'Decreasing (steadily or unsteadily)',
+    8: 'Steady or increasing, then decreasing; or decreasing, then decreasing more rapidly',
+}
+
+REBASE_HOURS = 1000.0       # shift the time origin this often to keep the sums well conditioned
+
+
+class Window(object):
+    __slots__ = ('span', 'tail', 'n', 'st', 'sp', 'stt', 'stp')
+
+    def __init__(self, span):
+        self.span = span        # hours
+        self.tail = 0           # absolute index of the oldest sample in the window
+        self.n = 0
+        self.st = self.sp = self.stt = self.stp = 0.0
+
+    def add(self, t, p):
+        self.n += 1
+        self.st += t
+        self.sp += p
+        self.stt += t * t
+        self.stp += t * p
+
+    def remove(self, t, p):
+        self.n -= 1
+        self.st -= t
+        self.sp -= p
+        self.stt -= t * t
+        self.stp -= t * p
+
+    def slope(self):
+        # least squares slope in hPa/h, None with fewer than 2 samples
+        if self.n < 2: return None
+        den = self.n * self.stt - self.st * self.st
+        if den <= 0: return None
+        return (self.n * self.stp - self.st * self.sp) / den
+
+
+class Tendency(object):
+
+    def __init__(self, windows=(1.0, 3.0), interval=5.0, steady=0.1, coverage=0.5):
+        self.spans = tuple(sorted(windows))     # hours
+        self.steady = steady                    # hPa/h below which pressure counts as steady
+        self.coverage = coverage                # part of a window that must hold samples before it reports
+        self.capacity = int(self.spans[-1] * 3600 / interval * 1.1) + 2
+        self.times = array('d', [0.0] * self.capacity)
+        self.values = array('d', [0.0] * self.capacity)
+        self.windows = [Window(span) for span in self.spans]
+        self.head = 0           # absolute index of the next sample
+        self.base = None        # seconds, time origin of the stored samples
+
+    def add(self, t, p):
+        # t in seconds (monotonic), p in hPa
+        if self.base is None:
+            self.base = t
+        th = (t - self.base) / 3600.0
+        if th > REBASE_HOURS:
+            self._rebase(t)
+            th = (t - self.base) / 3600.0
+        # make room if samples arrive faster than the ring was sized for
+        oldest = min(w.tail for w in self.windows)
+        if self.head - oldest >= self.capacity:
+            i = oldest % self.capacity
+            for w in self.windows:
+                if w.tail == oldest:
+                    w.remove(self.times[i], self.values[i])
+                    w.tail += 1
+        i = self.head % self.capacity
+        self.times[i] = th
+        self.values[i] = p
+        self.head += 1
+        for w in self.windows:
+            w.add(th, p)
+            while w.tail < self.head and self.times[w.tail % self.capacity] < th - w.span:
+                j = w.tail % self.capacity
+                w.remove(self.times[j], self.values[j])
+                w.tail += 1
+
+    def _rebase(self, t):
+        # move the time origin to now & rebuild the sums from the ring, once every REBASE_HOURS
+        shift = (t - self.base) / 3600.0
+        self.base = t
+        for k in range(min(self.windows, key=lambda w: w.tail).tail, self.head):
+            self.times[k % self.capacity] -= shift
+        for w in self.windows:
+            tail = w.tail
+            w.__init__(w.span)
+            w.tail = tail
+            for k in range(tail, self.head):
+                w.add(self.times[k % self.capacity], self.values[k % self.capacity])
+
+    def slope(self, span):
+        # hPa/h over the window of span hours, None until the window is covered well enough
+        w = self.windows[self.spans.index(span)]
+        if w.n < 2: return None
+        newest = self.times[(self.head - 1) % self.capacity]
+        oldest = self.times[w.tail % self.capacity]
+        if newest - oldest < w.span * self.coverage: return None
+        return w.slope()
+
+    def trend(self):
+        # 'up', 'down' or 'steady' from the shortest window, for the LED
+        s = self.slope(self.spans[0])
+        if s is None or abs(s) < self.steady: return 'steady'
+        return 'up' if s > 0 else 'down'
+
+    def wmo_code(self):
+        # WMO 0200 characteristic from the longest window's change & the shortest window's recent slope
+        long_slope = self.slope(self.spans[-1])
+        short_slope = self.slope(self.spans[0])
+        if long_slope is None or short_slope is None: return None
+        change = long_slope * self.spans[-1]
+        steady_change = self.steady * self.spans[-1]
+        if abs(change) < steady_change:
+            if short_slope > self.steady: return 3
+            if short_slope < -self.steady: return 8
+            return 4
+        if change > 0:
+            if short_slope < -self.steady: return 0
+            if short_slope < self.steady: return 1
+            if short_slope > long_slope * 1.5: return 3
+            return 2
+        if short_slope > self.steady: return 5
+        if short_slope > -self.steady: return 6
+        if short_slope < long_slope * 1.5: return 8
+        return 7
+
+    def summary(self):
+        result = {'trend': self.trend(), 'code': self.wmo_code()}
+        for span in self.spans:
+            s = self.slope(span)
+            result['slope_%gh' % span] = round(s, 3) if s is not None else None
+        long_slope = self.slope(self.spans[-1])
+        result['change_%gh' % self.spans[-1]] = round(long_slope * self.spans[-1], 2) if long_slope is not None else None
+        return result
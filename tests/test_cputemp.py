@@ -0,0 +1,207 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - CPU temperature tests
+
+    CpuTemp against a fake /sys/class/thermal in a temporary directory: normal reads through the held
+    descriptor, slow reads (each read delayed by SLOW_DELAYS seconds) & a zone or file that isn't there.
+
+        python -m pytest tests
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, baseDir)
+
+import cputemp
+from cputemp import CpuTemp, find_zone
+
+SLOW_DELAYS = (0.05, 0.25)      # seconds a slow read takes
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SlowCpuTemp(CpuTemp):
+    # every sysfs read takes delay seconds, charged to the fake clock as well
+
+    def __init__(self, delay, *args, **kwargs):
+        CpuTemp.__init__(self, *args, **kwargs)
+        self.delay = delay
+
+    def read_sysfs(self):
+        time.sleep(self.delay)
+        self.clock.now += self.delay
+        return CpuTemp.read_sysfs(self)
+
+
+class CpuTempTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='weatherpi-sysfs-')
+        self.pattern = os.path.join(self.root, 'thermal_zone*')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def zone(self, name, kind, millidegrees=None):
+        path = os.path.join(self.root, name)
+        os.mkdir(path)
+        with open(os.path.join(path, 'type'), 'w') as f:
+            f.write(kind + '\n')
+        if millidegrees is not None: self.write(name, millidegrees)
+        return os.path.join(path, 'temp')
+
+    def write(self, name, millidegrees):
+        # rewritten in place like sysfs, the open descriptor sees the new value
+        with open(os.path.join(self.root, name, 'temp'), 'w') as f:
+            f.write('%d\n' % millidegrees)
+
+    # ------------------------------------------------------------------
+    # normal reads
+    # ------------------------------------------------------------------
+    def test_find_zone_prefers_the_cpu(self):
+        self.zone('thermal_zone0', 'gpu-thermal', 40000)
+        path = self.zone('thermal_zone1', 'cpu-thermal', 50000)
+        self.assertEqual(find_zone(self.pattern), path)
+
+    def test_find_zone_falls_back_to_the_first_with_a_temp(self):
+        self.zone('thermal_zone0', 'soc')
+        path = self.zone('thermal_zone1', 'soc', 45000)
+        self.assertEqual(find_zone(self.pattern), path)
+
+    def test_reads_millidegrees(self):
+        path = self.zone('thermal_zone0', 'cpu-thermal', 48312)
+        cpu = CpuTemp(5.0, path, self.clock)
+        try:
+            self.assertEqual(cpu.source, 'sysfs')
+            self.assertEqual(cpu.get(), 48.312)
+            self.assertEqual(cpu.reads, 1)
+        finally:
+            cpu.close()
+
+    def test_cached_for_max_age(self):
+        path = self.zone('thermal_zone0', 'cpu-thermal', 48000)
+        cpu = CpuTemp(5.0, path, self.clock)
+        try:
+            self.assertEqual(cpu.get(), 48.0)
+            self.write('thermal_zone0', 51500)
+            self.clock.now += 5.0
+            self.assertEqual(cpu.get(), 48.0)
+            self.assertEqual(cpu.reads, 1)
+            self.clock.now += 0.1
+            self.assertEqual(cpu.get(), 51.5)
+            self.assertEqual(cpu.reads, 2)
+        finally:
+            cpu.close()
+
+    def test_python2_fallback_rereads_from_the_start(self):
+        path = self.zone('thermal_zone0', 'cpu-thermal', 47000)
+        pread = getattr(os, 'pread', None)
+        if pread is not None: del os.pread
+        cpu = CpuTemp(0.0, path, self.clock)
+        try:
+            self.assertEqual(cpu.read(), 47.0)
+            self.write('thermal_zone0', 49000)
+            self.assertEqual(cpu.read(), 49.0)
+        finally:
+            cpu.close()
+            if pread is not None: os.pread = pread
+
+    # ------------------------------------------------------------------
+    # slow reads
+    # ------------------------------------------------------------------
+    def test_slow_reads_are_cached(self):
+        for delay in SLOW_DELAYS:
+            path = os.path.join(self.root, 'thermal_zone0', 'temp')
+            if not os.path.exists(path): path = self.zone('thermal_zone0', 'cpu-thermal', 52000)
+            cpu = SlowCpuTemp(delay, 1.0, path, self.clock)
+            try:
+                started = time.time()
+                self.assertEqual(cpu.get(), 52.0)
+                self.assertTrue(time.time() - started >= delay)
+                # the samples within max_age of the read don't wait on the sensor again
+                started = time.time()
+                for i in range(10):
+                    self.assertEqual(cpu.get(), 52.0)
+                self.assertTrue(time.time() - started < delay)
+                self.assertEqual(cpu.reads, 1)
+            finally:
+                cpu.close()
+
+    def test_slow_read_longer_than_max_age(self):
+        # a read slower than max_age still serves its value, the next get() reads again
+        delay = SLOW_DELAYS[-1]
+        path = self.zone('thermal_zone0', 'cpu-thermal', 53000)
+        cpu = SlowCpuTemp(delay, delay / 2, path, self.clock)
+        try:
+            self.assertEqual(cpu.get(), 53.0)
+            self.clock.now += delay
+            self.assertEqual(cpu.get(), 53.0)
+            self.assertEqual(cpu.reads, 2)
+        finally:
+            cpu.close()
+
+    # ------------------------------------------------------------------
+    # missing file
+    # ------------------------------------------------------------------
+    def test_no_zones(self):
+        self.assertEqual(find_zone(self.pattern), None)
+
+    def test_missing_file_uses_vcgencmd(self):
+        calls = []
+
+        def vcgencmd():
+            calls.append(1)
+            return 55.5
+        saved = cputemp.read_vcgencmd
+        cputemp.read_vcgencmd = vcgencmd
+        try:
+            # a cpu zone without its temp file, or a path that was never there
+            self.zone('thermal_zone0', 'cpu-thermal')
+            for path in (find_zone(self.pattern), os.path.join(self.root, 'thermal_zone9', 'temp')):
+                cpu = CpuTemp(5.0, path, self.clock)
+                self.assertEqual(cpu.source, 'vcgencmd')
+                self.assertEqual(cpu.fd, None)
+                self.assertEqual(cpu.get(), 55.5)
+                cpu.close()
+            self.assertEqual(len(calls), 2)
+        finally:
+            cputemp.read_vcgencmd = saved
+
+    def test_file_removed_after_open(self):
+        # the held descriptor keeps reading the file it opened
+        path = self.zone('thermal_zone0', 'cpu-thermal', 46000)
+        cpu = CpuTemp(0.0, path, self.clock)
+        try:
+            shutil.rmtree(os.path.join(self.root, 'thermal_zone0'))
+            self.assertEqual(cpu.read(), 46.0)
+        finally:
+            cpu.close()
+
+    def test_unreadable_value(self):
+        path = self.zone('thermal_zone0', 'cpu-thermal')
+        with open(path, 'w') as f:
+            f.write('')
+        cpu = CpuTemp(0.0, path, self.clock)
+        try:
+            self.assertRaises(ValueError, cpu.read)
+        finally:
+            cpu.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - 1-Wire probe tests
+
+    ProbeReader against a fake /sys/bus/w1/devices in a temporary directory, its reads delayed by a reader
+    that sleeps READ_DELAY seconds (the DS18B20 conversion time, shortened): the parallel refresh, the bulk
+    conversion path, the max_age staleness, the 85.0 power on value & unreadable or garbled files.
+
+        python -m pytest tests
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, baseDir)
+
+from probes import ProbeReader, discover, read_file, PROBE_OK, PROBE_STALE, PROBE_POWER_ON, PROBE_ERROR
+
+READ_DELAY = 0.2        # seconds per probe read
+
+PROBES = ['28-000000000001', '28-000000000002', '28-000000000003', '28-000000000004']
+
+
+def w1_slave(millidegrees, crc='YES'):
+    return ('72 01 4b 46 7f ff 0e 10 57 : crc=57 %s\n'
+            '72 01 4b 46 7f ff 0e 10 57 t=%s\n' % (crc, millidegrees))
+
+
+class DelayedReader(object):
+    # read_file, delay seconds a read & counting them by file name
+
+    def __init__(self, delay=READ_DELAY):
+        self.delay = delay
+        self.reads = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, path):
+        with self._lock:
+            name = os.path.basename(path)
+            self.reads[name] = self.reads.get(name, 0) + 1
+        time.sleep(self.delay)
+        return read_file(path)
+
+
+class ProbeReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='weatherpi-w1-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def probe(self, probe, millidegrees, crc='YES', temperature=None):
+        path = os.path.join(self.root, probe)
+        if not os.path.isdir(path): os.mkdir(path)
+        with open(os.path.join(path, 'w1_slave'), 'w') as f:
+            f.write(w1_slave(millidegrees, crc))
+        if temperature is not None:
+            with open(os.path.join(path, 'temperature'), 'w') as f:
+                f.write('%s\n' % temperature)
+
+    def reader(self, delay=READ_DELAY, **kwargs):
+        reader = ProbeReader(self.root, reader=DelayedReader(delay), **kwargs)
+        self.addCleanup(reader.stop)
+        return reader
+
+    # ------------------------------------------------------------------
+    # discovery & parallel reads
+    # ------------------------------------------------------------------
+    def test_discovers_ds18b20s(self):
+        for n, probe in enumerate(PROBES):
+            self.probe(probe, 20000 + n)
+        os.mkdir(os.path.join(self.root, '10-000000000009'))       # a DS18S20, another family
+        os.mkdir(os.path.join(self.root, 'w1_bus_master1'))
+        self.assertEqual(discover(self.root), PROBES)
+
+    def test_parallel_refresh(self):
+        for n, probe in enumerate(PROBES):
+            self.probe(probe, 20000 + n * 1000)
+        reader = self.reader()
+        self.assertEqual(reader.scan(), PROBES)
+        started = time.time()
+        reader.refresh()
+        elapsed = time.time() - started
+        # the reads overlap, about one read's time rather than one per probe
+        self.assertTrue(READ_DELAY <= elapsed < READ_DELAY * 2.5, elapsed)
+        self.assertEqual(reader.reader.reads, {'w1_slave': len(PROBES)})
+        for n, probe in enumerate(PROBES):
+            reading = reader.get(probe)
+            self.assertEqual((reading['status'], reading['celcius']), (PROBE_OK, 20.0 + n))
+        self.assertFalse(reader.bulk)
+
+    def test_get_never_blocks(self):
+        self.probe(PROBES[0], 21500)
+        reader = self.reader(delay=1.0, interval=5.0)
+        reader.start()
+        started = time.time()
+        reading = reader.get(PROBES[0])
+        self.assertTrue(time.time() - started < 0.1)
+        self.assertEqual(reading['status'], PROBE_STALE)       # nothing read yet
+
+    # ------------------------------------------------------------------
+    # bulk conversion
+    # ------------------------------------------------------------------
+    def test_bulk_path(self):
+        for n, probe in enumerate(PROBES):
+            self.probe(probe, 0, temperature=18000 + n * 500)
+        os.mkdir(os.path.join(self.root, 'w1_bus_master1'))
+        with open(os.path.join(self.root, 'w1_bus_master1', 'therm_bulk_read'), 'w') as f:
+            f.write('1\n')
+        reader = self.reader()
+        reader.scan()
+        self.assertTrue(reader.bulk)
+        reader.refresh()
+        # one conversion on the bus, then only the temperature attributes are read
+        self.assertEqual(reader.reader.reads.get('w1_slave'), None)
+        self.assertEqual(reader.reader.reads['temperature'], len(PROBES))
+        for n, probe in enumerate(PROBES):
+            self.assertEqual(reader.get(probe)['celcius'], 18.0 + n * 0.5)
+
+    def test_bulk_conversion_still_running(self):
+        # a bus master that never finishes its conversion falls back to reading each probe's w1_slave
+        self.probe(PROBES[0], 19000, temperature=99000)
+        os.mkdir(os.path.join(self.root, 'w1_bus_master1'))
+        path = os.path.join(self.root, 'w1_bus_master1', 'therm_bulk_read')
+        reader = self.reader(delay=0.0)
+
+        def busy(name):
+            return '-1\n' if name == path else read_file(name)
+        reader.reader = busy
+        reader.scan()
+        reader.refresh()
+        self.assertEqual(reader.get(PROBES[0])['celcius'], 19.0)
+
+    # ------------------------------------------------------------------
+    # staleness & bad readings
+    # ------------------------------------------------------------------
+    def test_max_age(self):
+        self.probe(PROBES[0], 22000)
+        reader = self.reader(delay=0.0, max_age=0.2)
+        reader.scan()
+        reader.refresh()
+        self.assertEqual(reader.get(PROBES[0])['status'], PROBE_OK)
+        time.sleep(0.3)
+        reading = reader.get(PROBES[0])
+        self.assertEqual(reading['status'], PROBE_STALE)
+        self.assertEqual(reading['celcius'], 22.0)               # the last value, for what it's worth
+        self.assertTrue(reading['age'] > 0.2)
+
+    def test_failed_read_keeps_the_last_good_value(self):
+        self.probe(PROBES[0], 23000)
+        reader = self.reader(delay=0.0, max_age=0.2)
+        reader.scan()
+        reader.refresh()
+        self.probe(PROBES[0], 99999, crc='NO')
+        reader.refresh()
+        self.assertEqual(reader.get(PROBES[0])['celcius'], 23.0)
+        time.sleep(0.3)
+        self.assertEqual(reader.get(PROBES[0])['status'], PROBE_STALE)
+
+    def test_power_on_value(self):
+        self.probe(PROBES[0], 85000)
+        reader = self.reader(delay=0.0)
+        reader.scan()
+        reader.refresh()
+        reading = reader.get(PROBES[0])
+        self.assertEqual((reading['status'], reading['celcius']), (PROBE_POWER_ON, 85.0))
+
+    def test_garbled_value_is_that_probes_error(self):
+        self.probe(PROBES[0], '2l5')            # a garbled t= line
+        self.probe(PROBES[1], '')               # truncated
+        self.probe(PROBES[2], 24000)
+        reader = self.reader(delay=0.0)
+        reader.scan()
+        reader.refresh()
+        self.assertEqual(reader.get(PROBES[0])['status'], PROBE_ERROR)
+        self.assertEqual(reader.get(PROBES[1])['status'], PROBE_ERROR)
+        self.assertEqual(reader.get(PROBES[2])['status'], PROBE_OK)
+        self.assertEqual(reader.failures, 0)
+
+    def test_missing_probe(self):
+        reader = self.reader(delay=0.0, probes=[PROBES[0]])
+        reader.scan()
+        reader.refresh()
+        self.assertEqual(reader.get(PROBES[0])['status'], PROBE_ERROR)
+
+    def test_failed_refresh_is_counted(self):
+        self.probe(PROBES[0], 25000)
+
+        def broken(path):
+            raise RuntimeError('bus gone')
+        reader = self.reader(delay=0.0, interval=0.05)
+        reader.reader = broken
+        reader.start()
+        deadline = time.time() + 5
+        while not reader.failures and time.time() < deadline:
+            time.sleep(0.01)
+        reader.stop()
+        self.assertTrue(reader.failures >= 1)
+        self.assertEqual(reader.stats()['last_error'], 'bus gone')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,317 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - sink tests
+
+    Each sink (sinks.py) through its worker against a local stand in: a stub MQTT broker that accepts or
+    refuses the connection, the stub HTTP server of benchmarks/bench_tick.py answering 200 or 500 for
+    InfluxDB, and a file in a temporary directory or one that doesn't exist. Then the worker's bounded
+    queue, with a health probe waiting while it is full.
+
+        python -m pytest tests
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, baseDir)
+sys.path.insert(0, os.path.join(baseDir, 'benchmarks'))
+
+from sinks import FileSink, InfluxSink, MqttSink, line_protocol, make_sink, CONNECT, CONNACK, PUBLISH, DISCONNECT
+from bench_tick import StubServer
+from uploader import Sink
+
+RECORDS = [{'time': 1538300000 + i * 60, 'station': 'home', 'pid': '28-0417a2d9f9ff', 't': 12.4 + i, 'rh': 61.2}
+           for i in range(3)]
+
+
+def deliver(sink, records, timeout=10.0):
+    # every record through the sink's worker, the results once it has sent them all - the full batches
+    # (retries included) before it is stopped, the part batch left over by the flush on stop
+    sink.start()
+    for record in records:
+        sink.submit(record)
+    full = len(records) // sink.batch_size * sink.batch_size
+    deadline = time.time() + timeout
+    while sink.sent + sink.failed < full and time.time() < deadline:
+        time.sleep(0.01)
+    sink.stop(timeout, flush=True)
+    return sink.results()
+
+
+def closed_port():
+    # a local port nothing listens on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# ============================================================================
+# stub MQTT broker
+# ============================================================================
+class StubBroker(object):
+    # answers CONNECT with CONNACK & return code (0 accepted, 5 not authorized) & keeps what it's sent
+
+    def __init__(self, code=0):
+        self.code = code
+        self.connects = []              # CONNECT payloads
+        self.published = []             # (topic, payload)
+        self.disconnects = 0
+        self.done = threading.Event()   # a session has ended
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'mqtt://127.0.0.1:%d' % self.sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, name='StubBroker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except (socket.error, OSError):
+                return
+            try:
+                self._session(conn)
+            finally:
+                conn.close()
+                self.done.set()
+
+    def _read(self, conn, size):
+        data = b''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk: raise EOFError
+            data += chunk
+        return data
+
+    def _packet(self, conn):
+        kind = bytearray(self._read(conn, 1))[0]
+        length, shift = 0, 0
+        while True:
+            byte = bytearray(self._read(conn, 1))[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80: break
+        return kind, self._read(conn, length)
+
+    def _session(self, conn):
+        try:
+            kind, payload = self._packet(conn)
+            if kind != CONNECT: return
+            self.connects.append(payload)
+            conn.sendall(struct.pack('!BBBB', CONNACK, 2, 0, self.code))
+            if self.code: return
+            while True:
+                kind, payload = self._packet(conn)
+                if kind & 0xf0 == PUBLISH:
+                    size = struct.unpack('!H', payload[:2])[0]
+                    self.published.append((payload[2:2 + size].decode('utf-8'), payload[2 + size:]))
+                elif kind == DISCONNECT:
+                    self.disconnects += 1
+                    return
+        except (EOFError, socket.error):
+            pass
+
+
+class MqttSinkTest(unittest.TestCase):
+
+    def test_publishes_each_reading(self):
+        broker = StubBroker()
+        try:
+            sink = MqttSink('mqtt', broker.url, 'weatherpi/test', client_id='test', retries=0)
+            results = deliver(sink, RECORDS)
+            self.assertTrue(broker.done.wait(5.0))
+            self.assertEqual([result.ok for result in results], [True] * len(RECORDS))
+            self.assertEqual(broker.disconnects, 1)
+            self.assertEqual(len(broker.connects), 1)        # one connection kept for every reading
+            self.assertEqual([topic for topic, payload in broker.published], ['weatherpi/test'] * len(RECORDS))
+            self.assertEqual([json.loads(payload.decode('utf-8')) for topic, payload in broker.published], RECORDS)
+            self.assertEqual(sink.stats()['sent'], len(RECORDS))
+        finally:
+            broker.close()
+
+    def test_credentials_in_the_url(self):
+        broker = StubBroker()
+        try:
+            sink = MqttSink('mqtt', broker.url.replace('mqtt://', 'mqtt://user:secret@'), client_id='test')
+            results = deliver(sink, RECORDS[:1])
+            self.assertTrue(broker.done.wait(5.0))
+            self.assertTrue(results[0].ok)
+            self.assertTrue(b'user' in broker.connects[0] and b'secret' in broker.connects[0])
+        finally:
+            broker.close()
+
+    def test_refused_connection(self):
+        broker = StubBroker(code=5)
+        try:
+            sink = MqttSink('mqtt', broker.url, client_id='test', retries=0)
+            results = deliver(sink, RECORDS[:1])
+            self.assertFalse(results[0].ok)
+            self.assertTrue(issubclass(results[0].error, IOError))
+            self.assertEqual(sink.stats()['failed'], 1)
+        finally:
+            broker.close()
+
+    def test_no_broker(self):
+        sink = MqttSink('mqtt', 'mqtt://127.0.0.1:%d' % closed_port(), timeout=1.0, retries=0)
+        results = deliver(sink, RECORDS[:1])
+        self.assertFalse(results[0].ok)
+        self.assertTrue(results[0].error is not None)
+        self.assertRaises(socket.error, sink.check)
+
+
+# ============================================================================
+# InfluxDB against the bench stub server
+# ============================================================================
+class InfluxSinkTest(unittest.TestCase):
+
+    def server(self, failure):
+        server = StubServer(0.0, failure)
+        server.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_written(self):
+        server = self.server(0.0)
+        sink = InfluxSink('influx', server.url + '/write?db=weather', batch_size=2, retries=0)
+        results = deliver(sink, RECORDS)
+        self.assertEqual([result.ok for result in results], [True] * len(RECORDS))
+        self.assertEqual(server.requests, 2)                # a full batch & the part batch flushed on stop
+        self.assertTrue(sink.check())
+
+    def test_server_error(self):
+        server = self.server(1.0)
+        sink = InfluxSink('influx', server.url + '/write?db=weather', batch_size=1, retries=1, retry_wait=0.01)
+        results = deliver(sink, RECORDS[:1])
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].status, 500)
+        self.assertEqual(server.requests, 2)                # the retry
+        self.assertEqual(sink.stats()['retries'], 1)
+
+    def test_no_server(self):
+        sink = InfluxSink('influx', 'http://127.0.0.1:%d/write?db=weather' % closed_port(), connect_timeout=1.0,
+                          retries=0)
+        results = deliver(sink, RECORDS[:1])
+        self.assertFalse(results[0].ok)
+        self.assertTrue(results[0].error is not None)
+
+    def test_line_protocol(self):
+        self.assertEqual(line_protocol('weather', RECORDS[0]),
+                         'weather,pid=28-0417a2d9f9ff,station=home rh=61.2,t=12.4 1538300000000000000')
+        self.assertEqual(line_protocol('weather', {'station': 'my home', 'on': True, 'x': None}),
+                         'weather,station=my\\ home on=true')
+
+
+# ============================================================================
+# file
+# ============================================================================
+class FileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='weatherpi-sinks-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_appends_json_lines(self):
+        path = os.path.join(self.root, 'readings.jsonl')
+        sink = make_sink({'kind': 'file', 'path': path, 'batch': 2})
+        self.assertTrue(isinstance(sink, FileSink))
+        results = deliver(sink, RECORDS)
+        self.assertEqual([result.ok for result in results], [True] * len(RECORDS))
+        with open(path) as f:
+            self.assertEqual([json.loads(line) for line in f], RECORDS)
+        self.assertTrue(sink.check())
+
+    def test_missing_directory(self):
+        path = os.path.join(self.root, 'gone', 'readings.jsonl')
+        sink = FileSink('file', path, batch_size=1)
+        results = deliver(sink, RECORDS[:1])
+        self.assertFalse(results[0].ok)
+        self.assertTrue(issubclass(results[0].error, (IOError, OSError)))
+        self.assertFalse(sink.check())
+
+
+# ============================================================================
+# the worker's queue
+# ============================================================================
+class GatedSink(Sink):
+    # sends once the gate opens, so uploads pile up behind the first
+
+    def __init__(self, queue_size):
+        Sink.__init__(self, 'gated', queue_size)
+        self.gate = threading.Event()
+        self.sending = threading.Event()
+        self.batches = []
+        self.checks = 0
+
+    def send(self, batch):
+        self.sending.set()
+        self.gate.wait(10)
+        self.batches.append([result.params for result in batch])
+        return True, 200, 'ok'
+
+    def check(self):
+        self.checks += 1
+        return True
+
+
+class SinkQueueTest(unittest.TestCase):
+
+    def test_probe_survives_a_full_queue(self):
+        sink = GatedSink(queue_size=2)
+        sink.start()
+        sink.submit({'n': 0})
+        self.assertTrue(sink.sending.wait(5))        # the worker is held up sending it
+        sink.submit({'n': 1})
+        sink.submit({'n': 2})
+        sink.probe()
+        dropped = sink.submit({'n': 3})             # the queue is full, the oldest reading makes room
+        self.assertEqual(dropped.params, {'n': 1})
+        sink.gate.set()
+        deadline = time.time() + 5
+        while len(sink.batches) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        sink.stop()
+        results = sink.results()
+        self.assertEqual(sink.batches, [[{'n': 0}], [{'n': 2}], [{'n': 3}]])
+        self.assertEqual(sink.checks, 1)
+        self.assertEqual([result.probe for result in results], [False, True, False, False])
+        self.assertEqual(sink.dropped, 1)
+
+    def test_probes_while_one_waits(self):
+        sink = GatedSink(queue_size=2)
+        sink.start()
+        sink.submit({'n': 0})
+        self.assertTrue(sink.sending.wait(5))
+        sink.probe()
+        sink.probe()
+        sink.gate.set()
+        deadline = time.time() + 5
+        while not sink.checks and time.time() < deadline:
+            time.sleep(0.01)
+        sink.stop()
+        self.assertEqual(sink.checks, 1)
+        self.assertEqual(sink.stop(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
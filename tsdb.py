@@ -0,0 +1,202 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - local time series store
+
+    Keeps the station's history on the Pi in a SQLite file. Samples are buffered in memory and written in
+    one transaction every flush_interval seconds to spare the SD card. 1 minute, 15 minute & hourly
+    rollups (n/min/max/avg/sd) are built incrementally as samples arrive, and every resolution has its
+    own retention so a year of history stays a few MB. Tables are keyed on (metric, time) so a range
+    query is a single index range scan. With a Compression (compress.py) only the points it keeps go to
+    the raw samples, the rollups still see every sample.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import math
+import sqlite3
+import threading
+import time
+
+from aggregate import RunningStats
+
+RAW = 0                             # resolution of the raw samples
+ROLLUPS = (60, 900, 3600)           # seconds per rollup bucket
+
+DAY = 86400
+RETENTION = {RAW: 2 * DAY,          # seconds of history kept per resolution
+             60: 30 * DAY,
+             900: 365 * DAY,
+             3600: 2 * 365 * DAY}
+
+
+def combine(a, b):
+    # merge two (n, min, max, avg, sd) rollups of the same bucket
+    n = a[0] + b[0]
+    if not a[0]: return b
+    if not b[0]: return a
+    avg = (a[0] * a[3] + b[0] * b[3]) / n
+    m2 = (a[4] ** 2) * (a[0] - 1) + (b[4] ** 2) * (b[0] - 1) + ((b[3] - a[3]) ** 2) * a[0] * b[0] / n
+    sd = math.sqrt(m2 / (n - 1)) if n > 1 else 0.0
+    return (n, min(a[1], b[1]), max(a[2], b[2]), avg, sd)
+
+
+class TimeSeriesStore(object):
+
+    def __init__(self, path, retention=None, flush_interval=60, clock=time.time, compression=None):
+        self.path = path
+        self.retention = dict(RETENTION)
+        if retention: self.retention.update(retention)
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.compression = compression
+        self.flushes = 0
+        self.rows_written = 0
+        self._lock = threading.Lock()
+        self._samples = []              # raw rows waiting for the next flush
+        self._rollups = []              # closed buckets waiting for the next flush
+        self._open = {}                 # (resolution, metric) -> [bucket start, RunningStats]
+        self._resumed = set()           # buckets that may already be partly on disk from a previous run
+        self._last_flush = clock()
+        self._last_prune = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS samples ('
+                         ' metric TEXT NOT NULL, ts INTEGER NOT NULL, value REAL NOT NULL,'
+                         ' PRIMARY KEY (metric, ts)) WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS rollups ('
+                         ' resolution INTEGER NOT NULL, metric TEXT NOT NULL, ts INTEGER NOT NULL,'
+                         ' n INTEGER NOT NULL, min REAL, max REAL, avg REAL, sd REAL,'
+                         ' PRIMARY KEY (resolution, metric, ts)) WITHOUT ROWID')
+        self._db.commit()
+
+    # ------------------------------------------------------------------
+    # writing
+    # ------------------------------------------------------------------
+    def add(self, ts, values):
+        # values: {metric: number} sampled at ts (epoch seconds)
+        ts = int(ts)
+        with self._lock:
+            if self.compression is not None:
+                self._samples.extend(self.compression.add(ts, values))
+            else:
+                self._samples.extend((metric, ts, x) for metric, x in values.items())
+            for metric, x in values.items():
+                for resolution in ROLLUPS:
+                    bucket = ts - ts % resolution
+                    key = (resolution, metric)
+                    current = self._open.get(key)
+                    if current is None:
+                        current = self._open[key] = [bucket, RunningStats()]
+                        self._resumed.add((resolution, metric, bucket))
+                    elif current[0] != bucket:
+                        self._close_bucket(key, current)
+                        current[0] = bucket
+                    current[1].add(x)
+        if self.clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _close_bucket(self, key, current):
+        stats = current[1]
+        if stats.n:
+            self._rollups.append((key[0], key[1], current[0], stats.n, stats.min, stats.max, stats.mean, stats.sd()))
+        stats.reset()
+
+    def flush(self, partial=False):
+        # write everything buffered in one transaction, partial=True also writes the open buckets (shutdown)
+        with self._lock:
+            if partial:
+                # the samples the compression is still holding back
+                if self.compression is not None: self._samples.extend(self.compression.flush())
+                for key, current in self._open.items():
+                    self._close_bucket(key, current)
+                    self._resumed.add((key[0], key[1], current[0]))
+            samples, self._samples = self._samples, []
+            rollups, self._rollups = self._rollups, []
+            self._last_flush = self.clock()
+            with self._db:
+                if samples:
+                    self._db.executemany('INSERT OR REPLACE INTO samples (metric, ts, value) VALUES (?, ?, ?)', samples)
+                if rollups:
+                    self._db.executemany('INSERT OR REPLACE INTO rollups (resolution, metric, ts, n, min, max, avg, sd)'
+                                         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [self._merge(row) for row in rollups])
+                if self._last_flush - self._last_prune >= 3600:
+                    self._prune(self._last_flush)
+            self.flushes += 1
+            self.rows_written += len(samples) + len(rollups)
+
+    def rewrite(self, resolution, rows, start=None, end=None):
+        # replace stored points in one transaction, e.g. recomputed derived metrics (see derived.py)
+        # raw rows are (metric, ts, value), rollup rows (metric, ts, n, min, max, avg, sd). With start & end
+        # the raw samples of the rows' metrics in that range go first, compressed points needn't fall on
+        # the old ones' times
+        with self._lock:
+            with self._db:
+                if resolution == RAW:
+                    if start is not None:
+                        self._db.executemany('DELETE FROM samples WHERE metric=? AND ts>=? AND ts<=?',
+                                             [(metric, int(start), int(end)) for metric in set(row[0] for row in rows)])
+                    self._db.executemany('INSERT OR REPLACE INTO samples (metric, ts, value) VALUES (?, ?, ?)', rows)
+                else:
+                    self._db.executemany('INSERT OR REPLACE INTO rollups (resolution, metric, ts, n, min, max, avg, sd)'
+                                         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(resolution,) + tuple(row) for row in rows])
+            self.rows_written += len(rows)
+
+    def _merge(self, row):
+        # a bucket cut short by a restart is combined with what the previous run stored
+        key = (row[0], row[1], row[2])
+        if key not in self._resumed:
+            return row
+        self._resumed.discard(key)
+        old = self._db.execute('SELECT n, min, max, avg, sd FROM rollups WHERE resolution=? AND metric=? AND ts=?', key).fetchone()
+        if old is None:
+            return row
+        return key + combine(tuple(old), row[3:])
+
+    def _prune(self, now):
+        self._last_prune = now
+        self._db.execute('DELETE FROM samples WHERE ts < ?', (int(now - self.retention[RAW]),))
+        for resolution in ROLLUPS:
+            self._db.execute('DELETE FROM rollups WHERE resolution=? AND ts < ?', (resolution, int(now - self.retention[resolution])))
+
+    def close(self):
+        self.flush(partial=True)
+        with self._lock:
+            self._db.close()
+
+    # ------------------------------------------------------------------
+    # reading
+    # ------------------------------------------------------------------
+    def pick_resolution(self, start, end, max_points=1000):
+        # finest resolution that still holds start & returns no more than max_points per metric
+        age = self.clock() - start
+        for resolution in (RAW,) + ROLLUPS:
+            if age > self.retention[resolution]:
+                continue
+            if (end - start) / float(resolution or 5) <= max_points:
+                return resolution
+        return ROLLUPS[-1]
+
+    def query(self, metric, start, end, resolution=None):
+        # raw: [(ts, value)], rollups: [(ts, n, min, max, avg, sd)], oldest first, including unflushed data
+        start, end = int(start), int(end)
+        if resolution is None:
+            resolution = self.pick_resolution(start, end)
+        with self._lock:
+            if resolution == RAW:
+                rows = self._db.execute('SELECT ts, value FROM samples WHERE metric=? AND ts>=? AND ts<=? ORDER BY ts',
+                                        (metric, start, end)).fetchall()
+                rows += [(ts, x) for m, ts, x in self._samples if m == metric and start <= ts <= end]
+            else:
+                rows = self._db.execute('SELECT ts, n, min, max, avg, sd FROM rollups'
+                                        ' WHERE resolution=? AND metric=? AND ts>=? AND ts<=? ORDER BY ts',
+                                        (resolution, metric, start, end)).fetchall()
+                rows += [row[2:] for row in self._rollups if row[0] == resolution and row[1] == metric and start <= row[2] <= end]
+                current = self._open.get((resolution, metric))
+                if current is not None and current[1].n and start <= current[0] <= end:
+                    stats = current[1]
+                    rows.append((current[0], stats.n, stats.min, stats.max, stats.mean, stats.sd()))
+        return resolution, [tuple(row) for row in rows]
+
+    def metrics(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT DISTINCT metric FROM rollups WHERE resolution=?', (ROLLUPS[-1],))]
@@ -0,0 +1,309 @@
+'''*****************************************************************************************************************
+    Pi Weather Station - background uploader
+
+    Uploads are queued to a worker thread per destination (a Sink) so the sampling loop never waits on the
+    network & one destination never waits on another. Each sink has its own batch size & retry policy, the
+    station servers (Uploader) keep one keep-alive HTTP connection with separate connect and read timeouts.
+    The queue is bounded, when it is full the oldest request is dropped. Finished requests are collected as
+    results for the main loop to act on, so all State/Config changes stay on the main thread. The other
+    destinations (MQTT, InfluxDB, a local file) are in sinks.py.
+********************************************************************************************************************'''
+
+from __future__ import print_function
+
+import collections
+import socket
+import sys
+import threading
+
+try:
+    import httplib
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlencode, urlsplit
+
+from scheduler import monotonic
+
+
+class UploadResult(object):
+
+    def __init__(self, name, params, tag):
+        self.name = name
+        self.params = params
+        self.tag = tag              # caller's context, returned untouched
+        self.url = None
+        self.ok = False
+        self.status = None          # HTTP status
+        self.body = None
+        self.error = None           # exception class when the request failed
+        self.queued = 0.0           # seconds spent waiting in the queue
+        self.latency = 0.0          # seconds spent on the request itself
+        self.retries = 0            # requests resent after a kept-alive connection went stale
+        self.probe = False          # a health check (Sink.probe) rather than an upload
+
+
+class Connection(object):
+    # a single persistent HTTP connection to one server
+
+    def __init__(self, url, connect_timeout, read_timeout):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.conn = None
+        self.reused = False
+        self.retries = 0
+
+    def _open(self):
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        # the connect timeout only covers the handshake, reads get their own
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    def check(self):
+        # can the server be reached at all, a TCP connect on a throwaway socket (resolving the host again)
+        port = self.port or (443 if self.scheme == 'https' else 80)
+        socket.create_connection((self.host, port), self.connect_timeout).close()
+        return True
+
+    def get(self, query):
+        return self.request('GET', query)
+
+    def post(self, body, content_type='application/x-www-form-urlencoded'):
+        return self.request('POST', None, body, {'Content-Type': content_type})
+
+    def request(self, method, query, body=None, headers=None):
+        # returns (status, body), retries once on a fresh connection if a kept-alive one went stale
+        target = self.path + ('?' + query if query else '')
+        send_headers = {'Connection': 'keep-alive'}
+        if headers: send_headers.update(headers)
+        for attempt in (0, 1):
+            self.reused = self.conn is not None
+            if self.conn is None:
+                self.conn = self._open()
+            try:
+                self.conn.request(method, target, body, send_headers)
+                response = self.conn.getresponse()
+                body = response.read()
+                if response.getheader('connection', '').lower() == 'close':
+                    self.close()
+                return response.status, body
+            except socket.timeout:
+                # the server is slow rather than the connection stale, don't wait twice
+                self.close()
+                raise
+            except Exception:
+                self.close()
+                if attempt or not self.reused:
+                    raise
+                self.retries += 1
+
+
+class Sink(object):
+    # a destination fed from a bounded queue by its own worker thread, so a slow or failing destination
+    # only ever delays itself. Subclasses implement send(batch) -> (ok, status, body) & close().
+
+    def __init__(self, name, queue_size=10, batch_size=1, retries=0, retry_wait=5.0):
+        self.name = name
+        self.queue_size = queue_size
+        self.batch_size = max(1, batch_size)    # uploads sent together, the worker waits for a full batch
+        self.retries = retries                  # resends of a failed batch, retry_wait doubling each time
+        self.retry_wait = retry_wait
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.resent = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+        self._queue = collections.deque()
+        self._results = collections.deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._flush = False
+        self._probe = None                      # a health check waiting, it jumps the queue & any part batch and
+                                                # is kept out of it so a full queue can't drop it
+        self._reconnect = False
+        self._stopping = threading.Event()     # cuts a retry wait short
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='Sink-'+self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0, flush=False):
+        # stop the worker, flush sends what is queued once more (e.g. a part batch), returns the params
+        # of any uploads still queued
+        with self._cond:
+            self._running = False
+            self._flush = flush
+            self._cond.notify()
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.close()
+        with self._cond:
+            unsent = [result.params for result, queued in self._queue]
+            self._queue.clear()
+            self._probe = None
+        return unsent
+
+    def submit(self, params, tag=None):
+        # never blocks, returns the result dropped to make room (or None)
+        dropped = None
+        with self._cond:
+            if len(self._queue) >= self.queue_size:
+                dropped = self._queue.popleft()[0]
+                self.dropped += 1
+            self._queue.append((UploadResult(self.name, params, tag), monotonic()))
+            self._cond.notify()
+        return dropped
+
+    def probe(self):
+        # queue a cheap health check (see check()) ahead of the uploads, its result has probe=True, one
+        # already waiting answers for both
+        result = UploadResult(self.name, None, None)
+        result.probe = True
+        with self._cond:
+            if self._probe is None:
+                self._probe = result
+            self._cond.notify()
+
+    def reconnect(self):
+        # drop the connection before the next request, so it is made (& the host resolved) afresh
+        self._reconnect = True
+
+    def results(self):
+        # finished requests since the last call, for the main loop to act on
+        done = []
+        while self._results:
+            done.append(self._results.popleft())
+        return done
+
+    def depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {'depth': len(self._queue),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'retries': self.resent,
+                'latency_last': round(self.latency_last, 4),
+                'latency_max': round(self.latency_max, 4),
+                'latency_avg': round(self.latency_total / (self.sent + self.failed), 4) if (self.sent + self.failed) else 0.0}
+
+    def send(self, batch):
+        raise NotImplementedError
+
+    def check(self):
+        # True when the destination looks reachable, may raise
+        return True
+
+    def close(self):
+        pass
+
+    def _check(self, result):
+        start = monotonic()
+        try:
+            result.ok = bool(self.check())
+        except Exception:
+            result.error = sys.exc_info()[0]
+        result.latency = monotonic() - start
+        self._results.append(result)
+
+    def _attempt(self, batch):
+        try:
+            ok, status, body = self.send(batch)
+            return ok, status, body, None
+        except Exception:
+            return False, None, None, sys.exc_info()[0]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and len(self._queue) < self.batch_size and self._probe is None:
+                    self._cond.wait()
+                if not self._running and not (self._flush and self._queue):
+                    return
+                probe, self._probe = self._probe, None
+                if probe is None:
+                    batch = [self._queue.popleft() for n in range(min(self.batch_size, len(self._queue)))]
+            if self._reconnect:
+                self._reconnect = False
+                self.close()
+            if probe is not None:
+                self._check(probe)
+                continue
+            start = monotonic()
+            resent = self.resent
+            results = [result for result, queued in batch]
+            ok, status, body, error = self._attempt(results)
+            for attempt in range(self.retries):
+                if ok or not self._running: break
+                self._stopping.wait(self.retry_wait * 2 ** attempt)
+                if not self._running: break
+                self.resent += 1
+                ok, status, body, error = self._attempt(results)
+            latency = monotonic() - start
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_total += latency
+            for result, queued in batch:
+                result.queued = start - queued
+                result.ok, result.status, result.body, result.error = ok, status, body, error
+                result.latency = latency
+                result.retries = self.resent - resent
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._results.append(result)
+
+
+class Uploader(Sink):
+    # one GET per upload to a station server (PW, WU) over a keep-alive connection
+
+    def __init__(self, name, url, queue_size=10, connect_timeout=5.0, read_timeout=10.0, retries=0, retry_wait=5.0):
+        Sink.__init__(self, name, queue_size, 1, retries, retry_wait)
+        self.url = url
+        self.connection = Connection(url, connect_timeout, read_timeout)
+
+    def send(self, batch):
+        result = batch[0]
+        query = urlencode(result.params)
+        result.url = self.url + '?' + query
+        retries = self.connection.retries
+        try:
+            status, body = self.connection.get(query)
+        finally:
+            # a stale kept-alive connection resent the request
+            self.resent += self.connection.retries - retries
+        return status == 200, status, body
+
+    def check(self):
+        return self.connection.check()
+
+    def close(self):
+        self.connection.close()
@@ -13,17 +13,36 @@ import datetime
 import os
 import sys
 import logging
-from logging.handlers import RotatingFileHandler
 import time
-import math
 import json
-from urllib import urlencode
-import cPickle as pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import errno
 import fnmatch
-
-import urllib2
-from sense_hat import SenseHat
+import functools
+import numbers
+import signal
+
+from display import LedDisplay, TREND_UP, TREND_DOWN, TREND_STEADY
+from scheduler import Scheduler
+from outbox import Outbox, Replayer
+from filters import Filters
+from aggregate import Aggregator, upload_fields
+from tsdb import TimeSeriesStore
+from api import Api
+from tendency import Tendency
+from derived import derive, DERIVED
+from compress import Compression, make_compressor
+from acquire import SenseSampler
+from ring import HistoryRing
+from breaker import CircuitBreaker, OPEN, CLOSED, LEVELS
+from hal import PiHardware
+from metrics import Registry
+from logqueue import AsyncHandler, BatchRotatingFileHandler
+from commands import CommandProcessor, ControlServer, flag, choice, int_range
+from supervisor import Heartbeat
 
 # from config import Config
 
@@ -46,16 +65,25 @@ else:
 logFilePath = os.path.join(baseDir, baseFileName + ".log")
 
 logger = logging.getLogger('weather_pi')
-if Config.LOGGING_DEBUG:
-    logger.setLevel(logging.DEBUG)
-elif Config.LOGGING_INFO:
-    logger.setLevel(logging.INFO)
-else:
-    logger.setLevel(logging.WARNING)
-handler = RotatingFileHandler(logFilePath, maxBytes=Config.LOGGING_BYTES, backupCount=Config.LOGGING_ROTATION)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+log_handler = None
+
+def setup_logging(path):
+    # records are queued & written in batches by a background thread (see logqueue.py), everything below
+    # the configured level is kept in memory & only written when an error occurs
+    global log_handler
+    if Config.LOGGING_DEBUG:
+        level = logging.DEBUG
+    elif Config.LOGGING_INFO:
+        level = logging.INFO
+    else:
+        level = logging.WARNING
+    logger.setLevel(logging.DEBUG if Config.LOGGING_RING else level)
+    handler = BatchRotatingFileHandler(path, maxBytes=Config.LOGGING_BYTES, backupCount=Config.LOGGING_ROTATION)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    log_handler = AsyncHandler(handler, level, Config.LOGGING_FLUSH_INTERVAL, Config.LOGGING_REPEAT_WINDOW,
+                               Config.LOGGING_RATE, Config.LOGGING_RING)
+    logger.addHandler(log_handler)
 
 # ============================================================================
 # Constants
@@ -64,14 +92,15 @@ GO=True
 REBOOT=False
 SHUTDOWN=False
 FAILURE_COUNTER=0
+SAMPLE_INTERVAL=5   # seconds between sensor readings
+DISPLAY_MODES=('Number', 'Temperature', 'Pressure')
 STANDARD_PRESSURE=1013.25
-# Dew Point Temperature (oC) =(B1*(ln(RH/100) + (A1*t)/(B1 +t)))/(A1-ln(RH/100)-A1*t/(B1+t))
-A1=17.625
-B1=243.04
 
-# init environment
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
+# latest reading, shared by the display & upload jobs
+Reading={}
+
+# the pipe to supervisor.py when running as its worker, None otherwise
+heartbeat=None
 
 # set up the colours (blue, red, empty)
 # modified from https://www.raspberrypi.org/learning/getting-started-with-the-sense-hat/worksheet/
@@ -84,28 +113,12 @@ p = [204, 0, 102]   # pink
 l = [127, 0, 255]   # purple
 e = [0, 0, 0]       # empty
 
-NOTICE_OFFSET_LEFT = 0
-NOTICE_OFFSET_TOP = 7
 NOTICE ={"Air":{"Notify":False,"Colour":r,"Offset":1},
         "ColdFrame":{"Notify":False,"Colour":p,"Offset":2},
         "DataLoad":{"Notify":False,"Colour":g,"Offset":3},
         "PiServer":{"Notify":False,"Colour":b,"Offset":4},
         "WUServer":{"Notify":False,"Colour":o,"Offset":5}}
 
-OFFSET_LEFT = 1
-OFFSET_TOP = 1
-
-NUMS =[1,1,1,1,0,1,1,0,1,1,0,1,1,1,1,  # 0
-       0,1,0,0,1,0,0,1,0,0,1,0,0,1,0,  # 1
-       1,1,1,0,0,1,0,1,0,1,0,0,1,1,1,  # 2
-       1,1,1,0,0,1,1,1,1,0,0,1,1,1,1,  # 3
-       1,0,0,1,0,1,1,1,1,0,0,1,0,0,1,  # 4
-       1,1,1,1,0,0,1,1,1,0,0,1,1,1,1,  # 5
-       1,1,1,1,0,0,1,1,1,1,0,1,1,1,1,  # 6
-       1,1,1,0,0,1,0,1,0,1,0,0,1,0,0,  # 7
-       1,1,1,1,0,1,1,1,1,1,0,1,1,1,1,  # 8
-       1,1,1,1,0,1,1,1,1,0,0,1,0,0,1]  # 9
-
 def infoMsg(lvl,msg):
     if (Config.LOGGING_PRINT): print(msg)
     if (lvl=='d'):
@@ -119,116 +132,23 @@ def infoMsg(lvl,msg):
     else:
         logger.info(msg)
 
-def show_steady_state(colour):
-  e = [0, 0, 0]
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 0, colour)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 7, colour)
-  time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 1, colour)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 6, colour)
-  time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 0, e)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 7, e)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 2, colour)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 5, colour)
-  time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 1, e)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 6, e)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 3, colour)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 4, colour)
-  time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 2, e)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 5, e)
-  time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 3, e)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, 4, e)
-
-def show_trending_up(colour):
-  e = [0, 0, 0]
-  for p in range(7,-1,-1):
-    if (p<7):
-        sense.set_pixel(NOTICE_OFFSET_LEFT, (p+1), e)
-    sense.set_pixel(NOTICE_OFFSET_LEFT, p, colour)
-    time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, (p), e)
-
-def show_trending_down(colour):
-  e = [0, 0, 0]
-  for p in range(0, 8):
-    if (p>0):
-        sense.set_pixel(NOTICE_OFFSET_LEFT, (p-1), e)
-    sense.set_pixel(NOTICE_OFFSET_LEFT, p, colour)
-    time.sleep(0.15)
-  sense.set_pixel(NOTICE_OFFSET_LEFT, (p), e)
-
-def show_notification(offset,colour):
-  global State
-  if State['DisplayOn']:
-    for p in range(0, 8):
-    # print("\nSetting Pixel %d" % (p))
-      sense.set_pixel(p, NOTICE_OFFSET_TOP, colour)
-      # sense.set_pixel(offset, NOTICE_OFFSET_TOP, colour)
-      time.sleep(0.15)
-
 def check_notification():
-
-    if (NOTICE['Air']['Notify']==True):
-        show_notification(NOTICE['Air']['Offset'],NOTICE['Air']['Colour'])
-    if (NOTICE['ColdFrame']['Notify']==True):
-        show_notification(NOTICE['ColdFrame']['Offset'],NOTICE['ColdFrame']['Colour'])
-    if (NOTICE['DataLoad']['Notify']==True):
-        show_notification(NOTICE['DataLoad']['Offset'],NOTICE['DataLoad']['Colour'])
-    if (NOTICE['PiServer']['Notify']==True):
-        show_notification(NOTICE['PiServer']['Offset'],NOTICE['PiServer']['Colour'])
-    if (NOTICE['WUServer']['Notify']==True):
-        show_notification(NOTICE['WUServer']['Offset'],NOTICE['WUServer']['Colour'])
-
-    show_notification(0,e)
-
-# Displays a single digit (0-9)
-def show_digit(val, xd, yd, r, g, b):
-  global State
-  offset = val * 15
-  for p in range(offset, offset + 15):
-    xt = p % 3
-    yt = (p-offset) // 3
-    if (State['DisplayOn']): sense.set_pixel(xt+xd, yt+yd, r*NUMS[p], g*NUMS[p], b*NUMS[p])
-
-# Displays a two-digits positive number (0-99)
-def show_number(val, rgb):
-  abs_val = abs(val)
-  tens = abs_val // 10
-  units = abs_val % 10
-  if (abs_val > 9): show_digit(tens, OFFSET_LEFT, OFFSET_TOP, rgb[0], rgb[1], rgb[2])
-  show_digit(units, OFFSET_LEFT+4, OFFSET_TOP, rgb[0], rgb[1], rgb[2])
+    # post the colours of the active notices, the display engine sweeps them along the bottom row
+    colours=[]
+    for notice in sorted(NOTICE.values(), key=lambda n: n['Offset']):
+        if (notice['Notify']==True): colours.append(notice['Colour'])
+    display.notices(colours)
 
 def c_to_f(input_temp):
     # convert input_temp from Celsius to Fahrenheit
     return (input_temp * 1.8) + 32
 
 def get_cpu_temp():
-    # 'borrowed' from https://www.raspberrypi.org/forums/viewtopic.php?f=104&t=111457
-    # executes a command at the OS to pull in the CPU temperature
-    res = os.popen('vcgencmd measure_temp').readline()
-    return float(res.replace("temp=", "").replace("'C\n", ""))
-
-
-# use moving average to smooth readings
-def get_smooth(x):
-    # do we have the t object?
-    if not hasattr(get_smooth, "t"):
-        # then create it
-        get_smooth.t = [x, x, x]
-    # manage the rolling previous values
-    get_smooth.t[2] = get_smooth.t[1]
-    get_smooth.t[1] = get_smooth.t[0]
-    get_smooth.t[0] = x
-    # average the three last temperatures
-    xs = (get_smooth.t[0] + get_smooth.t[1] + get_smooth.t[2]) / 3
-    return xs
-
-
-def get_temp():
+    # sysfs thermal zone through a held-open descriptor, vcgencmd only when there is none (see cputemp.py)
+    return cpu_temp.get()
+
+
+def get_temp(channel='sensehat'):
     # ====================================================================
     # Unfortunately, getting an accurate temperature reading from the
     # Sense HAT is improbable, see here:
@@ -238,73 +158,102 @@ def get_temp():
     # using the following:
     # http://yaab-arduino.blogspot.co.uk/2016/08/accurate-temperature-reading-sensehat.html
     # ====================================================================
-    # First, get temp readings from both sensors
-    t1 = sense.get_temperature_from_humidity()
-    t2 = sense.get_temperature_from_pressure()
+    # First, get temp readings from both sensors, from this sample's snapshot (see acquire.py)
+    snapshot = sampler.latest
+    t1 = snapshot.th
+    t2 = snapshot.tp
     # t becomes the average of the temperatures from both sensors
     t = (t1 + t2) / 2
-    # Now, grab the CPU temperature
-    t_cpu = get_cpu_temp()
+    # Now, grab the CPU temperature, read with the snapshot
+    t_cpu = snapshot.cpu
     # Calculate the 'real' temperature compensating for CPU heating
     # t_corr = t - ((t_cpu - t) / 1.5)
     t_corr = t - ((t_cpu - t) / .75)
-    # Finally, average out that value across the last three readings
-    t_corr = get_smooth(t_corr)
+    # Finally, smooth that value with the channel's own filter (a 3 reading average by default)
+    t_corr = filters.update(channel, t_corr)
     # convoluted, right?
     # Return the calculated temperature
     return t_corr
 
-def probe_temp_raw(temp_sensor):
-    status = 9
+def probe_id(probe, n):
+    # configured probe id, or the n'th probe found on the bus when it is left as None
+    if probe is not None: return probe
+    if len(probes.probes) > n: return probes.probes[n]
+    return 'None'
+
+def sensor_expected(sensor):
+    # a State key (e.g. ColdFrameOn) or a fixed True/False
+    expected = sensor.get('expected', False)
+    if expected in State: return State[expected]
+    return expected is True
+
+def sensor_value(sensor, channel):
+    # the channel reading as uploaded & stored, Celsius unless it follows the display units
+    if sensor.get('display_units') and not Config.DISPLAY_SI: return channel['f']
+    return channel['c']
+
+def acquire():
+    # ========================================================
+    # acquisition job - runs every SAMPLE_INTERVAL seconds, ahead of the sensor & sampling jobs
+    # ========================================================
+    # every SenseHat value read once (or the average of the SENSEHAT_OVERSAMPLE reads spread across the
+    # slot) into the snapshot the sensor & sampling jobs share
+    sampler.snapshot()
+
+def read_sensor(sensor):
+    # ========================================================
+    # sensor job - runs every sensor['interval'] seconds for each of Config.SENSORS
+    # ========================================================
+    name = sensor['name']
+    notice = NOTICE.get(sensor.get('notice'))
+    celcius = None
+    if sensor['source']=='sensehat':
+        sensor_id = 'SenseHat'
+        celcius = get_temp(name)
+    else:
+        # the probes are read on their own thread, this is the latest cached reading
+        sensor_id = probe_id(sensor.get('probe'), sensor.get('index', 0))
+        with stage['probes']: reading = probes.get(sensor_id)
+        # each channel has its own filter, spikes & the 85.0 power on value are rejected there
+        if (reading['status']==0): celcius = filters.update(name, reading['celcius'])
+        if (celcius is None) and (sensor.get('fallback')=='sensehat'):
+            if notice: notice['Notify']=True
+            sensehat_fallbacks.inc()
+            celcius = get_temp()
+            sensor_id = 'SenseHat'
+        elif notice:
+            notice['Notify'] = (celcius is None) and sensor_expected(sensor)
+    if (celcius is not None):
+        channel = {'c': round(celcius,1), 'f': round(c_to_f(celcius),1), 'id': sensor_id, 'valid': True}
+    elif sensor_expected(sensor):
+        channel = {'c': 0, 'f': 0, 'id': 'None', 'valid': False}
+    else:
+        channel = {'c': -99, 'f': -99, 'id': 'NotSet', 'valid': False}
+    # replaced whole, so a reading handed to the API is never half updated
+    channels[name] = channel
+    # the real measurements (no placeholders) go to the upload window's statistics & the local history
+    if channel['valid']:
+        value = sensor_value(sensor, channel)
+        window.add(sensor['field'], value)
+        if Config.TSDB: history.add(clock.time(), {sensor['field']: value})
+        # & the air temperature to the display's recent history
+        if sensor is Config.SENSORS[0]: recent.add(sensor['field'], clock.time(), value)
+
+def storeFailure(weather_data):
+    # append an undelivered PW reading to the outbox
+    if not Config.OUTBOX: return
     try:
-        f = open(temp_sensor, 'r')
-        lines = f.readlines()
-        f.close()
-        status = 0
+        outbox.store('pw', weather_data)
     except:
-        lines = ''
-        infoMsg("w","...Unable To Retrieve Sensor Data:%s" % str(temp_sensor))
-
-    return {'status':status, 'lines':lines}
-
-def probe_temp(temp_sensor):
-    raw_temp = probe_temp_raw(temp_sensor)
-    status = 9
-    celcius = 0
-    if (raw_temp['status']==0):
-        if (raw_temp['lines'][0].strip()[-3:]=='YES'):
-            temp_output = raw_temp['lines'][1].find('t=')
-            if temp_output != -1:
-                status = 0
-                temp_string = raw_temp['lines'][1].strip()[temp_output+2:]
-                celcius = float(temp_string) / 1000.0
-                if (celcius==85.0): status = 8
-                # temp_f = temp_c * 9.0 / 5.0 + 32.0
-    return {'status':status, 'celcius':celcius}
-
-def failureLog(t,rh,p,dp,cf,pid,cid,ct):
-    utc_datetime=datetime.datetime.utcnow()
-    local_datetime=datetime.datetime.now()
-    if (ct==0 or ct==30):
-        fn='fl_'+local_datetime.strftime('%Y-%m-%d')+'_'+local_datetime.strftime('%H:%M:%S')+'.csv'
-        fl=os.path.join(Config.FAILURE_DIR , fn)
-        dt =[local_datetime.strftime('%Y-%m-%d'),local_datetime.strftime('%H:%M:%S'),t,rh,p,dp,cf,pid,cid,utc_datetime.strftime('%Y-%m-%d'),utc_datetime.strftime('%H:%M:%S')]
-        try:
-            fLog = open(fl, 'w')
-            with fLog:
-                writer = csv.writer(fLog)
-                writer.writerow(dt)
-            fLog.close()
-        except:
-            infoMsg("w",".....Unable to Save Failure Log")
+        infoMsg("w",".....Unable to Store Reading In Outbox:"+str(sys.exc_info()[0]))
 
 def saveState(s):
     global State
     State['Calling'] = s
     State['Status'] = 'Current'
-    State['Updated'] = datetime.datetime.now()
+    State['Updated'] = clock.now()
     try:
-      outfile = open('State.pkl', 'wb')
+      outfile = open(Config.STATE_PATH, 'wb')
       # Use a dictionary (rather than pickling 'raw' values) so
       # the number & order of things can change without breaking.
       pickle.dump(State, outfile)
@@ -316,361 +265,735 @@ def saveState(s):
 def loadState():
     global State
     try:
-      infile = open('State.pkl', 'rb')
+      infile = open(Config.STATE_PATH, 'rb')
       State= pickle.load(infile)
       infile.close()
     except:
       infoMsg("w",".....State File Not Found")
 
 def reboot_now():
-    os.system('reboot')
+    # get the log onto the card before the Pi goes down
+    if log_handler is not None: log_handler.flush()
+    hw.reboot()
 
 def shutdown_now():
-    os.system('shutdown -h now')
+    if log_handler is not None: log_handler.flush()
+    hw.shutdown()
+
+def take_sample():
+    # ========================================================
+    # sampling job - runs every SAMPLE_INTERVAL seconds
+    # ========================================================
+    global Reading
+    global NOTICE
+
+    # The temp measurement smoothing algorithm's accuracy is based
+    # on frequent measurements, so we'll take measurements every 5 seconds
+    # but only show on DISPLAY_INTERVAL
+
+    # ========================================================
+    # read values from the Sense HAT
+    # ========================================================
+    # Calculate the temperature. The get_temp function 'adjusts' the recorded temperature adjusted for the
+    # current processor temp in order to accommodate any temperature leakage from the processor to
+    # the Sense HAT's sensor. This happens when the Sense HAT is mounted on the Pi in a case.
+    # If you've mounted the Sense HAT outside of the Raspberry Pi case, then you don't need that
+    # calculation. So, when the Sense HAT is external, replace the following line (comment it out  with a #)
+    # calc_temp = get_temp()
+    # with the following line (uncomment it, remove the # at the line start)
+    # calc_temp = sampler.latest.tp
+    # or the following line (each will work)
+    # calc_temp = sampler.latest.th
+    # ========================================================
+    # At this point, we should have an accurate temperature, so lets use the recorded (or calculated)
+    # temp for our purposes
+
+    # the sensor channels are read by their own jobs (see read_sensor), the first is the air temperature
+    air = channels[Config.SENSORS[0]['name']]
+    temp_c = air['c']
+    temp_f = air['f']
+
+    # every SenseHat value of this sample comes from the one snapshot taken by the acquisition job
+    snapshot = sampler.latest
+    humidity = round(snapshot.humidity, 1)
+    # convert pressure from millibars to inHg for weather underground
+    calc_pressure = snapshot.pressure
+    pressure_mB = round(calc_pressure, 2)
+    pressure_Hg = round(calc_pressure * 0.0295300, 2)
+
+    # dew point & the other derived metrics, None where the readings are outside a formula's domain
+    with stage['derived']:
+        derived = derive(temp_c if air['valid'] else None, humidity, calc_pressure, Config.ALTITUDE)
+    for name in derived:
+        if derived[name] is not None: derived[name] = round(derived[name], 1)
+    dew_point_c = derived['dp']
+    if (dew_point_c is None):
+        dew_point_c = 0.0
+        infoMsg("w","...No Dew Point From temp_c="+str(temp_c)+" humidity="+str(humidity))
+    # print("Temp: %sF (%sC), Pressure: %s inHg, Humidity: %s%%" % (temp_f, temp_c, pressure, humidity))
+    # pressure = pressure_mB
+    temp = temp_f
+    pressure = pressure_mB
+
+    # display celcius if SI selected
+    if (Config.DISPLAY_SI): temp = temp_c
+
+    # pressure tendency from the regression over the TENDENCY_WINDOWS
+    pressure_tendency.add(clock.monotonic(), calc_pressure)
+    tendency = pressure_tendency.summary()
+
+    # show pressure trend, the history modes use the whole matrix
+    if (State['DisplayMode']=='Number'):
+        if (tendency['trend']=='up'): display.trend(TREND_UP, b)
+        elif (tendency['trend']=='down'): display.trend(TREND_DOWN, b)
+        else: display.trend(TREND_STEADY, b)
+
+    # the real measurements (no placeholders) go to the upload window's statistics & the local history
+    values = {'rh': humidity, 'p': pressure}
+    for name in Config.DERIVED:
+        if derived[name] is not None: values[name] = derived[name]
+    for metric in values: window.add(metric, values[metric])
+    if Config.TSDB: history.add(clock.time(), values)
+    recent.add('p', clock.time(), pressure)
+
+    Reading = {'temp': temp,
+               'temp_c': temp_c,
+               'temp_f': temp_f,
+               'humidity': humidity,
+               'dew_point_c': dew_point_c,
+               'derived': derived,
+               'pressure': pressure,
+               'pressure_Hg': pressure_Hg,
+               'AirTemperatureProbeId': air['id'],
+               'channels': channels,
+               'tendency': tendency,
+               # set display temp to integer
+               'display_temp': int(round(temp,0))}
+
+    hw.tick()
+    check_uploads()
+    # commands from the upload responses above & the control endpoint, then the State is saved once
+    commands.apply()
+    if State['Status']=='Stale': saveState('main')
+    # scroll notifications if any are set
+    check_notification()
+
+    # hand the new reading to the local API, it serializes on demand on its own threads
+    if Config.API: api.publish({'current': dict(Reading, time=clock.now()), 'state': State})
+    startup_event('first_sample')
+
+def refresh_display():
+    # ========================================================
+    # display job - runs every DISPLAY_INTERVAL minutes
+    # ========================================================
+    global last_temp
+
+    if not Reading: return
+    mode = State['DisplayMode']
+    if mode != 'Number':
+        # the last SPARKLINE_HOURS of the temperature or pressure, redrawn each time as the hours move on
+        metric = 'p' if mode == 'Pressure' else Config.SENSORS[0]['field']
+        columns = recent.columns(metric, clock.time(), Config.SPARKLINE_HOURS * 3600)
+        display.sparkline(columns, b if mode == 'Pressure' else g, Config.SPARKLINE_MIN_RANGE)
+        last_temp = None
+        return
+    display_temp = Reading['display_temp']
+    current_hour = clock.now().hour
+    # did the temperature go up or down?
+    if last_temp != display_temp:
+        rgb=g
+        if (display_temp<1): rgb=b
+        if (current_hour>Config.SUNSET) and (current_hour<Config.SUNRISE): display.low_light(True)
+        display.number(display_temp, rgb)
+    last_temp = display_temp
+
+def pw_upload():
+    # ========================================================
+    # Upload the weather data to DB's - runs every PW_UPLOAD_INTERVAL minutes
+    # ========================================================
+    global NOTICE
+
+    # every sample since the last upload, summarised
+    summaries = window.close_window()
+    if not (Config.PW_UPLOAD and Reading): return
+
+    utc_datetime=clock.utcnow()
+    local_datetime=clock.now()
+
+    # print("Pi Server Upload...%s" % (local_datetime))
+    infoMsg("d","Pi Server Upload...")
+    NOTICE['DataLoad']['Notify']=False
+    NOTICE['PiServer']['Notify']=False
+    rpt_dim=0
+    rpt_display=0
+    rpt_coldframe=0
+    rpt_WU=0
+    if State['DisplayDim']==True: rpt_dim=1
+    if State['DisplayOn']==True: rpt_display=1
+    if State['ColdFrameOn']==True: rpt_coldframe=1
+    if State['WUUpload']==False: rpt_WU=0
+    else: rpt_WU=State['WUInterval']
+    # From http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
+    # print("Uploading data to Weather Pi")
+    # build a weather data object
+    weather_data = {
+        "si": Config.PW_ID,
+        "rh": str(Reading['humidity']),
+        "p": str(Reading['pressure']),
+        "dp": str(Reading['dew_point_c']),
+        "sld": local_datetime.strftime('%Y-%m-%d'),
+        "slt": local_datetime.strftime('%H:%M:%S'),
+        "stz": Config.LOCAL_STATION_TIMEZONE,
+        "sud": utc_datetime.strftime('%Y-%m-%d'),
+        "sut": utc_datetime.strftime('%H:%M:%S'),
+        "dd": str(rpt_dim),
+        "do": str(rpt_display),
+        "co": str(rpt_coldframe),
+        "wu": str(rpt_WU),
+        "st": "Current",
+    }
+    # the derived metrics, dp is always sent
+    for name in Config.DERIVED:
+        if name!='dp' and Reading['derived'][name] is not None: weather_data[name] = str(Reading['derived'][name])
+    # each sensor channel's reading & probe id, e.g. t & pid, cf & cid
+    for sensor in Config.SENSORS:
+        channel = channels[sensor['name']]
+        weather_data[sensor['field']] = str(sensor_value(sensor, channel))
+        weather_data[sensor['id_field']] = str(channel['id'])
+    # min/max/avg/sd/n of each metric over the window, e.g. t_min, rh_avg, p_sd
+    weather_data.update(upload_fields(summaries))
+    # pressure tendency, WMO characteristic & slope in hPa/h per window e.g. pr1, pr3, left out until
+    # its window has filled
+    tendency = Reading['tendency']
+    if tendency['code'] is not None: weather_data['pa'] = str(tendency['code'])
+    for span in Config.TENDENCY_WINDOWS:
+        if tendency['slope_%gh' % span] is not None: weather_data['pr%g' % span] = str(tendency['slope_%gh' % span])
+    if not breakers['pw'].allow():
+        # the server is down, straight to the outbox rather than queueing behind it
+        metrics.counter('weatherpi_uploads_skipped_total', 'Uploads not sent while the breaker is open', dest='pw').inc()
+        NOTICE['PiServer']['Notify']=True
+        storeFailure(weather_data)
+        return
+    # queue the upload, the response is handled by pw_result() on a later tick
+    dropped = pw_uploader.submit(weather_data)
+    if dropped is not None:
+        metrics.counter('weatherpi_uploads_dropped_total', 'Uploads dropped from a full queue', dest='pw').inc()
+        infoMsg("w","...PW Queue Full, Storing Upload From "+dropped.params['slt'])
+        storeFailure(dropped.params)
+
+def pw_result(result):
+    # act on a finished PW upload
+    global NOTICE, FAILURE_COUNTER
+
+    weather_data=result.params
+    try:
+        if (result.error is not None): raise result.error
+        if (not result.ok): raise IOError("HTTP Status %s" % str(result.status))
+        rtn_control = json.loads(result.body)
+        FAILURE_COUNTER=0
+        breakers['pw'].success()
+        # the server is answering again, send it anything we've stored
+        if Config.OUTBOX: replayer.wake()
+        if ("Status" in rtn_control):
+            infoMsg("d","Returned==> %s" % str(rtn_control))
+            if (rtn_control["Status"]==0):
+                NOTICE['DataLoad']['Notify']=False
+            elif (rtn_control["Status"]==1):
+                infoMsg("i","Parameter Updates...")
+                NOTICE['DataLoad']['Notify']=False
+                # applied with any local commands at the end of this tick
+                del rtn_control["Status"]
+                submit_commands(rtn_control, 'pw')
+            else:
+                infoMsg("w","...DataLoad Status "+str(rtn_control["Status"]))
+                infoMsg("w","...Weather_data==>"+str(weather_data))
+                NOTICE['DataLoad']['Notify']=True
+        else:
+            infoMsg("w","...DataLoad No Status Returned")
+            infoMsg("w","...Server response==>"+str(result.body))
+            NOTICE['PiServer']['Notify']=True
+
+    except:
+        infoMsg("w","...PW Exception:"+str(sys.exc_info()[0]))
+        # keep the reading for the replay once the server is back
+        storeFailure(weather_data)
+        NOTICE['PiServer']['Notify']=True
+        FAILURE_COUNTER=FAILURE_COUNTER+1
+        # enough failures in a row open the breaker, see breaker_changed()
+        breakers['pw'].failure()
+
+# ============================================================================
+# remote commands - from the PW upload response or the local control endpoint
+# ============================================================================
+def submit_commands(rtn_control, source):
+    accepted, rejected = commands.submit(rtn_control, source)
+    for name in rejected:
+        infoMsg("w","...Command %s=%s Rejected: %s" % (name, str(rtn_control[name]), rejected[name]))
+
+def cmd_shutdown(value):
+    global GO, SHUTDOWN
+    GO=False
+    SHUTDOWN=True
+    infoMsg("i","Shutting Down Weather Pi....")
+
+def cmd_reboot(value):
+    global GO, REBOOT
+    GO=False
+    REBOOT=True
+    infoMsg("i","Rebooting Weather Pi....")
+
+def cmd_off(value):
+    global GO
+    GO=False
+    infoMsg("i","Shutting Weather Pi App Off....")
+
+def stop_signal(signum, frame):
+    # SIGTERM from the supervisor, stop after the running job as WeatherPiOff does
+    global GO
+    GO=False
+
+def cmd_display_dim(value):
+    Config.DISPLAY_DIM=(value=='Yes')
+    infoMsg("i","Display to "+("Dim" if Config.DISPLAY_DIM else "Bright"))
+    State['DisplayDim']=Config.DISPLAY_DIM
+    State['Status']='Stale'
+
+def cmd_display_on(value):
+    Config.DISPLAY_ON=(value=='Yes')
+    display.enable(Config.DISPLAY_ON)
+    infoMsg("i","Display "+("On" if Config.DISPLAY_ON else "Off"))
+    State['DisplayOn']=Config.DISPLAY_ON
+    State['Status']='Stale'
+
+def cmd_display_mode(value):
+    State['DisplayMode']=value
+    State['Status']='Stale'
+    infoMsg("i","Display Mode "+value)
+    refresh_display()
+
+def cmd_pw_interval(value):
+    if (value>0):
+        Config.PW_UPLOAD=True
+        Config.PW_UPLOAD_INTERVAL=value
+        scheduler.set_interval('pw', Config.PW_UPLOAD_INTERVAL*60)
+        infoMsg("i","Setting Upload to Weather DB to "+str(Config.PW_UPLOAD_INTERVAL)+" minutes")
+    else:
+        Config.PW_UPLOAD=False
+        infoMsg("i","Setting Upload to Weather DB Off")
+
+def cmd_coldframe(value):
+    infoMsg("i","Setting ColdFrame "+value)
+    Config.USE_PROBE_2=(value=='On')
+    State['ColdFrameOn']=Config.USE_PROBE_2
+    State['Status']='Stale'
+
+def cmd_wu_interval(value):
+    infoMsg("i","Setting WUServerUploadInterval=> %s" % value)
+    if (value>14):
+        Config.WU_UPLOAD=True
+        Config.WU_UPLOAD_INTERVAL=value
+        scheduler.set_interval('wu', Config.WU_UPLOAD_INTERVAL*60)
+        infoMsg("i","Setting WU Interval to "+str(Config.WU_UPLOAD_INTERVAL)+" minutes")
+    else:
+        Config.WU_UPLOAD=False
+        infoMsg("i","Setting Weather Underground Upload Off")
+    State['WUUpload']=Config.WU_UPLOAD
+    State['WUInterval']=Config.WU_UPLOAD_INTERVAL
+    State['Status']='Stale'
+
+def command_processor():
+    # the commands the station takes, applied in this order
+    processor = CommandProcessor()
+    processor.register('PiShutdown', flag, cmd_shutdown)
+    processor.register('PiReboot', flag, cmd_reboot)
+    processor.register('WeatherPiOff', flag, cmd_off)
+    processor.register('DisplayDim', choice('Yes', 'No'), cmd_display_dim)
+    processor.register('DisplayOn', choice('Yes', 'No'), cmd_display_on)
+    processor.register('DisplayMode', choice(*DISPLAY_MODES), cmd_display_mode)
+    processor.register('PiServerUploadInterval', int_range(0, 60), cmd_pw_interval)
+    processor.register('ColdFrame', choice('On', 'Off'), cmd_coldframe)
+    processor.register('WUServerUploadInterval', int_range(0, 60), cmd_wu_interval)
+    return processor
+
+def wu_upload():
+    # ========================================================
+    # Upload the weather data to Weather Underground - runs every WUInterval minutes
+    # ========================================================
+    global NOTICE
+
+    # is weather upload enabled (True)?
+    if not (State['WUUpload'] and Reading): return
+
+    # From http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
+    # print("Uploading data to Weather Underground")
+    # build a weather data object
+    if not breakers['wu'].allow():
+        metrics.counter('weatherpi_uploads_skipped_total', 'Uploads not sent while the breaker is open', dest='wu').inc()
+        return
+    infoMsg("d","WU Server Upload...")
+    weather_data = {
+        "action": "updateraw",
+        "ID": wu_station_id,
+        "PASSWORD": wu_station_key,
+        "dateutc": "now",
+        "tempf": str(Reading['temp_f']),
+        "humidity": str(Reading['humidity']),
+        "baromin": str(Reading['pressure_Hg']),
+    }
+    # queue the upload, the response is handled by wu_result() on a later tick
+    dropped = wu_uploader.submit(weather_data)
+    if dropped is not None:
+        metrics.counter('weatherpi_uploads_dropped_total', 'Uploads dropped from a full queue', dest='wu').inc()
+        infoMsg("w","...WU Queue Full, Dropped Upload")
+
+def wu_result(result):
+    # act on a finished WU upload
+    global NOTICE
+
+    if (result.ok):
+        infoMsg("d","WU Response:"+str(result.body))
+        NOTICE['WUServer']['Notify']=False
+        breakers['wu'].success()
+    else:
+        breakers['wu'].failure()
+        infoMsg("w","...WU URL      :"+str(result.url))
+        infoMsg("w","...WU Exception:"+str(result.error or result.status))
+        # infoMsg("w","...WU Response:"+str(html))
+        NOTICE['WUServer']['Notify']=True
+
+def sink_record():
+    # the latest reading as a flat record, only the channels with a real reading
+    record = {'time': int(clock.time()),
+              'station': Config.LOCAL_STATION_ID,
+              'rh': Reading['humidity'],
+              'p': Reading['pressure']}
+    for name in Config.DERIVED:
+        if Reading['derived'][name] is not None: record[name] = Reading['derived'][name]
+    for sensor in Config.SENSORS:
+        channel = channels[sensor['name']]
+        if channel['valid']:
+            record[sensor['field']] = sensor_value(sensor, channel)
+            record[sensor['id_field']] = channel['id']
+    return record
+
+def sink_records(name, record, flush=False):
+    # the record as sent to a sink, with compression a record per time of the values kept then (& the tags)
+    compression = compressions.get(name)
+    if compression is None: return [record]
+    tags = dict((key, value) for key, value in record.items() if not isinstance(value, numbers.Number))
+    if flush:
+        rows = compression.flush()
+    else:
+        rows = compression.add(record['time'], dict((key, value) for key, value in record.items() if key != 'time' and key not in tags))
+    records = {}
+    for metric, ts, x in rows: records.setdefault(ts, dict(tags, time=ts))[metric] = x
+    return [records[ts] for ts in sorted(records)]
+
+def sink_send(sink):
+    # ========================================================
+    # sink job - runs every 'interval' seconds for each enabled Config.SINKS
+    # ========================================================
+    if not Reading: return
+    if not breakers[sink.name].allow():
+        metrics.counter('weatherpi_uploads_skipped_total', 'Uploads not sent while the breaker is open', dest=sink.name).inc()
+        return
+    # queued for the sink's own worker, sent once it has a full batch
+    for record in sink_records(sink.name, sink_record()):
+        dropped = sink.submit(record)
+        if dropped is not None:
+            metrics.counter('weatherpi_uploads_dropped_total', 'Uploads dropped from a full queue', dest=sink.name).inc()
+            infoMsg("w","..."+sink.name+" Queue Full, Dropped Reading")
+
+def sink_result(result):
+    if result.ok:
+        breakers[result.name].success()
+    else:
+        infoMsg("w","..."+result.name+" Sink Failed:"+str(result.error or result.status))
+        breakers[result.name].failure()
+
+def breaker_changed(breaker, old, new):
+    metrics.counter('weatherpi_breaker_transitions_total', 'Circuit breaker state changes', dest=breaker.name, state=new).inc()
+    metrics.gauge('weatherpi_breaker_state', 'Circuit breaker state, 0 closed, 1 half open, 2 open', dest=breaker.name).set(LEVELS[new])
+    save_breaker(breaker)
+    if new == OPEN:
+        infoMsg("w","..."+breaker.name+" Breaker Open (%d in a row), Probing In %.0fs" % (breaker.opens, breaker.retry_at - clock.monotonic()))
+        recover(breaker)
+    elif new == CLOSED:
+        infoMsg("i","..."+breaker.name+" Breaker Closed")
+
+def save_breaker(breaker):
+    # the breaker's snapshot in the State, with when an open one is due a probe as a wall clock time
+    # so the backoff still holds after a restart
+    snapshot = breaker.snapshot()
+    if snapshot['retry_in'] is not None: snapshot['retry_time'] = clock.time() + snapshot['retry_in']
+    State['Breakers'][breaker.name] = snapshot
+
+def recover(breaker):
+    # local recovery as the PW breaker keeps opening - each step of Config.BREAKER_RECOVERY once an outage
+    # (breaker.recovered, kept over a restart), the first not yet taken whose count is reached. A reboot
+    # only when the Pi's own network is down, it doesn't bring back a server that is down
+    global GO, REBOOT
+    # the probe & the next upload start on a fresh connection, resolving the host again
+    destinations[breaker.name].reconnect()
+    if breaker.name != 'pw': return
+    steps = [Config.BREAKER_RECOVERY[opens] for opens in sorted(Config.BREAKER_RECOVERY)
+             if opens <= breaker.opens and Config.BREAKER_RECOVERY[opens] not in breaker.recovered]
+    if not steps: return
+    step = steps[0]
+    if step == 'network':
+        breaker.recovered.append(step)
+        metrics.counter('weatherpi_recovery_total', 'Local recovery steps taken', step=step).inc()
+        infoMsg("w","Restarting The Network After %d PW Breaker Openings...." % breaker.opens)
+        hw.restart_network()
+    elif step == 'reboot' and Config.FAILURE_REBOOT:
+        if hw.network_up():
+            infoMsg("w","PW Server Still Down After %d Breaker Openings, The Network Is Up So Not Rebooting" % breaker.opens)
+            return
+        breaker.recovered.append(step)
+        metrics.counter('weatherpi_recovery_total', 'Local recovery steps taken', step=step).inc()
+        GO=False
+        REBOOT=True
+        infoMsg("e","Rebooting Weather Pi After %d PW Breaker Openings, The Network Is Down...." % breaker.opens)
+    save_breaker(breaker)
+
+def probed(result):
+    metrics.counter('weatherpi_breaker_probes_total', 'Health probes of destinations with an open breaker', dest=result.name, result='ok' if result.ok else 'failed').inc()
+    breakers[result.name].probed(result.ok)
+
+def startup_event(event):
+    # seconds from the station starting (the process on the Pi) to each start up milestone, once each
+    if event in startup_times: return
+    startup_times[event] = clock.monotonic() - hw.started
+    metrics.gauge('weatherpi_startup_seconds', 'Seconds from start to each start up milestone', event=event).set(round(startup_times[event], 3))
+    infoMsg("i","Startup: %s after %.2fs" % (event, startup_times[event]))
+
+def count_upload(result):
+    if result.ok and result.name=='pw': startup_event('first_upload')
+    metrics.histogram('weatherpi_upload_seconds', 'Seconds per upload request', dest=result.name).observe(result.latency)
+    metrics.counter('weatherpi_uploads_total', 'Finished uploads', dest=result.name, result='ok' if result.ok else 'failed').inc()
+    if result.retries: metrics.counter('weatherpi_upload_retries_total', 'Requests resent on a fresh connection', dest=result.name).inc(result.retries)
+
+def finished(destination, handler):
+    for result in destination.results():
+        if result.probe:
+            probed(result)
+        else:
+            count_upload(result)
+            handler(result)
+        # failures & opens change without a state change too (a delivery resets opens while closed)
+        save_breaker(breakers[result.name])
+
+def check_uploads():
+    # handle uploads finished since the last tick, on the main thread
+    finished(pw_uploader, pw_result)
+    finished(wu_uploader, wu_result)
+    for spec, sink in sinks: finished(sink, sink_result)
+    # a destination down long enough gets a cheap probe rather than an upload
+    for name in breakers:
+        if breakers[name].due():
+            breakers[name].probing()
+            destinations[name].probe()
+
+def missed_slots(job, slots):
+    metrics.counter('weatherpi_missed_slots_total', 'Scheduler slots skipped because a job ran late', job=job.name).inc(slots)
+    infoMsg("w","...Scheduler: %s ran %.2fs late, skipped %d slot(s)" % (job.name, job.late_last, slots))
+
+def write_metrics():
+    # ========================================================
+    # metrics job - runs every METRICS_INTERVAL seconds
+    # ========================================================
+    metrics.gauge('weatherpi_upload_queue_depth', 'Uploads waiting to be sent', dest='pw').set(pw_uploader.depth())
+    metrics.gauge('weatherpi_upload_queue_depth', 'Uploads waiting to be sent', dest='wu').set(wu_uploader.depth())
+    for spec, sink in sinks:
+        metrics.gauge('weatherpi_upload_queue_depth', 'Uploads waiting to be sent', dest=sink.name).set(sink.depth())
+    metrics.gauge('weatherpi_failure_counter', 'Consecutive PW upload failures').set(FAILURE_COUNTER)
+    metrics.gauge('weatherpi_probe_refresh_failures', 'Probe refreshes that failed as a whole').set(probes.stats()['failures'])
+    for name in compressions:
+        metrics.gauge('weatherpi_compression_ratio', 'Samples per point kept by the compression', dest=name).set(compressions[name].ratio())
+    if Config.OUTBOX:
+        metrics.gauge('weatherpi_outbox_backlog', 'Readings waiting in the outbox').set(outbox.count('pw'))
+        metrics.gauge('weatherpi_outbox_rejected', 'Readings the server refused, moved aside').set(outbox.rejected('pw'))
+    try:
+        metrics.write(os.path.join(baseDir, Config.METRICS_PATH))
+    except (IOError, OSError):
+        infoMsg("w","...Unable to Write Metrics:"+str(sys.exc_info()[1]))
+
+def save_recent():
+    # ========================================================
+    # recent history job - runs every SPARKLINE_SAVE_INTERVAL seconds, so the sparklines survive a restart
+    # ========================================================
+    try:
+        recent.save(os.path.join(baseDir, Config.SPARKLINE_PATH))
+    except (IOError, OSError):
+        infoMsg("w","...Unable to Save Recent History:"+str(sys.exc_info()[1]))
+
+def main(run_for=None):
+    # run_for: seconds (on the hardware's clock) before stopping, None runs until told to stop
+    global scheduler, pw_uploader, wu_uploader, sinks, compressions, destinations, breakers, outbox, replayer, history, api, control
 
-def main():
-    global last_temp, State
-    global GO, REBOOT, SHUTDOWN, NOTICE, FAILURE_COUNTER
+    # a point is kept only when it leaves its metric's error bound, per destination (see compress.py)
+    compressions = {}
 
-    last_pressure = 0
-    # initialize the lastMinute variable to the current time to start
-    last_minute = datetime.datetime.now().minute
-    # on startup, just use the previous minute as lastMinute
-    last_minute -= 1
-    if last_minute == 0:
-        last_minute = 59
+    # local history, written in batches with rollups & retention
+    if Config.TSDB:
+        if Config.TSDB_COMPRESS: compressions['history'] = Compression(Config.COMPRESSION)
+        history = TimeSeriesStore(os.path.join(baseDir, Config.TSDB_PATH), Config.TSDB_RETENTION, Config.TSDB_FLUSH_INTERVAL, clock.time,
+                                  compressions.get('history'))
+
+    # read only HTTP API for local consoles
+    if Config.API:
+        try:
+            api = Api(Config.API_BIND, Config.API_PORT, history if Config.TSDB else None, metrics)
+            api.start()
+        except:
+            infoMsg("w","...Unable to Start API:"+str(sys.exc_info()[1]))
+            Config.API = False
+
+    # local control endpoint, commands are queued & applied by the sampling job
+    if Config.CONTROL:
+        try:
+            control = ControlServer(commands, Config.CONTROL_BIND, Config.CONTROL_PORT, Config.CONTROL_TOKEN)
+            control.start()
+        except:
+            infoMsg("w","...Unable to Start Control:"+str(sys.exc_info()[1]))
+            Config.CONTROL = False
+
+    # the 1-Wire probes convert in parallel on their own thread & are read from a cache
+    probes.start()
+    infoMsg("i","Probes Found=======> %s (bulk read %s)" % (str(probes.probes), str(probes.bulk)))
+
+    # undelivered readings are kept in the outbox & replayed once the server is back
+    if Config.OUTBOX:
+        outbox = Outbox(os.path.join(baseDir, Config.OUTBOX_PATH))
+        connection = hw.connection(Config.PW_BATCH_URL or Config.PW_URL, Config.UPLOAD_CONNECT_TIMEOUT, Config.UPLOAD_READ_TIMEOUT)
+        # a refused batch is sent again one reading at a time to PW_URL
+        row_connection = hw.connection(Config.PW_URL, Config.UPLOAD_CONNECT_TIMEOUT, Config.UPLOAD_READ_TIMEOUT) if Config.PW_BATCH_URL else None
+        replayer = Replayer(outbox, 'pw', Config.PW_URL, Config.PW_BATCH_URL, Config.REPLAY_BATCH_SIZE, Config.REPLAY_RATE,
+                            connection=connection, max_attempts=Config.REPLAY_MAX_ATTEMPTS, row_connection=row_connection)
+        replayer.start()
+        infoMsg("i","Outbox Backlog=====> %d" % outbox.count('pw'))
+
+    # uploads run on their own worker threads, the loop only queues them
+    pw_uploader = hw.uploader('pw', Config.PW_URL, Config.UPLOAD_QUEUE_SIZE, Config.UPLOAD_CONNECT_TIMEOUT, Config.UPLOAD_READ_TIMEOUT)
+    wu_uploader = hw.uploader('wu', Config.WU_URL, Config.UPLOAD_QUEUE_SIZE, Config.UPLOAD_CONNECT_TIMEOUT, Config.UPLOAD_READ_TIMEOUT)
+    pw_uploader.start()
+    wu_uploader.start()
+    # and the other destinations, each with its own worker, batch size & retry policy (see sinks.py)
+    sinks = []
+    for spec in Config.SINKS:
+        if not spec.get('enabled', True): continue
+        if spec.get('path'): spec = dict(spec, path=os.path.join(baseDir, spec['path']))
+        try:
+            sink = hw.sink(spec)
+        except:
+            infoMsg("w","...Unable to Start Sink "+str(spec.get('name'))+":"+str(sys.exc_info()[1]))
+            continue
+        sink.start()
+        sinks.append((spec, sink))
+        if spec.get('compress'): compressions[sink.name] = Compression(Config.COMPRESSION)
+
+    # a circuit breaker per destination, nothing is sent while it is open & the destination is probed instead
+    destinations = {'pw': pw_uploader, 'wu': wu_uploader}
+    for spec, sink in sinks: destinations[sink.name] = sink
+    breakers = {}
+    saved = State.get('Breakers') or {}
+    State['Breakers'] = {}
+    for name in sorted(destinations):
+        breakers[name] = CircuitBreaker(name, Config.BREAKER_THRESHOLD, Config.BREAKER_BACKOFF, Config.BREAKER_BACKOFF_MAX,
+                                        Config.BREAKER_JITTER, clock.monotonic)
+        # an outage carries over a restart - the openings in a row, the recovery steps already taken & an
+        # open breaker's backoff - so a restart neither starts the recovery over nor opens it afresh
+        previous = saved.get(name) or {}
+        breakers[name].restore(previous, previous.get('retry_time', 0) - clock.time())
+        if breakers[name].state == OPEN:
+            infoMsg("w","..."+name+" Breaker Still Open (%d in a row), Probing In %.0fs" % (breakers[name].opens, breakers[name].retry_at - clock.monotonic()))
+        breakers[name].on_change = breaker_changed
+        save_breaker(breakers[name])
+        metrics.gauge('weatherpi_breaker_state', 'Circuit breaker state, 0 closed, 1 half open, 2 open', dest=name).set(LEVELS[breakers[name].state])
+
+    # every job keeps its own deadline on the monotonic clock, the sensors & sampling are added first so
+    # they run ahead of the display & uploads when they fall due in the same slot
+    scheduler = Scheduler(clock.monotonic, clock.time, clock.sleep)
+    scheduler.on_missed = missed_slots
+    # the SenseHat snapshot first, the sensors & sampling read from it
+    if sampler.oversample > 1:
+        scheduler.add('sensehat:read', float(SAMPLE_INTERVAL) / sampler.oversample, sampler.read)
+    scheduler.add('sensehat', SAMPLE_INTERVAL, stage['sensehat'].timed(acquire))
+    for sensor in Config.SENSORS:
+        scheduler.add('sensor:'+sensor['name'], sensor['interval'], stage['sensors'].timed(functools.partial(read_sensor, sensor)))
+    scheduler.add('sample', SAMPLE_INTERVAL, stage['sample'].timed(take_sample))
+    scheduler.add('display', Config.DISPLAY_INTERVAL*60, stage['display'].timed(refresh_display))
+    scheduler.add('pw', Config.PW_UPLOAD_INTERVAL*60, stage['pw_upload'].timed(pw_upload))
+    scheduler.add('wu', State['WUInterval']*60, stage['wu_upload'].timed(wu_upload))
+    for spec, sink in sinks:
+        scheduler.add('sink:'+sink.name, spec.get('interval', 60), stage['sinks'].timed(functools.partial(sink_send, sink)))
+    if Config.METRICS: scheduler.add('metrics', Config.METRICS_INTERVAL, write_metrics)
+    scheduler.add('recent', Config.SPARKLINE_SAVE_INTERVAL, save_recent)
+    # tells the supervisor the loop is still going, it restarts this process when the beats stop
+    if heartbeat is not None: scheduler.add('heartbeat', Config.HEARTBEAT_INTERVAL, heartbeat.beat)
 
     # infinite loop to continuously check weather values
     infoMsg("i","Start Loop...")
+    startup_event('loop')
+    # rather than waiting for the first 5 second slot
+    if Config.FAST_START:
+        scheduler.job('sensehat').func()
+        for sensor in Config.SENSORS: scheduler.job('sensor:'+sensor['name']).func()
+        scheduler.job('sample').func()
+    if heartbeat is not None: heartbeat.beat()
+
+    if run_for is None:
+        keep_going = lambda: GO
+    else:
+        stop_at = clock.monotonic() + run_for
+        keep_going = lambda: GO and clock.monotonic() < stop_at
 
-    while (GO==True):
-        # The temp measurement smoothing algorithm's accuracy is based
-        # on frequent measurements, so we'll take measurements every 5 seconds
-        # but only show on DISPLAY_INTERVAL
-        current_second = datetime.datetime.now().second
-        # are we at the top of the minute or at a 5 second interval?
-        if (current_second == 0) or ((current_second % 5) == 0):
-            # ========================================================
-            # read values from the Sense HAT
-            # ========================================================
-            # Calculate the temperature. The get_temp function 'adjusts' the recorded temperature adjusted for the
-            # current processor temp in order to accommodate any temperature leakage from the processor to
-            # the Sense HAT's sensor. This happens when the Sense HAT is mounted on the Pi in a case.
-            # If you've mounted the Sense HAT outside of the Raspberry Pi case, then you don't need that
-            # calculation. So, when the Sense HAT is external, replace the following line (comment it out  with a #)
-            # calc_temp = get_temp()
-            # with the following line (uncomment it, remove the # at the line start)
-            # calc_temp = sense.get_temperature_from_pressure()
-            # or the following line (each will work)
-            # calc_temp = sense.get_temperature_from_humidity()
-            # ========================================================
-            # At this point, we should have an accurate temperature, so lets use the recorded (or calculated)
-            # temp for our purposes
-
-            AirTemperature=probe_temp(Config.TEMP_SENSOR_1)
-            if (AirTemperature['status']==0):
-                NOTICE['Air']['Notify']=False
-                temp_c = round(AirTemperature['celcius'],1)
-                temp_f = round(c_to_f(AirTemperature['celcius']),1)
-                AirTemperatureProbeId = Config.PROBE_1
-            elif Config.USE_SENSEHAT_TEMPERATURE:
-                NOTICE['Air']['Notify']=True
-                calc_temp = get_temp()
-                temp_c = round(calc_temp,1)
-                temp_f = round(c_to_f(calc_temp),1)
-                AirTemperatureProbeId = 'SenseHat'
-            else:
-                temp_c = -99
-                temp_f = -99
-                AirTemperatureProbeId = 'NotSet'
-
-            ColdFrameTemperature=probe_temp(Config.TEMP_SENSOR_2)
-            if (ColdFrameTemperature['status']==0):
-                NOTICE['ColdFrame']['Notify']=False
-                coldframe_temp_c = round(ColdFrameTemperature['celcius'],1)
-                coldframe_temp_f = round(c_to_f(ColdFrameTemperature['celcius']),1)
-                ColdFrameTemperatureProbeId = Config.PROBE_2
-            elif State['ColdFrameOn']:
-                NOTICE['ColdFrame']['Notify']=True
-                calc_temp = get_temp()
-                coldframe_temp_c = 0
-                coldframe_temp_f = 0
-                ColdFrameTemperatureProbeId = 'None'
-            else:
-                coldframe_temp_c = -99
-                coldframe_temp_f = -99
-                ColdFrameTemperatureProbeId = 'NotSet'
-
-            humidity = round(sense.get_humidity(), 1)
-            # calculate dew point
-            try:
-                dew_point_c=round((B1*(math.log(humidity/100) + (A1*temp_c)/(B1 +temp_c)))/(A1-math.log(humidity/100)-A1*temp_c/(B1+temp_c)),1)
-            except:
-                dew_point_c=0.0
-                infoMsg("i","************************************")
-                infoMsg("i","******** Error on dew point ********")
-                infoMsg("i","************************************")
-                infoMsg("i","A1=======>"+str(A1))
-                infoMsg("i","B1=======>"+str(B1))
-                infoMsg("i","humidity=>"+str(humidity))
-                infoMsg("i","temp_c===>"+str(temp_c))
-                infoMsg("i","=========> (B1*(math.log(humidity/100) + (A1*temp_c)/(B1 +temp_c)))/(A1-math.log(humidity/100)-A1*temp_c/(B1+temp_c)) <<====")
-                infoMsg("i","************************************")
-
-            # convert pressure from millibars to inHg for weather underground
-            calc_pressure = sense.get_pressure()
-            pressure_mB = round(calc_pressure, 2)
-            pressure_Hg = round(calc_pressure * 0.0295300, 2)
-            # print("Temp: %sF (%sC), Pressure: %s inHg, Humidity: %s%%" % (temp_f, temp_c, pressure, humidity))
-            # pressure = pressure_mB
-            temp = temp_f
-            pressure = pressure_mB
-
-            # display celcius if SI selected
-            if (Config.DISPLAY_SI): temp = temp_c
-
-            # set display temp to integer
-            display_temp=int(round(temp,0))
-
-            # get the current minute
-            current_minute = datetime.datetime.now().minute
-            current_hour = datetime.datetime.now().hour
-
-            # test pressure change over 15 minute intervals
-            if (current_minute == 0) or ((current_minute % 15) == 0):
-                last_pressure = round(pressure_mB,1)
-
-            # show pressure trend
-            this_pressure = round(pressure_mB,1)
-            if (this_pressure>last_pressure): show_trending_up(b)
-            elif (this_pressure<last_pressure): show_trending_down(b)
-            else: show_steady_state(b)
-
-            # print("C/L:%s=/=%s Temp: %sF (%sC), Dew Point: %d Pressure: %s inHg, Humidity: %s%%" % (current_minute, last_minute, temp_f, temp_c, dew_point_c, pressure, humidity))
-            # is it the same minute as the last time we checked?
-            if current_minute != last_minute:
-                # reset last_minute to the current_minute
-                last_minute = current_minute
-                # is minute zero, or divisible by 10?
-                # we're only going to take measurements every DISPLAY_INTERVAL minutes
-                now = datetime.datetime.now()
-                if (current_minute == 0) or ((current_minute % Config.DISPLAY_INTERVAL) == 0):
-                    # print("\n%d minute mark (%d @ %s)" % (DISPLAY_INTERVAL, current_minute, str(now)))
-                    # did the temperature go up or down?
-                    if last_temp != display_temp:
-                        rgb=g
-                        if (display_temp<1): rgb=b
-                        sense.clear()
-                        if (current_hour>Config.SUNSET) and (current_hour<Config.SUNRISE): sense.low_light = True
-                        show_number(display_temp, rgb)
-                    last_temp = display_temp
-
-                    # show pressure trend
-                    # if (pressure_mB>last_pressure): show_trending_up(b)
-                    # elif (pressure_mB<last_pressure): show_trending_down(b)
-                    # else: show_steady_state(b)
-
-                    # last_pressure = pressure_mB
-
-                utc_datetime=datetime.datetime.utcnow()
-                local_datetime=datetime.datetime.now()
-
-                # ========================================================
-                # Upload the weather data to DB's
-                # ========================================================
-                if Config.PW_UPLOAD:
-                    if (current_minute == 0) or ((current_minute % Config.PW_UPLOAD_INTERVAL) == 0):
-                        # print("Pi Server Upload...%s" % (local_datetime))
-                        infoMsg("d","Pi Server Upload...")
-                        NOTICE['DataLoad']['Notify']=False
-                        NOTICE['PiServer']['Notify']=False
-                        rpt_dim=0
-                        rpt_display=0
-                        rpt_coldframe=0
-                        rpt_WU=0
-                        if State['DisplayDim']==True: rpt_dim=1
-                        if State['DisplayOn']==True: rpt_display=1
-                        if State['ColdFrameOn']==True: rpt_coldframe=1
-                        if State['WUUpload']==False: rpt_WU=0
-                        else: rpt_WU=State['WUInterval']
-                        # From http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
-                        # print("Uploading data to Weather Pi")
-                        # build a weather data object
-                            # "cf": str(coldframe_temp_c),
-                            # "cid": str(ColdFrameTemperatureProbeId),
-                        weather_data = {
-                            "si": Config.PW_ID,
-                            "t": str(temp),
-                            "rh": str(humidity),
-                            "p": str(pressure),
-                            "dp": str(dew_point_c),
-                            "sld": local_datetime.strftime('%Y-%m-%d'),
-                            "slt": local_datetime.strftime('%H:%M:%S'),
-                            "stz": Config.LOCAL_STATION_TIMEZONE,
-                            "sud": utc_datetime.strftime('%Y-%m-%d'),
-                            "sut": utc_datetime.strftime('%H:%M:%S'),
-                            "pid": str(AirTemperatureProbeId),
-                            "cf": str(coldframe_temp_c),
-                            "cid": str(ColdFrameTemperatureProbeId),
-                            "dd": str(rpt_dim),
-                            "do": str(rpt_display),
-                            "co": str(rpt_coldframe),
-                            "wu": str(rpt_WU),
-                            "st": "Current",
-                        }
-                        try:
-                            upload_url = Config.PW_URL + "?" + urlencode(weather_data)
-                            response = urllib2.urlopen(upload_url)
-                            rtn_control = json.load(response)
-                            FAILURE_COUNTER=0
-                            if ("Status" in rtn_control):
-                                infoMsg("d","Returned==> %s" % str(rtn_control))
-                                if (rtn_control["Status"]==0):
-                                    NOTICE['DataLoad']['Notify']=False
-                                elif (rtn_control["Status"]==1):
-                                    infoMsg("i","Parameter Updates...")
-                                    NOTICE['DataLoad']['Notify']=False
-                                    if "PiShutdown" in rtn_control:
-                                        GO=False
-                                        SHUTDOWN=True
-                                        infoMsg("i","Shutting Down Weather Pi....")
-                                    if "PiReboot" in rtn_control:
-                                        GO=False
-                                        REBOOT=True
-                                        infoMsg("i","Rebooting Weather Pi....")
-                                    if "WeatherPiOff" in rtn_control:
-                                        GO=False
-                                        infoMsg("i","Shutting Weather Pi App Off....")
-                                    if "DisplayDim" in rtn_control:
-                                        if (rtn_control["DisplayDim"]=='Yes'):
-                                            Config.DISPLAY_DIM=True
-                                            infoMsg("i","Display to Dim")
-                                        else:
-                                            Config.DISPLAY_DIM=False
-                                            infoMsg("i","Display to Bright")
-                                        State['DisplayDim']=Config.DISPLAY_DIM
-                                        State['Status']='Stale'
-                                    if "DisplayOn" in rtn_control:
-                                        if (rtn_control["DisplayOn"]=='Yes'):
-                                            Config.DISPLAY_ON=True
-                                            show_number(display_temp, rgb)
-                                            infoMsg("i","Display On")
-                                        else:
-                                            Config.DISPLAY_ON=False
-                                            sense.clear()
-                                            infoMsg("i","Display Off")
-                                        State['DisplayOn']=Config.DISPLAY_ON
-                                        State['Status']='Stale'
-                                    if "PiServerUploadInterval" in rtn_control:
-                                        if (int(rtn_control["WUServerUploadInterval"])>0):
-                                            Config.PW_UPLOAD=True
-                                            Config.PW_UPLOAD_INTERVAL=int(rtn_control["PiServerUploadInterval"])
-                                            infoMsg("i","Setting Upload to Weather DB to "+str(Config.PW_UPLOAD_INTERVAL)+" minutes")
-                                        else:
-                                            Config.PW_UPLOAD=False
-                                            infoMsg("i","Setting Upload to Weather DB Off")
-                                    if "ColdFrame" in rtn_control:
-                                        infoMsg("i","Setting ColdFrame "+rtn_control["ColdFrame"])
-                                        if (rtn_control["ColdFrame"]==On):
-                                            Config.USE_PROBE_2=True
-                                        else:
-                                            Config.USE_PROBE_2=False
-                                        State['ColdFrameOn']=Config.USE_PROBE_2
-                                        State['Status']='Stale'
-                                    if "WUServerUploadInterval" in rtn_control:
-                                        infoMsg("i","Setting WUServerUploadInterval=> %s" % rtn_control["WUServerUploadInterval"])
-                                        Config.WU_UPLOAD=False
-                                        if (int(rtn_control["WUServerUploadInterval"])>14):
-                                            Config.WU_UPLOAD=True
-                                            Config.WU_UPLOAD_INTERVAL=int(rtn_control["WUServerUploadInterval"])
-                                            infoMsg("i","Setting WU Interval to "+str(Config.WU_UPLOAD_INTERVAL)+" minutes")
-                                        else:
-                                            Config.WU_UPLOAD=False
-                                            infoMsg("i","Setting Weather Underground Upload Off")
-                                        State['WUUpload']=Config.WU_UPLOAD
-                                        State['WUInterval']=Config.WU_UPLOAD_INTERVAL
-                                        State['Status']='Stale'
-                                else:
-                                    infoMsg("w","...DataLoad Status "+rtn_control["Status"])
-                                    infoMsg("w","...Weather_data==>"+str(weather_data))
-                                    NOTICE['DataLoad']['Notify']=True
-                            else:
-                                html = response.read()
-                                infoMsg("w","...DataLoad No Status Returned")
-                                infoMsg("w","...Server response==>"+str(html))
-                                response.close()  # best practice to close the file
-                                NOTICE['PiServer']['Notify']=True
-
-                        except:
-                            infoMsg("w","...PW Exception:"+str(sys.exc_info()[0]))
-                            t=str(temp)
-                            rh=str(humidity)
-                            p=str(pressure)
-                            dp=str(dew_point_c)
-                            cf=str(coldframe_temp_c)
-                            pid=str(AirTemperatureProbeId)
-                            cid=str(ColdFrameTemperatureProbeId)
-                            if Config.FAILURE_CSV: failureLog(t,rh,p,dp,cf,pid,cid,current_minute)
-                            NOTICE['PiServer']['Notify']=True
-                            FAILURE_COUNTER=FAILURE_COUNTER+1
-                            if (FAILURE_COUNTER>Config.FAILURE_MAX) and (Config.FAILURE_REBOOT):
-                                GO=False
-                                REBOOT=True
-                                infoMsg("i","Rebooting Weather Pi Due To Excessive Upload Failures (%s)...." % str(FAILURE_COUNTER))
-
-                # else:
-                    # NOTICE['PiServer']['Notify']=True
-                    # print("Skipping Weather Pi upload")
-
-                # ========================================================
-                # Upload the weather data to Weather Underground
-                # ========================================================
-                # is weather upload enabled (True)?
-                if State['WUUpload']:
-                    if (current_minute == 0) or ((current_minute % State['WUInterval']) == 0):
-                        # From http://wiki.wunderground.com/index.php/PWS_-_Upload_Protocol
-                        # print("Uploading data to Weather Underground")
-                        # build a weather data object
-                        infoMsg("d","WU Server Upload...")
-                        weather_data = {
-                            "action": "updateraw",
-                            "ID": wu_station_id,
-                            "PASSWORD": wu_station_key,
-                            "dateutc": "now",
-                            "tempf": str(temp_f),
-                            "humidity": str(humidity),
-                            "baromin": str(pressure_Hg),
-                        }
-                        try:
-                            upload_url = Config.WU_URL + "?" + urlencode(weather_data)
-                            response = urllib2.urlopen(upload_url)
-                            html = response.read()
-                            infoMsg("d","WU Response:"+str(html))
-                            response.close()  # best practice to close the file
-                            NOTICE['WUServer']['Notify']=False
-                        except:
-                            infoMsg("w","...WU URL      :"+str(upload_url))
-                            infoMsg("w","...WU Exception:"+str(sys.exc_info()[0]))
-                            # infoMsg("w","...WU Response:"+str(html))
-                            NOTICE['WUServer']['Notify']=True
-
-                # else:
-                    # NOTICE['WUServer']['Notify']=True
-                    # print("Skipping Weather Underground upload")
-
-            if State['Status']=='Stale': saveState('main')
-            # scroll notifications if any are set
-            check_notification()
-
-        # wait a second then check again
-        # You can always increase the sleep value below to check less often
-        time.sleep(1)  # this should never happen since the above is an infinite loop
+    try:
+        scheduler.run(keep_going)
+    finally:
+        # anything still queued goes to the outbox rather than being lost
+        for weather_data in pw_uploader.stop(): storeFailure(weather_data)
+        wu_uploader.stop()
+        # a part batch is sent rather than left in the queue
+        for spec, sink in sinks:
+            # the last values the compression held back
+            if Reading and breakers[sink.name].allow():
+                for record in sink_records(sink.name, sink_record(), flush=True): sink.submit(record)
+            sink.stop(flush=True)
+        hw.close()
+        infoMsg("i","Probe Stats======> %s" % json.dumps(probes.stats(), sort_keys=True))
+        infoMsg("i","SenseHat Stats===> %s" % json.dumps(sampler.stats(), sort_keys=True))
+        infoMsg("i","Filter Rejects===> %s" % json.dumps(filters.rejected(), sort_keys=True))
+        infoMsg("i","Scheduler Stats==> %s" % json.dumps(scheduler.stats(), sort_keys=True))
+        infoMsg("i","Upload Stats=====> %s" % json.dumps({'pw': pw_uploader.stats(), 'wu': wu_uploader.stats()}, sort_keys=True))
+        infoMsg("i","Breakers=========> %s" % json.dumps(dict((name, breakers[name].snapshot()) for name in breakers), sort_keys=True))
+        if compressions:
+            infoMsg("i","Compression======> %s" % json.dumps(dict((name, compressions[name].ratio()) for name in compressions), sort_keys=True))
+        if sinks:
+            infoMsg("i","Sink Stats=======> %s" % json.dumps(dict((sink.name, sink.stats()) for spec, sink in sinks), sort_keys=True))
+        if Config.OUTBOX:
+            replayer.stop()
+            infoMsg("i","Replay Stats=====> %s" % json.dumps(replayer.stats(), sort_keys=True))
+            outbox.close()
+        if Config.CONTROL:
+            control.stop()
+            infoMsg("i","Command Stats====> %s" % json.dumps(commands.stats(), sort_keys=True))
+        if Config.API:
+            api.stop()
+            infoMsg("i","API Stats========> %s" % json.dumps(api.stats(), sort_keys=True))
+        if Config.TSDB:
+            history.close()
+        save_recent()
+        if log_handler is not None:
+            infoMsg("i","Log Stats========> %s" % json.dumps(log_handler.stats(), sort_keys=True))
 
     infoMsg("i","Sending GoodBye....")
+    display.stop()
     sense.clear()
     sense.show_message("GoodBye", text_colour=[255, 255, 0], back_colour=[0, 0, 255])
-    time.sleep(10)
+    clock.sleep(10)
     sense.clear()
+    if (SHUTDOWN or REBOOT): saveState('main')
     if (SHUTDOWN):
         infoMsg("i","Shutdown....")
         shutdown_now()
@@ -682,132 +1005,204 @@ def main():
 # ============================================================================
 # Start Start Start Start Start Start Start Start Start Start Start Start
 # ============================================================================
-infoMsg("i",".........................")
-infoMsg("i",".........................")
-infoMsg("i","Weather Pi....Starting...")
-infoMsg("i",".........................")
-infoMsg("i",".........................")
-
-infoMsg("i","Initializing Configuration")
-
-infoMsg("i","USE_PROBE_1================>"+str(Config.USE_PROBE_1))
-infoMsg("i","PROBE_1====================>"+Config.PROBE_1)
-infoMsg("i","TEMP_SENSOR_1==============>"+Config.TEMP_SENSOR_1)
-infoMsg("i","USE_PROBE_2================>"+str(Config.USE_PROBE_2))
-infoMsg("i","PROBE_2====================>"+Config.PROBE_2)
-infoMsg("i","TEMP_SENSOR_2==============>"+Config.TEMP_SENSOR_2)
-infoMsg("i","USE_SENSEHAT_TEMPERATURE===>"+str(Config.USE_SENSEHAT_TEMPERATURE))
-
-infoMsg("i","LOCAL_STATION_ID===========>"+Config.LOCAL_STATION_ID)
-infoMsg("i","LOCAL_STATION_TIMEZONE=====>"+Config.LOCAL_STATION_TIMEZONE)
-
-infoMsg("i","SUNRISE====================>"+str(Config.SUNRISE))
-infoMsg("i","SUNSET=====================>"+str(Config.SUNSET))
-
-infoMsg("i","MEASUREMENT_INTERVAL=======>"+str(Config.MEASUREMENT_INTERVAL))
-infoMsg("i","DISPLAY_INTERVAL===========>"+str(Config.DISPLAY_INTERVAL))
-infoMsg("i","DISPLAY_ON=================>"+str(Config.DISPLAY_ON))
-infoMsg("i","DISPLAY_DIM================>"+str(Config.DISPLAY_DIM))
-infoMsg("i","DISPLAY_SI=================>"+str(Config.DISPLAY_SI))
-
-infoMsg("i","FAILURE_CSV================>"+str(Config.FAILURE_CSV))
-infoMsg("i","FAILURE_DIR================>"+str(Config.FAILURE_DIR))
-infoMsg("i","FAILURE_REBOOT=============>"+str(Config.FAILURE_REBOOT))
-infoMsg("i","FAILURE_MAX================>"+str(Config.FAILURE_MAX))
-
-infoMsg("i","PW_UPLOAD==================>"+str(Config.PW_UPLOAD))
-infoMsg("i","PW_UPLOAD_INTERVAL=========>"+str(Config.PW_UPLOAD_INTERVAL))
-infoMsg("i","PW_URL=====================>"+Config.PW_URL)
-infoMsg("i","PW_ID======================>"+Config.PW_ID)
-
-infoMsg("i","WU_UPLOAD==================>"+str(Config.WU_UPLOAD))
-infoMsg("i","WU_UPLOAD_INTERVAL=========>"+str(Config.WU_UPLOAD_INTERVAL))
-infoMsg("i","WU_URL=====================>"+Config.WU_URL)
-
-# make sure we don't have a DISPLAY_INTERVAL > 60
-if (Config.MEASUREMENT_INTERVAL is None) or (Config.MEASUREMENT_INTERVAL > 60):
-    infoMsg("w","The application's 'MEASUREMENT_INTERVAL' cannot be empty or greater than 60")
-    sys.exit(1)
-if (Config.DISPLAY_INTERVAL is None) or (Config.DISPLAY_INTERVAL > 60):
-    infoMsg("w","The application's 'DISPLAY_INTERVAL' cannot be empty or greater than 60")
-    sys.exit(1)
-if (Config.PW_UPLOAD_INTERVAL is None) or (Config.PW_UPLOAD_INTERVAL > 60):
-    infoMsg("w","The application's 'PW_UPLOAD_INTERVAL' cannot be empty or greater than 60")
-    sys.exit(1)
-if (Config.WU_UPLOAD_INTERVAL is None) or (Config.WU_UPLOAD_INTERVAL < 15) or (Config.WU_UPLOAD_INTERVAL > 60):
-    infoMsg("w","The application's 'WU_UPLOAD_INTERVAL' cannot be empty, less than 15 or greater than 60")
-    sys.exit(1)
-
-#  Set Weather Underground Configuration Parameters
-wu_station_id = Config.STATION_ID
-wu_station_key = Config.STATION_KEY
-if (wu_station_id is None) or (wu_station_key is None):
-    infoMsg("w","Missing values from the Weather Underground configuration file")
-    Config.WU_UPLOAD = False
-
-infoMsg("i","Station ID:"+wu_station_id)
-
-infoMsg("i","Successfully Set Configuration Values")
-
-infoMsg("i","Load Saved State")
-
-# weather station state
-State= {'Status': 'Stale',
-        'Updated': 'Unknown',
-        'DisplayDim': False,
-        'DisplayOn': True,
-        'ColdFrameOn': True,
-        'WUUpload': False,
-        'WUInterval': 15}
-
-State['DisplayDim']=Config.DISPLAY_DIM
-State['DisplayOn']=Config.DISPLAY_ON
-State['ColdFrameOn']=Config.USE_PROBE_2
-State['WUUpload']=Config.WU_UPLOAD
-State['WUInterval']=Config.WU_UPLOAD_INTERVAL
-
-loadState()
-
-infoMsg("i","State -> Status ==========>"+str(State['Status']))
-infoMsg("i","         Updated =========>"+str(State['Updated']))
-infoMsg("i","         DisplayDim ======>"+str(State['DisplayDim']))
-infoMsg("i","         DisplayOn =======>"+str(State['DisplayOn']))
-infoMsg("i","         ColdFrameOn =====>"+str(State['ColdFrameOn']))
-infoMsg("i","         WUUpload ========>"+str(State['WUUpload']))
-infoMsg("i","         WUInterval ======>"+str(State['WUInterval']))
-
-infoMsg("i","Successfully Set State Values")
-
-# ============================================================================
-# initialize the Sense HAT object
-# ============================================================================
-try:
-    infoMsg("i","Initializing the Sense HAT client")
-    sense = SenseHat()
-    sense.low_light = False
-    # if (current_hour>SUNSET) and (current_hour<SUNRISE): sense.low_light = True
-    # sense.set_rotation(180)
-    # then write some text to the Sense HAT's 'screen'
-    sense.show_message("Weather Pi", text_colour=[255, 255, 0], back_colour=[0, 0, 255])
-    # clear the screen
-    sense.clear()
-    # get the current temp to use when checking the previous measurement
-    # last_temp = int(round(c_to_f(get_temp()), 0))
-    last_temp = 0
-    rgb=g
-    if (last_temp<1): rgb=b
-    # sense.low_light = True
-    show_number(last_temp, rgb)
-    infoMsg("i","Current temperature reading:"+str(last_temp))
-except:
-    infoMsg("w","...Unable to initialize the Sense HAT library:"+str(sys.exc_info()[0]))
-    sys.exit(1)
+def startup(hardware):
+    # log the configuration, load the State & bring up the display on the given hardware (see hal.py)
+    global hw, clock, sense, probes, cpu_temp, sampler, display, filters, window, pressure_tendency, recent
+    global metrics, stage, sensehat_fallbacks, commands, startup_times
+    global State, wu_station_id, wu_station_key, last_temp, Reading, channels
+    global GO, REBOOT, SHUTDOWN, FAILURE_COUNTER
+
+    hw = hardware
+    clock = hw.clock
+    sense = hw.sense
+    probes = hw.probes
+    cpu_temp = hw.cpu
+    GO = True
+    REBOOT = False
+    SHUTDOWN = False
+    FAILURE_COUNTER = 0
+    Reading = {}
+    channels = dict((sensor['name'], {'c': -99, 'f': -99, 'id': 'NotSet', 'valid': False}) for sensor in Config.SENSORS)
+    for notice in NOTICE.values(): notice['Notify'] = False
+
+    # stage timings & counters, served at /metrics & written to METRICS_PATH
+    metrics = Registry()
+    startup_times = {}
+    stage = {}
+    for name in ('sample', 'sensors', 'probes', 'sensehat', 'derived', 'display', 'pw_upload', 'wu_upload', 'sinks'):
+        stage[name] = metrics.histogram('weatherpi_stage_seconds', 'Seconds spent per stage', stage=name)
+    sensehat_fallbacks = metrics.counter('weatherpi_sensehat_fallbacks_total', 'Samples taking the air temperature from the SenseHat')
+    commands = command_processor()
+
+    infoMsg("i",".........................")
+    infoMsg("i",".........................")
+    infoMsg("i","Weather Pi....Starting...")
+    infoMsg("i",".........................")
+    infoMsg("i",".........................")
+
+    infoMsg("i","Initializing Configuration")
+
+    # the configuration goes to the log as one record
+    settings = ['FAST_START', 'SENSEHAT_OVERSAMPLE',
+                'W1_DEVICES', 'PROBE_INTERVAL', 'PROBE_MAX_AGE', 'PROBE_1', 'PROBE_2', 'USE_PROBE_2', 'USE_SENSEHAT_TEMPERATURE', 'SENSORS',
+                'LOCAL_STATION_ID', 'LOCAL_STATION_TIMEZONE', 'ALTITUDE', 'DERIVED',
+                'SUNRISE', 'SUNSET',
+                'TENDENCY_WINDOWS', 'TENDENCY_STEADY',
+                'MEASUREMENT_INTERVAL', 'DISPLAY_INTERVAL', 'DISPLAY_ON', 'DISPLAY_DIM', 'DISPLAY_SI', 'DISPLAY_MODE',
+                'SPARKLINE_HOURS', 'SPARKLINE_SLOT', 'SPARKLINE_MIN_RANGE', 'SPARKLINE_PATH',
+                'HEARTBEAT_INTERVAL', 'HEARTBEAT_TIMEOUT',
+                'FAILURE_REBOOT', 'BREAKER_THRESHOLD', 'BREAKER_BACKOFF', 'BREAKER_BACKOFF_MAX', 'BREAKER_JITTER',
+                'BREAKER_RECOVERY', 'NETWORK_RESTART', 'NETWORK_CHECK_PORT',
+                'PW_UPLOAD', 'PW_UPLOAD_INTERVAL', 'PW_URL', 'PW_ID',
+                'WU_UPLOAD', 'WU_UPLOAD_INTERVAL', 'WU_URL',
+                'UPLOAD_QUEUE_SIZE', 'UPLOAD_CONNECT_TIMEOUT', 'UPLOAD_READ_TIMEOUT', 'SINKS',
+                'OUTBOX', 'OUTBOX_PATH', 'PW_BATCH_URL', 'REPLAY_BATCH_SIZE', 'REPLAY_RATE', 'REPLAY_MAX_ATTEMPTS',
+                'TSDB', 'TSDB_PATH', 'TSDB_FLUSH_INTERVAL', 'TSDB_RETENTION', 'TSDB_COMPRESS', 'COMPRESSION',
+                'STATE_PATH', 'TRACE_PATH',
+                'METRICS', 'METRICS_PATH', 'METRICS_INTERVAL',
+                'CONTROL', 'CONTROL_BIND', 'CONTROL_PORT',
+                'API', 'API_BIND', 'API_PORT']
+    infoMsg("i","Configuration:\n"+"\n".join("%s>%s" % (name.ljust(27, '='), str(getattr(Config, name))) for name in settings))
+
+    # make sure we don't have a DISPLAY_INTERVAL > 60
+    if (Config.MEASUREMENT_INTERVAL is None) or (Config.MEASUREMENT_INTERVAL > 60):
+        infoMsg("w","The application's 'MEASUREMENT_INTERVAL' cannot be empty or greater than 60")
+        sys.exit(1)
+    if (Config.DISPLAY_INTERVAL is None) or (Config.DISPLAY_INTERVAL > 60):
+        infoMsg("w","The application's 'DISPLAY_INTERVAL' cannot be empty or greater than 60")
+        sys.exit(1)
+    if Config.DISPLAY_MODE not in DISPLAY_MODES:
+        infoMsg("w","The application's 'DISPLAY_MODE' must be one of "+", ".join(DISPLAY_MODES))
+        sys.exit(1)
+    if (Config.PW_UPLOAD_INTERVAL is None) or (Config.PW_UPLOAD_INTERVAL > 60):
+        infoMsg("w","The application's 'PW_UPLOAD_INTERVAL' cannot be empty or greater than 60")
+        sys.exit(1)
+    if (Config.WU_UPLOAD_INTERVAL is None) or (Config.WU_UPLOAD_INTERVAL < 15) or (Config.WU_UPLOAD_INTERVAL > 60):
+        infoMsg("w","The application's 'WU_UPLOAD_INTERVAL' cannot be empty, less than 15 or greater than 60")
+        sys.exit(1)
+    fields = ['rh', 'p'] + list(Config.DERIVED)
+    for name in Config.DERIVED:
+        if name not in DERIVED:
+            infoMsg("w","The application's 'DERIVED' entry '"+str(name)+"' must be one of "+", ".join(DERIVED))
+            sys.exit(1)
+    for name in Config.COMPRESSION:
+        try:
+            make_compressor(name, Config.COMPRESSION[name])
+        except ValueError:
+            infoMsg("w","The application's 'COMPRESSION' entry '"+str(name)+"' needs a kind of deadband, door or None")
+            sys.exit(1)
+    for sensor in Config.SENSORS:
+        if (sensor['source'] not in ('probe', 'sensehat')) or not (sensor.get('interval', 0) > 0) or (sensor['field'] in fields) or (sensor['id_field'] in fields):
+            infoMsg("w","The application's 'SENSORS' entry '"+str(sensor['name'])+"' needs a source of probe or sensehat, an interval & its own field names")
+            sys.exit(1)
+        fields += [sensor['field'], sensor['id_field']]
+
+    #  Set Weather Underground Configuration Parameters
+    wu_station_id = Config.STATION_ID
+    wu_station_key = Config.STATION_KEY
+    if (wu_station_id is None) or (wu_station_key is None):
+        infoMsg("w","Missing values from the Weather Underground configuration file")
+        Config.WU_UPLOAD = False
+
+    infoMsg("i","Station ID:"+wu_station_id)
+
+    infoMsg("i","Successfully Set Configuration Values")
+
+    infoMsg("i","Load Saved State")
+
+    # weather station state
+    State= {'Status': 'Stale',
+            'Updated': 'Unknown',
+            'DisplayDim': False,
+            'DisplayOn': True,
+            'ColdFrameOn': True,
+            'WUUpload': False,
+            'WUInterval': 15,
+            'DisplayMode': 'Number'}
+
+    State['DisplayDim']=Config.DISPLAY_DIM
+    State['DisplayOn']=Config.DISPLAY_ON
+    State['ColdFrameOn']=Config.USE_PROBE_2
+    State['WUUpload']=Config.WU_UPLOAD
+    State['WUInterval']=Config.WU_UPLOAD_INTERVAL
+    State['DisplayMode']=Config.DISPLAY_MODE
+
+    loadState()
+    # a State saved before the display modes
+    State.setdefault('DisplayMode', Config.DISPLAY_MODE)
+
+    infoMsg("i","State -> Status ==========>"+str(State['Status'])+"\n"
+               "         Updated =========>"+str(State['Updated'])+"\n"
+               "         DisplayDim ======>"+str(State['DisplayDim'])+"\n"
+               "         DisplayOn =======>"+str(State['DisplayOn'])+"\n"
+               "         ColdFrameOn =====>"+str(State['ColdFrameOn'])+"\n"
+               "         WUUpload ========>"+str(State['WUUpload'])+"\n"
+               "         WUInterval ======>"+str(State['WUInterval'])+"\n"
+               "         DisplayMode =====>"+str(State['DisplayMode']))
+
+    infoMsg("i","Successfully Set State Values")
+
+    # ============================================================================
+    # initialize the Sense HAT object
+    # ============================================================================
+    specs = dict(Config.FILTERS)
+    for sensor in Config.SENSORS: specs[sensor['name']] = sensor.get('filter')
+    filters = Filters(specs)
+    window = Aggregator(['rh', 'p'] + list(Config.DERIVED) + [sensor['field'] for sensor in Config.SENSORS])
+    pressure_tendency = Tendency(Config.TENDENCY_WINDOWS, SAMPLE_INTERVAL, Config.TENDENCY_STEADY)
+    # the last hours of the air temperature & pressure in fixed memory, for the display's history modes
+    recent = HistoryRing([Config.SENSORS[0]['field'], 'p'], int(Config.SPARKLINE_HOURS * 3600 // Config.SPARKLINE_SLOT), Config.SPARKLINE_SLOT)
+    if recent.load(os.path.join(baseDir, Config.SPARKLINE_PATH)): infoMsg("i","Recent History Loaded")
+    infoMsg("i","CPU Temperature From "+cpu_temp.source+" "+str(cpu_temp.path))
 
+    try:
+        infoMsg("i","Initializing the Sense HAT client")
+        sense.low_light = False
+        sampler = SenseSampler(sense, cpu_temp, clock, Config.SENSEHAT_OVERSAMPLE)
+        infoMsg("i","SenseHat Reads From "+("its sensors" if sampler.direct else "the getters")+", "+str(sampler.oversample)+" per sample")
+        # if (current_hour>SUNSET) and (current_hour<SUNRISE): sense.low_light = True
+        # sense.set_rotation(180)
+        # get the current temp to use when checking the previous measurement
+        # last_temp = int(round(c_to_f(get_temp()), 0))
+        last_temp = 0
+        rgb=g
+        if (last_temp<1): rgb=b
+        # sense.low_light = True
+        # hand the matrix over to the background display engine
+        display = LedDisplay(sense)
+        display.enable(State['DisplayOn'])
+        # then write some text to the Sense HAT's 'screen'
+        if Config.FAST_START:
+            # scrolled by the display thread while the first sample is taken
+            display.message("Weather Pi", [255, 255, 0], [0, 0, 255])
+        else:
+            sense.show_message("Weather Pi", text_colour=[255, 255, 0], back_colour=[0, 0, 255])
+            # clear the screen
+            sense.clear()
+        display.number(last_temp, rgb)
+        display.start()
+        infoMsg("i","Current temperature reading:"+str(last_temp))
+    except:
+        infoMsg("e","...Unable to initialize the Sense HAT library:"+str(sys.exc_info()[0]))
+        sys.exit(1)
 
-infoMsg("i","Initialization complete!")
+    infoMsg("i","Initialization complete!")
 
 # Now see what we're supposed to do next
 if __name__ == "__main__":
+    setup_logging(logFilePath)
+    heartbeat = Heartbeat.from_environ()
+    if heartbeat is not None:
+        infoMsg("i","Running under the supervisor")
+        signal.signal(signal.SIGTERM, stop_signal)
+        # the supervisor asks for every thread's stack before it restarts a hung loop
+        heartbeat.register_stacks()
+    try:
+        hardware = PiHardware(Config)
+    except:
+        infoMsg("e","...Unable to initialize the Sense HAT library:"+str(sys.exc_info()[0]))
+        sys.exit(1)
+    startup(hardware)
     try:
         main()
     except KeyboardInterrupt: